@@ -1,26 +1,34 @@
-from flask import Flask, request, render_template_string
-from linebot import LineBotApi, WebhookHandler
-from linebot.models import MessageEvent, TextMessage, TextSendMessage
+from flask import Flask, Response, request, render_template_string, jsonify
+from markupsafe import escape
+from linebot import WebhookParser
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.models import MessageEvent, TextMessage, ImageMessage, TextSendMessage
 from dotenv import load_dotenv
 import os
-import random
 import json
-import requests
+import time
+import atexit
 import traceback
-from datetime import datetime
-import pytz
+from collections import namedtuple
 
-from apscheduler.schedulers.background import BackgroundScheduler
+import psycopg2
 from utils import (
-    create_tables, save_chat, get_session, save_session, clear_session,
-    get_chat_history, get_user_profile, update_user_profile, create_reminder,
-    get_due_reminders, delete_reminder, delete_user_profile_key,
-    get_reminders_for_today, get_all_unique_users,
-    get_all_user_profiles, get_pending_reminders_for_dashboard,
-    clear_pending_action,
-    # --- เพิ่ม import ฟังก์ชันใหม่ ---
-    delete_user_profile
+    load_turn,
+    DASHBOARD_TABLES, query_dashboard_table, get_dashboard_counts,
+    get_pool_stats,
 )
+from workers import TurnWorkerPool, QueueFull
+from gemini_client import GeminiClient, GeminiUnavailable
+from messaging import call_line_api
+from chatlog import ChatLogWriter
+from migrations import migrate
+from ocr import OcrPool, OcrBusy, read_stream
+from turns import (bangkok_tz, MODEL_NAME, REPLY_TOKEN_TTL, FALLBACK_REPLY, OCR_BUSY_REPLY, OCR_EMPTY_REPLY,
+                   prompt_cache, prompt_stats, response_cache, intent_router,
+                   plan_reply, finish_reply, image_prompt)
+from metrics import ERRORS, GaugeFunc, current_trace, record_stage, render_metrics, start_metrics_export, trace_turn
+from background import (line_bot_api, push_pool, reminder_push_pool, reminder_dispatcher, event_dedup,
+                        last_daily_run, RUN_SCHEDULER, background_jobs, run_background_jobs)
 
 # --- 1. INITIALIZATION ---
 load_dotenv()
@@ -30,183 +38,213 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not all([LINE_CHANNEL_ACCESS_TOKEN, LINE_CHANNEL_SECRET, GEMINI_API_KEY]):
     raise ValueError("Missing required environment variables.")
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+parser = WebhookParser(LINE_CHANNEL_SECRET)
 app = Flask(__name__)
-bangkok_tz = pytz.timezone('Asia/Bangkok')
-MODEL_NAME = "gemini-1.5-flash-latest"
-emotions = ["😊", "😄", "🤔", "👍", "🙌", "😉", "✨"]
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
 
-try:
-    print("Initializing database...")
-    create_tables()
-except Exception as e:
-    print(f"FATAL: Could not connect to database: {e}")
-    raise e
+gemini = GeminiClient(
+    GEMINI_API_KEY, MODEL_NAME,
+    max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")),
+    rate_per_sec=float(os.getenv("GEMINI_RATE_PER_SEC", "5")),
+    burst=int(os.getenv("GEMINI_BURST", "10")),
+    max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "3")),
+    breaker_threshold=int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5")),
+    breaker_reset=float(os.getenv("GEMINI_BREAKER_RESET", "30")),
+)
+
+# ภายใต้ gunicorn migration รันแล้วใน master (gunicorn.conf.py) ก่อน fork worker
+if os.getenv("SKIP_MIGRATIONS") != "1":
+    try:
+        print("Initializing database...")
+        migrate()
+    except Exception as e:
+        print(f"FATAL: Could not connect to database: {e}")
+        raise e
 
 # --- 2. BACKGROUND JOBS (SCHEDULER) ---
-def send_notifications():
-    with app.app_context():
-        reminders = get_due_reminders()
-        for r_id, user_id, message in reminders:
-            try:
-                line_bot_api.push_message(user_id, TextSendMessage(text=f"⏰ แจ้งเตือนความจำ:\n\n{message}"))
-                delete_reminder(r_id)
-            except Exception as e:
-                print(f"ERROR sending reminder {r_id}: {e}")
-
-def run_daily_proactive_tasks():
-    with app.app_context():
-        print(f"[{datetime.now(bangkok_tz).strftime('%Y-%m-%d %H:%M')}] Running ALL Daily Proactive Jobs...")
-        all_users = get_all_unique_users()
-        today_str = datetime.now(bangkok_tz).strftime('%d-%m')
-        for user_id in all_users:
-            profile = get_user_profile(user_id)
-            # Job 1: Daily Summary
-            reminders_today = get_reminders_for_today(user_id, bangkok_tz)
-            if reminders_today:
-                summary_text = "สวัสดีตอนเช้าค่ะ! ☀️\nนี่คือรายการแจ้งเตือนสำหรับวันนี้นะคะ:\n"
-                for msg, notify_at in reminders_today:
-                    summary_text += f"\n- {notify_at.astimezone(bangkok_tz).strftime('%H:%M')}: {msg}"
-                try: line_bot_api.push_message(user_id, TextSendMessage(text=summary_text))
-                except Exception as e: print(f"ERROR sending daily summary to {user_id}: {e}")
-            # Job 2: Birthday Greeting
-            if profile.get('วันเกิด') == today_str:
-                try: line_bot_api.push_message(user_id, TextSendMessage(text="🎂 สุขสันต์วันเกิดนะคะ! ขอให้เป็นวันที่ดี มีความสุขมากๆ เลยค่ะ 🎉"))
-                except Exception as e: print(f"ERROR sending birthday greeting to {user_id}: {e}")
-
-scheduler = BackgroundScheduler(timezone=bangkok_tz)
-scheduler.add_job(send_notifications, 'interval', minutes=1, id='notification_job')
-scheduler.add_job(run_daily_proactive_tasks, 'cron', hour=8, minute=0, id='daily_proactive_job')
-scheduler.start()
-print("Scheduler started: Notifications (1 min) and Proactive Daily Jobs (8 AM).")
-
-
-# --- 3. CORE AI LOGIC ---
-def ask_gemini(user_id, user_text):
-    profile = get_user_profile(user_id)
-    pending_action = profile.get('pending_action')
-    if pending_action == 'set_reminder_message':
-        pending_data = profile.get('pending_data', {})
-        time_str = pending_data.get('time')
-        if time_str:
-            try:
-                notify_dt_naive = datetime.strptime(time_str, "%Y-%m-%d %H:%M:%S")
-                notify_dt_aware = bangkok_tz.localize(notify_dt_naive)
-                create_reminder(user_id, user_text, notify_dt_aware)
-                clear_pending_action(user_id)
-                return f"รับทราบค่ะ ตั้งการแจ้งเตือน '{user_text}' ในเวลา {notify_dt_naive.strftime('%H:%M น.')} ให้แล้วนะคะ 👍"
-            except Exception as e:
-                print(f"ERROR completing pending reminder: {e}")
-                clear_pending_action(user_id)
-                return "ขออภัยค่ะ มีปัญหาในการสร้างการแจ้งเตือน"
-
-    profile_str = ", ".join([f"{k}คือ{v}" for k, v in profile.items() if k not in ['pending_action', 'pending_data']])
-    profile_prompt = f"ข้อมูลเกี่ยวกับผู้ใช้: {profile_str}." if profile_str else ""
-    system_instruction = {"role": "system", "parts": [{"text": f"""คุณคือผู้ช่วย AI ส่วนตัวที่ฉลาด มีอารมณ์ขัน และเป็นมิตร ตอบเป็นภาษาไทย\n{profile_prompt}\n# ความสามารถพิเศษ:\n1.  **จดจำข้อมูล**: หากผู้ใช้บอกข้อมูลส่วนตัว (เช่น ของโปรด, วันเกิดในรูปแบบ DD-MM) ให้ตอบรับและต่อท้ายด้วย `[SAVE_PROFILE:{{"key":"value"}}]`\n2.  **ลืมข้อมูล**: หากผู้ใช้สั่งให้ลืมข้อมูล ให้ตอบรับและต่อท้ายด้วย `[DELETE_PROFILE:{{"key":"ชื่อkey"}}]`\n3.  **ตั้งแจ้งเตือน (สมบูรณ์)**: หากผู้ใช้บอกทั้ง "เวลา" และ "ข้อความ" ให้ตอบรับและต่อท้ายด้วย `[SET_REMINDER:{{"time":"YYYY-MM-DD HH:MM:SS", "message":"ข้อความ"}}]`\n4.  **ตั้งแจ้งเตือน (รอข้อมูล)**: หากผู้ใช้บอก "แค่เวลา" แต่ "ยังไม่บอกข้อความ" ให้ถามกลับว่า "จะให้เตือนเรื่องอะไรดีคะ?" และต่อท้ายด้วย `[SET_PENDING_ACTION:{{"action":"set_reminder_message", "data":{{"time":"YYYY-MM-DD HH:MM:SS"}}}}]`\n5.  **สร้างบุคลิก**: หากผู้ใช้บ่นว่า "เบื่อ" หรือ "เศร้า" ให้เล่าเรื่องตลกสั้นๆ ที่สร้างสรรค์และไม่ซ้ำซาก\nสำคัญ: ห้ามแสดง Markdown ในคำตอบ"""}]}
-    
+# push pool, reminder dispatcher และ scheduler อยู่ใน background.py (ใช้ร่วมกับ worker.py) เริ่มท้ายไฟล์นี้ด้วย run_background_jobs()
+
+
+# --- 3. CORE AI LOGIC (ตรรกะของ turn อยู่ใน turns.py) ---
+def ask_gemini(turn, user_text):
+    """สร้างคำตอบสำหรับหนึ่งรอบสนทนา; การเขียนลงฐานข้อมูลทั้งหมดจะถูกสะสมไว้ใน turn (ยังไม่ commit)
+    คืน None ถ้าสร้างคำตอบไม่ได้ (Gemini ใช้ไม่ได้หรือเกิดข้อผิดพลาด) ซึ่งตอนนั้น turn ยังไม่มีการเขียน"""
     try:
-        history = []
-        context_from_db = get_session(user_id)
-        if context_from_db:
-            try: history.extend(json.loads(context_from_db) if isinstance(context_from_db, str) else context_from_db)
-            except Exception as e: print(f"Session load error: {e}")
-        history.append({"role": "user", "parts": [{"text": user_text}]})
-        
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{MODEL_NAME}:generateContent?key={GEMINI_API_KEY}"
-        data = {"contents": history, "systemInstruction": system_instruction, "generationConfig": {"temperature": 0.85}}
-        response = requests.post(url, headers={"Content-Type": "application/json"}, json=data, timeout=30)
-        response.raise_for_status()
-        result = response.json()
-
-        reply_text = "ขออภัยค่ะ มีปัญหาในการสร้างคำตอบ"
-        if 'candidates' in result and result['candidates']:
-            candidate = result['candidates'][0]
-            if 'content' in candidate and 'parts' in candidate['content'] and candidate['content']['parts']:
-                reply_text = candidate['content']['parts'][0].get('text', reply_text)
-        
-        clean_reply = reply_text
-
-        if '[SAVE_PROFILE:' in reply_text:
-            command_str = reply_text.split('[SAVE_PROFILE:')[1].split(']')[0]
-            try: update_user_profile(user_id, json.loads(command_str)); clean_reply = reply_text.split('[SAVE_PROFILE:')[0].strip()
-            except Exception as e: print(f"ERROR parsing [SAVE_PROFILE]: {e}")
-        elif '[DELETE_PROFILE:' in reply_text:
-            command_str = reply_text.split('[DELETE_PROFILE:')[1].split(']')[0]
-            try: delete_user_profile_key(user_id, json.loads(command_str)['key']); clean_reply = reply_text.split('[DELETE_PROFILE:')[0].strip()
-            except Exception as e: print(f"ERROR parsing [DELETE_PROFILE]: {e}")
-        elif '[SET_REMINDER:' in reply_text:
-            command_str = reply_text.split('[SET_REMINDER:')[1].split(']')[0]
-            try:
-                r_data = json.loads(command_str)
-                n_dt = bangkok_tz.localize(datetime.strptime(r_data["time"], "%Y-%m-%d %H:%M:%S"))
-                create_reminder(user_id, r_data["message"], n_dt)
-                clean_reply = reply_text.split('[SET_REMINDER:')[0].strip()
-            except Exception as e: print(f"ERROR parsing [SET_REMINDER]: {e}")
-        elif '[SET_PENDING_ACTION:' in reply_text:
-            command_str = reply_text.split('[SET_PENDING_ACTION:')[1].split(']')[0]
+        plan = plan_reply(turn, user_text)
+        reply_text = plan.cached_reply
+        if plan.request is not None:
             try:
-                a_data = json.loads(command_str)
-                update_user_profile(user_id, {"pending_action": a_data.get("action"), "pending_data": a_data.get("data")})
-                clean_reply = reply_text.split('[SET_PENDING_ACTION:')[0].strip()
-            except Exception as e: print(f"ERROR parsing [SET_PENDING_ACTION]: {e}")
-
-        history.append({"role": "model", "parts": [{"text": clean_reply}]})
-        save_session(user_id, json.dumps(history[-8:], ensure_ascii=False))
-        return clean_reply + " " + random.choice(emotions)
+                reply_text = gemini.generate_text(*plan.request)
+            except GeminiUnavailable as e:
+                print(f"Gemini unavailable, sending fallback reply: {e}")
+                return None
+        return finish_reply(turn, plan, reply_text)
 
     except Exception as e:
+        ERRORS.inc("ask_gemini")
         print(f"An unexpected error occurred in ask_gemini: {e}\n{traceback.format_exc()}")
-        return "ขอโทษค่ะ ระบบขัดข้อง"
+        return None
 
 # --- 4. WEB ROUTES & HANDLERS (อัปเกรด) ---
-@handler.add(MessageEvent, message=TextMessage)
-def handle_text(event):
+def reply_or_push(event, messages):
+    """ตอบด้วย reply token; ถ้า token หมดอายุแล้ว (event รอคิวนาน) ให้ส่งแบบ push แทน"""
     user_id = event.source.user_id
-    user_text = event.message.text.strip()
+    if time.time() * 1000 - event.timestamp > REPLY_TOKEN_TTL * 1000:
+        call_line_api("push", line_bot_api.push_message, user_id, messages)
+        return
+    try:
+        call_line_api("reply", line_bot_api.reply_message, event.reply_token, messages)
+    except LineBotApiError as e:
+        if e.status_code == 400 and "reply token" in str(e.error.message).lower():
+            call_line_api("push", line_bot_api.push_message, user_id, messages)
+        else:
+            raise
 
-    if user_text.lower() in ["/reset", "ล้างความจำ", "reset", "clear"]:
-        clear_session(user_id)
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="🧠 ความจำระยะสั้น (บทสนทนา) ถูกล้างแล้วค่ะ!")
-        )
+def release_event(event):
+    """คืน claim ของ webhookEventId เมื่อ turn ล้มเหลวก่อน commit ให้ LINE ส่ง event เดิมซ้ำแล้วทำใหม่ได้
+    (turn ที่ commit แล้วไม่คืน แม้ส่งคำตอบไม่สำเร็จ เพื่อไม่ให้ตั้งเตือน/บันทึกซ้ำ)"""
+    event_dedup.release(getattr(event, "webhook_event_id", None))
+
+def run_turn(event, user_text):
+    user_id = event.source.user_id
+    try:
+        turn = load_turn(user_id)
+        # คำสั่งที่ตอบได้แน่นอน (ล้างความจำ, ตั้งเตือน, ลืมข้อมูล ฯลฯ) จัดการในเครื่อง ไม่ต้องเรียก Gemini
+        intent = intent_router.route(turn, user_text)
+    except Exception:
+        release_event(event)
+        raise
+    trace = current_trace()
+    if trace is not None:
+        trace.route = intent.intent if intent else "gemini"
+    reply_text = intent.reply if intent else ask_gemini(turn, user_text)
+    committed = reply_text is not None
+    if committed:
+        try:
+            turn.commit()
+        except Exception as e:
+            ERRORS.inc("turn_commit")
+            print(f"ERROR committing turn for {user_id}: {e}")
+            committed = False
+    if not committed:
+        release_event(event)
+        reply_text = FALLBACK_REPLY
+    if intent is None or intent.log_chat:
+        chat_writer.log(user_id, user_text, reply_text)
+    reply_or_push(event, TextSendMessage(text=reply_text))
+
+def handle_text(event):
+    run_turn(event, event.message.text.strip())
+
+# ผล OCR ที่ถูกส่งกลับเข้าคิวของผู้ใช้เดิม (TurnWorkerPool.resume) เพื่อทำ turn ต่อตามลำดับข้อความ
+OcrResult = namedtuple("OcrResult", "event text started")
+
+def handle_image(event):
+    """ดาวน์โหลดรูปที่ผู้ใช้ส่งมา (เช่น ใบนัด) แล้วส่งเข้า OCR โดยไม่รอผล worker thread จึงไปทำ turn อื่นได้ระหว่าง OCR
+    ข้อความที่อ่านได้กลับเข้าคิวของผู้ใช้เดิมเป็น OcrResult แล้วทำต่อใน finish_image"""
+    started = time.perf_counter()
+    key = _event_key(event)
+    try:
+        content = call_line_api("content", line_bot_api.get_message_content, event.message.id)
+        data = read_stream(content.iter_content(chunk_size=64 * 1024))
+    except Exception as e:
+        ERRORS.inc("image_download")
+        print(f"ERROR reading image {event.message.id}: {e}")
+        release_event(event)
+        reply_or_push(event, TextSendMessage(text=OCR_EMPTY_REPLY))
         return
-    
-    # --- เพิ่ม: คำสั่งลบข้อมูลถาวรทั้งหมด ---
-    elif user_text.lower() in ["/forgetme", "/ลบข้อมูลทั้งหมด", "/ลบข้อมูลถาวร"]:
-        delete_user_profile(user_id)
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="🗑️ ข้อมูลถาวรทั้งหมดของคุณ (ชื่อเล่น, ของโปรด, ฯลฯ) ถูกลบเรียบร้อยแล้วค่ะ")
-        )
+    try:
+        ocr_pool.submit(data, lambda text: turn_workers.resume(key, OcrResult(event, text, started)))
+    except OcrBusy as e:
+        ERRORS.inc("ocr_busy")
+        print(f"OCR queue full: {e}")
+        release_event(event)
+        reply_or_push(event, TextSendMessage(text=OCR_BUSY_REPLY))
+
+def finish_image(result):
+    record_stage("ocr", time.perf_counter() - result.started)
+    if not result.text:
+        reply_or_push(result.event, TextSendMessage(text=OCR_EMPTY_REPLY))
+        return
+    run_turn(result.event, image_prompt(result.text))
+
+def dispatch_event(event):
+    if isinstance(event, OcrResult):
+        with trace_turn(_event_key(event.event), "image_ocr"):
+            finish_image(event)
+        return
+    # event ที่ LINE ส่งซ้ำ (เช่น หลัง timeout) ถูกทิ้งก่อนเริ่มทำงานใดๆ
+    # claim ก่อนเริ่ม turn แล้วคืนเมื่อ turn ล้มเหลวก่อน commit (release_event) ครั้งที่ส่งซ้ำจึงได้ทำใหม่
+    if not event_dedup.claim(getattr(event, "webhook_event_id", None)):
+        print(f"Skipping duplicate webhook event {event.webhook_event_id}")
         return
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        with trace_turn(_event_key(event), "text"):
+            handle_text(event)
+    elif isinstance(event, MessageEvent) and isinstance(event.message, ImageMessage):
+        with trace_turn(_event_key(event), "image"):
+            handle_image(event)
+
+def _event_key(event):
+    source = event.source
+    return getattr(source, "user_id", None) or getattr(source, "group_id", None) or getattr(source, "room_id", None)
+
+ocr_pool = OcrPool()
+atexit.register(ocr_pool.shutdown)
+
+# ลงทะเบียน atexit ก่อน turn_workers เพื่อให้ flush หลังจาก worker ประมวลผลคิวที่เหลือเสร็จแล้ว
+chat_writer = ChatLogWriter(
+    batch_size=int(os.getenv("CHATLOG_BATCH_SIZE", "200")),
+    flush_interval=float(os.getenv("CHATLOG_FLUSH_INTERVAL", "1.0")),
+    max_queue=int(os.getenv("CHATLOG_QUEUE_SIZE", "10000")),
+)
+chat_writer.start()
+atexit.register(chat_writer.stop)
+
+turn_workers = TurnWorkerPool(dispatch_event, num_workers=WEBHOOK_WORKERS, max_queue=WEBHOOK_QUEUE_SIZE)
+turn_workers.start()
+atexit.register(turn_workers.stop)
 
-    reply_text = ask_gemini(user_id, user_text)
-    save_chat(user_id, user_text, reply_text)
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+leader_election = run_background_jobs(RUN_SCHEDULER)
+
+# gauge อ่านค่าตอน scrape /metrics
+GaugeFunc("smartbot_db_pool_connections", "Pooled database connections by state.",
+          lambda: {state: get_pool_stats().get(state, 0) for state in ("in_use", "idle")}, ["state"])
+GaugeFunc("smartbot_queue_depth", "Items waiting in in-process queues.",
+          lambda: {"webhook": turn_workers.depth(), "chat_log": chat_writer.stats()["depth"], "ocr": ocr_pool.pending}, ["queue"])
+GaugeFunc("smartbot_gemini_in_flight", "Gemini requests currently in flight.", lambda: gemini.stats()["in_flight"])
+start_metrics_export()
 
 @app.route("/callback", methods=["POST"])
 def callback():
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
     try:
-        handler.handle(body, signature)
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        ERRORS.inc("webhook_signature")
+        return "Invalid signature", 400
     except Exception as e:
-        app.logger.error(f"Error handling webhook: {e}")
+        ERRORS.inc("webhook_parse")
+        app.logger.error(f"Error parsing webhook: {e}")
         return "Bad Request", 400
+    try:
+        turn_workers.submit_batch([(_event_key(event), event) for event in events])
+    except QueueFull as e:
+        ERRORS.inc("webhook_queue_full")
+        app.logger.error(f"Webhook queue full, asking LINE to redeliver: {e}")
+        return "Busy", 503
     return "OK"
 
 @app.route("/")
 def dashboard():
-    chat_logs = get_chat_history(limit=200) 
-    profiles = get_all_user_profiles()
-    pending_reminders = get_pending_reminders_for_dashboard()
+    counts = get_dashboard_counts()
     html = """
 <!DOCTYPE html>
 <html lang="th">
 <head>
-    <meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><meta http-equiv="refresh" content="300">
+    <meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>🧠 SmartBot Dashboard</title>
     <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css" rel="stylesheet">
     <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.5.1/css/all.min.css"/>
@@ -230,44 +268,133 @@ def dashboard():
     <main class="container-fluid py-4">
         <header class="d-flex align-items-center mb-4"><h1 class="h2 text-dark me-3">SmartBot Dashboard</h1><span class="badge bg-primary-subtle text-primary-emphasis rounded-pill">Real-time</span></header>
         <div class="row g-4 mb-4">
-            <div class="col-lg-4 col-md-6"><div class="stat-card"><div class="card-body p-4"><div><div class="stat-number">{{ profiles|length }}</div><div class="stat-label">Active Profiles</div></div><i class="fas fa-users"></i></div></div></div>
-            <div class="col-lg-4 col-md-6"><div class="stat-card"><div class="card-body p-4"><div><div class="stat-number">{{ pending_reminders|length }}</div><div class="stat-label">Pending Reminders</div></div><i class="fas fa-bell"></i></div></div></div>
-            <div class="col-lg-4 col-md-12"><div class="stat-card"><div class="card-body p-4"><div><div class="stat-number">{{ chat_logs|length }}</div><div class="stat-label">Recent Messages</div></div><i class="fas fa-comments"></i></div></div></div>
+            <div class="col-lg-3 col-md-6"><div class="stat-card"><div class="card-body p-4"><div><div class="stat-number" id="stat-profiles">{{ counts.profiles }}</div><div class="stat-label">Active Profiles</div></div><i class="fas fa-users"></i></div></div></div>
+            <div class="col-lg-3 col-md-6"><div class="stat-card"><div class="card-body p-4"><div><div class="stat-number" id="stat-reminders">{{ counts.reminders }}</div><div class="stat-label">Pending Reminders</div></div><i class="fas fa-bell"></i></div></div></div>
+            <div class="col-lg-3 col-md-6"><div class="stat-card"><div class="card-body p-4"><div><div class="stat-number" id="stat-messages">{{ counts.messages_24h }}</div><div class="stat-label">Messages (24h)</div></div><i class="fas fa-comments"></i></div></div></div>
+            <div class="col-lg-3 col-md-6"><div class="stat-card"><div class="card-body p-4"><div><div class="stat-number" id="stat-active-users">{{ counts.active_users_24h }}</div><div class="stat-label">Active Users (24h)</div></div><i class="fas fa-user-clock"></i></div></div></div>
         </div>
         <div class="row g-4">
-            <div class="col-lg-6"><div class="card main-card"><div class="card-header bg-white">🧠 ความจำถาวร (User Profiles)</div><div class="card-body"><table id="profilesTable" class="table table-hover" style="width:100%"><thead><tr><th>User ID</th><th>ข้อมูล</th><th>อัปเดตล่าสุด</th></tr></thead><tbody>
-            {% for p in profiles %}<tr><td><small>{{ p[0][:15] }}...</small></td><td><pre class="mb-0"><small>{{ p[1]|tojson(indent=2) }}</small></pre></td><td><small>{{ p[2].astimezone(bangkok_tz).strftime('%Y-%m-%d %H:%M') }}</small></td></tr>{% endfor %}
-            </tbody></table></div></div></div>
-            <div class="col-lg-6"><div class="card main-card"><div class="card-header bg-white">⏰ รายการแจ้งเตือนที่รอส่ง</div><div class="card-body"><table id="remindersTable" class="table table-hover" style="width:100%"><thead><tr><th>User ID</th><th>ข้อความ</th><th>เวลาแจ้งเตือน</th></tr></thead><tbody>
-            {% for r in reminders %}<tr><td><small>{{ r[0][:15] }}...</small></td><td>{{ r[1] }}</td><td><small>{{ r[2].astimezone(bangkok_tz).strftime('%Y-%m-%d %H:%M') }}</small></td></tr>{% endfor %}
-            </tbody></table></div></div></div>
+            <div class="col-lg-6"><div class="card main-card"><div class="card-header bg-white">🧠 ความจำถาวร (User Profiles)</div><div class="card-body"><table id="profilesTable" class="table table-hover" style="width:100%"><thead><tr><th>User ID</th><th>ข้อมูล</th><th>อัปเดตล่าสุด</th></tr></thead><tbody></tbody></table></div></div></div>
+            <div class="col-lg-6"><div class="card main-card"><div class="card-header bg-white">⏰ รายการแจ้งเตือนที่รอส่ง</div><div class="card-body"><table id="remindersTable" class="table table-hover" style="width:100%"><thead><tr><th>User ID</th><th>ข้อความ</th><th>เวลาแจ้งเตือน</th></tr></thead><tbody></tbody></table></div></div></div>
         </div>
-        <div class="row mt-4"><div class="col-12"><div class="card main-card"><div class="card-header bg-white">💬 ความจำระยะสั้น (ประวัติแชทล่าสุด)</div><div class="card-body"><table id="chatHistoryTable" class="table table-hover" style="width:100%"><thead><tr><th>เวลา</th><th>User ID</th><th>ข้อความ</th><th>ตอบกลับ</th></tr></thead><tbody>
-            {% for log in chat_logs %}<tr><td><small>{{ log[4].astimezone(bangkok_tz).strftime('%Y-%m-%d %H:%M') }}</small></td><td><small>{{ log[1][:15] }}...</small></td><td>{{ log[2] }}</td><td>{{ log[3] }}</td></tr>{% endfor %}
-            </tbody></table></div></div></div></div>
+        <div class="row mt-4"><div class="col-12"><div class="card main-card"><div class="card-header bg-white">💬 ความจำระยะสั้น (ประวัติแชทล่าสุด)</div><div class="card-body"><table id="chatHistoryTable" class="table table-hover" style="width:100%"><thead><tr><th>เวลา</th><th>User ID</th><th>ข้อความ</th><th>ตอบกลับ</th></tr></thead><tbody></tbody></table></div></div></div></div>
     </main>
     <script src="https://code.jquery.com/jquery-3.7.1.min.js"></script>
     <script src="https://cdn.datatables.net/2.0.8/js/dataTables.min.js"></script>
     <script src="https://cdn.datatables.net/2.0.8/js/dataTables.bootstrap5.min.js"></script>
     <script>
+        // server-side processing: ถ้าผู้ใช้กด "หน้าถัดไป" ต่อจากหน้าเดิม (order/search เดิม) จะส่ง cursor ไปด้วยเพื่อใช้ keyset pagination
+        function serverTable(selector, name, order) {
+            let last = null;
+            return $(selector).DataTable({
+                responsive: true, serverSide: true, processing: true, searchDelay: 400, order: order,
+                language: { url: '//cdn.datatables.net/plug-ins/2.0.8/i18n/th.json', },
+                ajax: {
+                    url: '/api/dashboard/' + name,
+                    data: function(d) {
+                        const state = JSON.stringify([d.order, d.search.value, d.length]);
+                        if (last && last.state === state && last.end === d.start && last.cursor) { d.after = last.cursor; }
+                        last = { state: state, end: d.start + d.length, cursor: null };
+                    },
+                    dataSrc: function(json) { if (last) { last.cursor = json.cursor; } return json.data; }
+                }
+            });
+        }
         $(document).ready(function() {
-            const options = { responsive: true, language: { url: '//cdn.datatables.net/plug-ins/2.0.8/i18n/th.json', }, order: [[0, 'desc']] };
-            $('#chatHistoryTable').DataTable(options);
-            const otherOptions = { ...options, order: [] };
-            $('#profilesTable').DataTable(otherOptions);
-            $('#remindersTable').DataTable(otherOptions);
+            const tables = [
+                serverTable('#chatHistoryTable', 'chats', [[0, 'desc']]),
+                serverTable('#profilesTable', 'profiles', [[2, 'desc']]),
+                serverTable('#remindersTable', 'reminders', [[2, 'asc']]),
+            ];
+            setInterval(function() {
+                $.getJSON('/api/dashboard/stats', function(c) {
+                    $('#stat-profiles').text(c.profiles); $('#stat-reminders').text(c.reminders); $('#stat-messages').text(c.messages_24h); $('#stat-active-users').text(c.active_users_24h);
+                });
+                tables.forEach(function(t) { t.ajax.reload(null, false); });
+            }, 300000);
         });
     </script>
 </body>
 </html>
 """
-    return render_template_string(html,
-                                  chat_logs=chat_logs,
-                                  profiles=profiles,
-                                  reminders=pending_reminders,
-                                  bangkok_tz=bangkok_tz)
+    return render_template_string(html, counts=counts)
+
+def _fmt_time(value):
+    return f"<small>{value.astimezone(bangkok_tz).strftime('%Y-%m-%d %H:%M')}</small>" if value else ""
+
+def _fmt_user(user_id):
+    return f"<small>{escape((user_id or '')[:15])}...</small>"
+
+# แปลงแถวจากฐานข้อมูลเป็น HTML ของแต่ละเซลล์ (ต้อง escape เองเพราะ DataTables แสดงผลเป็น HTML)
+DASHBOARD_FORMATTERS = {
+    "profiles": lambda r: [_fmt_user(r[0]), f"<pre class=\"mb-0\"><small>{escape(json.dumps(r[1], ensure_ascii=False, indent=2))}</small></pre>", _fmt_time(r[2])],
+    "reminders": lambda r: [_fmt_user(r[0]), str(escape(r[1])), _fmt_time(r[2])],
+    "chats": lambda r: [_fmt_time(r[0]), _fmt_user(r[1]), str(escape(r[2] or "")), str(escape(r[3] or ""))],
+}
+
+@app.route("/api/dashboard/stats")
+def dashboard_stats():
+    return jsonify(get_dashboard_counts())
+
+@app.route("/api/dashboard/<name>")
+def dashboard_table(name):
+    """endpoint สำหรับ DataTables แบบ server-side processing"""
+    if name not in DASHBOARD_TABLES:
+        return jsonify({"error": "unknown table"}), 404
+    args = request.args
+    after = None
+    if args.get("after"):
+        try: after = json.loads(args["after"])
+        except ValueError: return jsonify({"error": "invalid cursor"}), 400
+        # cursor คือ [ค่าของคอลัมน์ที่เรียง, key] ของแถวสุดท้ายที่เราส่งไป: ต้องเป็น scalar สองค่าเท่านั้น
+        if not (isinstance(after, list) and len(after) == 2
+                and all(isinstance(v, (str, int, float)) and not isinstance(v, bool) for v in after)):
+            return jsonify({"error": "invalid cursor"}), 400
+    try:
+        rows, filtered, cursor = query_dashboard_table(
+            name,
+            start=args.get("start", 0, type=int),
+            length=args.get("length", 25, type=int),
+            search=args.get("search[value]", "").strip(),
+            order_column=args.get("order[0][column]", type=int),
+            order_dir=args.get("order[0][dir]"),
+            after=after,
+        )
+    except psycopg2.DataError:
+        # ค่าใน cursor แปลงเป็นชนิดของคอลัมน์ไม่ได้ (เช่นเวลาที่ไม่ใช่ ISO หรือ id ที่ไม่ใช่ตัวเลข)
+        if after is None:
+            raise
+        return jsonify({"error": "invalid cursor"}), 400
+    total = get_dashboard_counts()[name]
+    return jsonify({
+        "draw": args.get("draw", 0, type=int),
+        "recordsTotal": total,
+        "recordsFiltered": total if filtered is None else filtered,
+        "data": [DASHBOARD_FORMATTERS[name](row) for row in rows],
+        "cursor": json.dumps(cursor, default=lambda v: v.isoformat()) if cursor else None,
+    })
 
 @app.route("/ping")
 def ping():
     return "OK"
 
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/stats")
+def stats():
+    return jsonify({"db_pool": get_pool_stats(), "webhook_queue": turn_workers.stats(), "gemini": gemini.stats(),
+                    "reminders": reminder_dispatcher.stats(), "line_push": push_pool.stats(), "reminder_push": reminder_push_pool.stats(),
+                    "daily_job": last_daily_run,
+                    "scheduler": {"mode": RUN_SCHEDULER, "pid": os.getpid(), "running": "scheduler" in background_jobs,
+                                  **(leader_election.stats() if leader_election else {})},
+                    "chat_log": chat_writer.stats(),
+                    "prompt": {**prompt_stats.snapshot(), "system_instruction_cache": prompt_cache.stats()},
+                    "intents": intent_router.stats(), "response_cache": response_cache.stats(),
+                    "webhook_dedup": event_dedup.stats(), "ocr": ocr_pool.stats()})
+
+if __name__ == "__main__":
+    # สำหรับรันเครื่องเดียว/ทดสอบ; production ใช้ gunicorn (ดู gunicorn.conf.py)
+    # OCR worker (forkserver / spawn) import __main__ ซ้ำ: ถ้าจะส่งรูปทดสอบให้รันด้วย flask --app app run แทน python app.py
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "5000")))
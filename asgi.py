@@ -0,0 +1,434 @@
+# asgi.py
+
+import asyncio
+import json
+import os
+import time
+import traceback
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import aiohttp
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from dotenv import load_dotenv
+from linebot import AsyncLineBotApi, WebhookParser
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.models import MessageEvent, TextMessage, ImageMessage, TextSendMessage
+
+import async_db
+from chatlog import AsyncChatLogWriter
+from gemini_client import AsyncGeminiClient, GeminiUnavailable
+from idempotency import AsyncEventDeduplicator
+from leader import LeaderElection
+from messaging import AsyncPushPool, call_line_api_async
+from migrations import migrate
+from partitions import run_chat_maintenance
+from ocr import OcrPool, OcrBusy, read_stream_async
+from reminders import AsyncReminderDispatcher
+from turns import (bangkok_tz, MODEL_NAME, REPLY_TOKEN_TTL, FALLBACK_REPLY, OCR_BUSY_REPLY, OCR_EMPTY_REPLY,
+                   BIRTHDAY_MESSAGE, prompt_cache, prompt_stats, response_cache, intent_router,
+                   plan_reply, finish_reply, image_prompt, build_reminder_message, build_daily_summary)
+from metrics import (ERRORS, GaugeFunc, current_trace, record_stage, render_metrics,
+                     start_metrics_export, timed_job, trace_turn)
+
+# =====================================
+# โหมด asyncio: ASGI app ที่ให้ process เดียวรับ turn ที่ค้างพร้อมกันได้หลายร้อย turn
+# =====================================
+# webhook, Gemini (aiohttp), LINE (AsyncLineBotApi), Postgres (asyncpg) และงานเบื้องหลัง
+# (reminder dispatcher + APScheduler) รันบน event loop เดียวกัน; ตรรกะของ turn ใช้ร่วมกับ app.py ผ่าน turns.py
+# รัน: uvicorn asgi:app --host 0.0.0.0 --port $PORT
+#   หรือ gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app (migration รันใน master)
+# dashboard ("/" และ /api/dashboard/*) ยังอยู่ในโหมด Flask (wsgi:app)
+
+load_dotenv()
+LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
+LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+if not all([LINE_CHANNEL_ACCESS_TOKEN, LINE_CHANNEL_SECRET, GEMINI_API_KEY]):
+    raise ValueError("Missing required environment variables.")
+
+LINE_API_ENDPOINT = os.getenv("LINE_API_ENDPOINT", AsyncLineBotApi.DEFAULT_API_ENDPOINT)
+ASYNC_MAX_TURNS = int(os.getenv("ASYNC_MAX_TURNS", "500"))  # turn ที่ค้างพร้อมกันได้สูงสุด เกินนี้ตอบ 503 ให้ LINE ส่งซ้ำ
+RUN_SCHEDULER = os.getenv("RUN_SCHEDULER", "auto").lower()
+SHUTDOWN_GRACE_SECONDS = float(os.getenv("SHUTDOWN_GRACE_SECONDS", "20"))
+
+parser = WebhookParser(LINE_CHANNEL_SECRET)
+gemini = AsyncGeminiClient(
+    GEMINI_API_KEY, MODEL_NAME,
+    max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", "64")),
+    rate_per_sec=float(os.getenv("GEMINI_RATE_PER_SEC", "5")),
+    burst=int(os.getenv("GEMINI_BURST", "10")),
+    max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "3")),
+    breaker_threshold=int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5")),
+    breaker_reset=float(os.getenv("GEMINI_BREAKER_RESET", "30")),
+)
+chat_writer = AsyncChatLogWriter(
+    async_db.insert_chat_rows,
+    is_transient=async_db.is_connection_error,
+    batch_size=int(os.getenv("CHATLOG_BATCH_SIZE", "200")),
+    flush_interval=float(os.getenv("CHATLOG_FLUSH_INTERVAL", "1.0")),
+    max_queue=int(os.getenv("CHATLOG_QUEUE_SIZE", "10000")),
+)
+event_dedup = AsyncEventDeduplicator(async_db.claim_webhook_event, async_db.release_webhook_event, async_db.delete_processed_events_before)
+ocr_pool = OcrPool()
+
+# สร้างตอน startup (ต้องมี event loop): line_bot_api, push_pool, reminder_push_pool, reminder_dispatcher
+runtime = {}
+background_jobs = {}
+last_daily_run = {}
+leader_election = None
+
+# --- งานเบื้องหลัง (บน event loop เดียวกับ webhook) ---
+@timed_job("daily_proactive")
+async def run_daily_proactive_tasks():
+    """เหมือน background.run_daily_proactive_tasks: สรุปรายวันผ่าน push แบบขนาน, คำอวยพรวันเกิดผ่าน multicast"""
+    push_pool = runtime["push_pool"]
+    started = time.monotonic()
+    now = datetime.now(bangkok_tz)
+    print(f"[{now.strftime('%Y-%m-%d %H:%M')}] Running ALL Daily Proactive Jobs...")
+    summaries = await async_db.get_daily_reminder_summaries(bangkok_tz)
+    results = await push_pool.push_many((user_id, build_daily_summary(reminders_today)) for user_id, reminders_today in summaries)
+    summary_failed = 0
+    for user_id, error in results:
+        if error is not None:
+            summary_failed += 1
+            print(f"ERROR sending daily summary to {user_id}: {error}")
+    birthday_users = await async_db.get_birthday_users(now.strftime('%d-%m'))
+    birthday_sent, birthday_failed = await push_pool.multicast(birthday_users, TextSendMessage(text=BIRTHDAY_MESSAGE))
+
+    last_daily_run.clear()
+    last_daily_run.update({
+        "started_at": now.isoformat(),
+        "duration_seconds": round(time.monotonic() - started, 3),
+        "summaries_sent": len(results) - summary_failed, "summaries_failed": summary_failed,
+        "birthdays_sent": birthday_sent, "birthdays_failed": birthday_failed,
+    })
+    print(f"Daily proactive jobs finished: {last_daily_run}")
+    return last_daily_run
+
+@timed_job("chat_partitions")
+async def run_chat_partition_maintenance():
+    # ใช้ psycopg2 + server-side cursor (ไฟล์ archive เขียนแบบ stream) จึงรันใน thread ของ executor
+    return await asyncio.get_running_loop().run_in_executor(None, run_chat_maintenance)
+
+async def start_background_jobs():
+    runtime["reminder_dispatcher"].start()
+    scheduler = AsyncIOScheduler(timezone=bangkok_tz, event_loop=asyncio.get_running_loop())
+    scheduler.add_job(run_daily_proactive_tasks, 'cron', hour=8, minute=0, id='daily_proactive_job')
+    scheduler.add_job(timed_job("processed_events_cleanup")(event_dedup.cleanup), 'interval', hours=1, id='processed_events_cleanup')
+    scheduler.add_job(timed_job("reminder_cleanup")(async_db.cleanup_finished_reminders), 'interval', hours=1, id='reminder_cleanup')
+    scheduler.add_job(run_chat_partition_maintenance, 'cron', hour=3, minute=30, id='chat_partition_maintenance',
+                      next_run_time=datetime.now(bangkok_tz))
+    scheduler.start()
+    background_jobs["scheduler"] = scheduler
+    print("Scheduler started on the event loop: Reminder dispatcher (event-driven), Proactive Daily Jobs (8 AM) and chat partition maintenance (3:30 AM).")
+
+async def stop_background_jobs():
+    scheduler = background_jobs.pop("scheduler", None)
+    if scheduler is not None:
+        scheduler.shutdown(wait=False)
+    await runtime["reminder_dispatcher"].stop()
+
+def _on_loop(loop, coro_func, timeout=30.0):
+    """callback ของ LeaderElection (รันใน thread ของมันเอง) -> รัน coroutine บน event loop แล้วรอผล"""
+    def callback():
+        asyncio.run_coroutine_threadsafe(coro_func(), loop).result(timeout)
+    return callback
+
+# --- ตรรกะของ turn ---
+async def ask_gemini(turn, user_text):
+    """เหมือน app.ask_gemini (คืน None ถ้าสร้างคำตอบไม่ได้) แต่รอ Gemini แบบไม่บล็อก event loop"""
+    try:
+        plan = plan_reply(turn, user_text)
+        reply_text = plan.cached_reply
+        if plan.request is not None:
+            try:
+                reply_text = await gemini.generate_text(*plan.request)
+            except GeminiUnavailable as e:
+                print(f"Gemini unavailable, sending fallback reply: {e}")
+                return None
+        return finish_reply(turn, plan, reply_text)
+
+    except Exception as e:
+        ERRORS.inc("ask_gemini")
+        print(f"An unexpected error occurred in ask_gemini: {e}\n{traceback.format_exc()}")
+        return None
+
+async def reply_or_push(event, messages):
+    line_bot_api = runtime["line_bot_api"]
+    user_id = event.source.user_id
+    if time.time() * 1000 - event.timestamp > REPLY_TOKEN_TTL * 1000:
+        await call_line_api_async("push", line_bot_api.push_message, user_id, messages)
+        return
+    try:
+        await call_line_api_async("reply", line_bot_api.reply_message, event.reply_token, messages)
+    except LineBotApiError as e:
+        if e.status_code == 400 and "reply token" in str(e.error.message).lower():
+            await call_line_api_async("push", line_bot_api.push_message, user_id, messages)
+        else:
+            raise
+
+async def release_event(event):
+    """เหมือน app.release_event: คืน claim ของ turn ที่ล้มเหลวก่อน commit ให้ LINE ส่งซ้ำแล้วทำใหม่ได้"""
+    await event_dedup.release(getattr(event, "webhook_event_id", None))
+
+async def run_turn(event, user_text):
+    user_id = event.source.user_id
+    try:
+        turn = await async_db.load_turn(user_id)
+        intent = intent_router.route(turn, user_text)
+    except Exception:
+        await release_event(event)
+        raise
+    trace = current_trace()
+    if trace is not None:
+        trace.route = intent.intent if intent else "gemini"
+    reply_text = intent.reply if intent else await ask_gemini(turn, user_text)
+    committed = reply_text is not None
+    if committed:
+        try:
+            await async_db.commit_turn(turn)
+        except Exception as e:
+            ERRORS.inc("turn_commit")
+            print(f"ERROR committing turn for {user_id}: {e}")
+            committed = False
+    if not committed:
+        await release_event(event)
+        reply_text = FALLBACK_REPLY
+    if intent is None or intent.log_chat:
+        chat_writer.log(user_id, user_text, reply_text)
+    await reply_or_push(event, TextSendMessage(text=reply_text))
+
+async def ocr_text(data):
+    """รอผลจาก OcrPool.submit บน event loop (callback ถูกเรียกจาก thread ของ executor / timer) โดยไม่กิน thread ใดระหว่างรอ"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(text):
+        if not future.done():
+            future.set_result(text)
+    ocr_pool.submit(data, lambda text: loop.call_soon_threadsafe(resolve, text))
+    return await future
+
+async def handle_image(event):
+    started = time.perf_counter()
+    try:
+        content = await call_line_api_async("content", runtime["line_bot_api"].get_message_content, event.message.id)
+        data = await read_stream_async(content.iter_content(chunk_size=64 * 1024))
+        text = await ocr_text(data)
+    except OcrBusy as e:
+        ERRORS.inc("ocr_busy")
+        print(f"OCR queue full: {e}")
+        await release_event(event)
+        await reply_or_push(event, TextSendMessage(text=OCR_BUSY_REPLY))
+        return
+    except Exception as e:
+        ERRORS.inc("image_download")
+        print(f"ERROR reading image {event.message.id}: {e}")
+        await release_event(event)
+        text = ""
+    record_stage("ocr", time.perf_counter() - started)
+    if not text:
+        await reply_or_push(event, TextSendMessage(text=OCR_EMPTY_REPLY))
+        return
+    await run_turn(event, image_prompt(text))
+
+def _event_key(event):
+    source = event.source
+    return getattr(source, "user_id", None) or getattr(source, "group_id", None) or getattr(source, "room_id", None)
+
+# event ของผู้ใช้คนเดียวกันต้องทำตามลำดับ (เหมือน TurnWorkerPool) ส่วนต่างผู้ใช้ทำพร้อมกันได้
+_key_locks = {}  # key -> [asyncio.Lock, จำนวน task ที่ใช้อยู่]
+in_flight = set()
+turn_counts = {"accepted": 0, "rejected": 0, "completed": 0, "failed": 0, "max_in_flight": 0}
+
+@asynccontextmanager
+async def _ordered(key):
+    entry = _key_locks.get(key)
+    if entry is None:
+        entry = _key_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _key_locks[key]
+
+async def dispatch_event(event):
+    key = _event_key(event)
+    try:
+        async with _ordered(key):
+            if not await event_dedup.claim(getattr(event, "webhook_event_id", None)):
+                print(f"Skipping duplicate webhook event {event.webhook_event_id}")
+                return
+            if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+                with trace_turn(key, "text"):
+                    await run_turn(event, event.message.text.strip())
+            elif isinstance(event, MessageEvent) and isinstance(event.message, ImageMessage):
+                with trace_turn(key, "image"):
+                    await handle_image(event)
+        turn_counts["completed"] += 1
+    except Exception as e:
+        turn_counts["failed"] += 1
+        ERRORS.inc("webhook_turn")
+        print(f"ERROR handling webhook event: {e}\n{traceback.format_exc()}")
+
+def submit_events(events):
+    """สร้าง task ต่อ event; คืน False ถ้าจะเกิน ASYNC_MAX_TURNS (ไม่รับ event ชุดนี้เลย ให้ LINE ส่งซ้ำทั้งชุด)"""
+    if len(in_flight) + len(events) > ASYNC_MAX_TURNS:
+        turn_counts["rejected"] += len(events)
+        return False
+    loop = asyncio.get_running_loop()
+    for event in events:
+        task = loop.create_task(dispatch_event(event))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    turn_counts["accepted"] += len(events)
+    turn_counts["max_in_flight"] = max(turn_counts["max_in_flight"], len(in_flight))
+    return True
+
+# --- lifespan ---
+async def startup():
+    global leader_election
+    loop = asyncio.get_running_loop()
+    # ภายใต้ gunicorn migration รันแล้วใน master (gunicorn.conf.py)
+    if os.getenv("SKIP_MIGRATIONS") != "1":
+        print("Initializing database...")
+        await loop.run_in_executor(None, migrate)
+    await async_db.open_pool()
+    await gemini.start()
+    connect, read = gemini.timeout
+    line_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=int(os.getenv("LINE_MAX_CONNECTIONS", "32"))))
+    line_bot_api = AsyncLineBotApi(LINE_CHANNEL_ACCESS_TOKEN,
+                                   AiohttpAsyncHttpClient(line_session, timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)),
+                                   endpoint=LINE_API_ENDPOINT)
+    push_pool = AsyncPushPool(line_bot_api, max_concurrency=int(os.getenv("LINE_PUSH_WORKERS", "8")),
+                              rate_per_sec=float(os.getenv("LINE_PUSH_RATE_PER_SEC", "20")))
+    # การแจ้งเตือนใช้ pool แยก (เหมือน background.reminder_push_pool) จึงไม่ต้องรอ slot / token ต่อจากงานประจำวัน
+    reminder_push_pool = AsyncPushPool(line_bot_api,
+                                       max_concurrency=int(os.getenv("REMINDER_PUSH_WORKERS", os.getenv("LINE_PUSH_WORKERS", "8"))),
+                                       rate_per_sec=float(os.getenv("REMINDER_PUSH_RATE_PER_SEC", os.getenv("LINE_PUSH_RATE_PER_SEC", "20"))))
+    runtime.update(line_session=line_session, line_bot_api=line_bot_api, push_pool=push_pool, reminder_push_pool=reminder_push_pool,
+                   reminder_dispatcher=AsyncReminderDispatcher(async_db, reminder_push_pool, build_reminder_message))
+    chat_writer.start()
+    start_metrics_export()
+    if RUN_SCHEDULER == "always":
+        await start_background_jobs()
+    elif RUN_SCHEDULER == "auto":
+        leader_election = LeaderElection(_on_loop(loop, start_background_jobs), _on_loop(loop, stop_background_jobs),
+                                         interval=float(os.getenv("LEADER_ELECTION_INTERVAL", "10")))
+        leader_election.start()
+    else:
+        print(f"Background jobs disabled in this process (RUN_SCHEDULER={RUN_SCHEDULER}).")
+
+async def shutdown():
+    if in_flight:
+        await asyncio.wait(set(in_flight), timeout=SHUTDOWN_GRACE_SECONDS)
+    if leader_election is not None:
+        # stop() เรียก on_demoted ซึ่งรอ event loop จึงต้องรันใน thread อื่น
+        await asyncio.get_running_loop().run_in_executor(None, leader_election.stop)
+    elif "scheduler" in background_jobs:
+        await stop_background_jobs()
+    await chat_writer.stop()
+    await gemini.close()
+    if "line_session" in runtime:
+        await runtime["line_session"].close()
+    await async_db.close_pool()
+    ocr_pool.shutdown()
+
+GaugeFunc("smartbot_db_pool_connections", "Pooled database connections by state.",
+          lambda: {state: async_db.get_pool_stats().get(state, 0) for state in ("in_use", "idle")}, ["state"])
+GaugeFunc("smartbot_queue_depth", "Items waiting in in-process queues.",
+          lambda: {"webhook": len(in_flight), "chat_log": chat_writer.stats()["depth"], "ocr": ocr_pool.pending}, ["queue"])
+GaugeFunc("smartbot_gemini_in_flight", "Gemini requests currently in flight.", lambda: gemini.stats()["in_flight"])
+GaugeFunc("smartbot_scheduler_leader", "1 if this process runs the background jobs.", lambda: int("scheduler" in background_jobs))
+
+# --- routes ---
+async def callback(headers, body):
+    signature = headers.get("x-line-signature", "")
+    try:
+        events = parser.parse(body.decode("utf-8"), signature)
+    except InvalidSignatureError:
+        ERRORS.inc("webhook_signature")
+        return 400, "text/plain", "Invalid signature"
+    except Exception as e:
+        ERRORS.inc("webhook_parse")
+        print(f"Error parsing webhook: {e}")
+        return 400, "text/plain", "Bad Request"
+    if not submit_events(events):
+        ERRORS.inc("webhook_queue_full")
+        print(f"Too many turns in flight ({len(in_flight)}), asking LINE to redeliver")
+        return 503, "text/plain", "Busy"
+    return 200, "text/plain", "OK"
+
+def stats():
+    reminder_dispatcher = runtime.get("reminder_dispatcher")
+    return {"db_pool": async_db.get_pool_stats(),
+            "webhook_turns": {**turn_counts, "in_flight": len(in_flight), "max": ASYNC_MAX_TURNS, "ordered_keys": len(_key_locks)},
+            "gemini": gemini.stats(),
+            "reminders": reminder_dispatcher.stats() if reminder_dispatcher else {},
+            "line_push": runtime["push_pool"].stats() if "push_pool" in runtime else {},
+            "reminder_push": runtime["reminder_push_pool"].stats() if "reminder_push_pool" in runtime else {},
+            "daily_job": last_daily_run,
+            "scheduler": {"mode": RUN_SCHEDULER, "pid": os.getpid(), "running": "scheduler" in background_jobs,
+                          **(leader_election.stats() if leader_election else {})},
+            "chat_log": chat_writer.stats(),
+            "prompt": {**prompt_stats.snapshot(), "system_instruction_cache": prompt_cache.stats()},
+            "intents": intent_router.stats(), "response_cache": response_cache.stats(),
+            "webhook_dedup": event_dedup.stats(), "ocr": ocr_pool.stats()}
+
+async def route(method, path, headers, body):
+    if path == "/callback" and method == "POST":
+        return await callback(headers, body)
+    if path == "/ping":
+        return 200, "text/plain", "OK"
+    if path == "/metrics":
+        return 200, "text/plain; version=0.0.4", render_metrics()
+    if path == "/stats":
+        return 200, "application/json", json.dumps(stats(), default=str)
+    return 404, "text/plain", "Not Found"
+
+# --- ASGI ---
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await startup()
+            except Exception as e:
+                print(f"FATAL: startup failed: {e}\n{traceback.format_exc()}")
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+    body = await _read_body(receive)
+    status, content_type, text = await route(scope["method"], scope["path"], headers, body)
+    payload = text.encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", f"{content_type}; charset=utf-8".encode()),
+                            (b"content-length", str(len(payload)).encode())]})
+    await send({"type": "http.response.body", "body": payload})
+
+application = app
@@ -0,0 +1,223 @@
+# async_db.py
+
+import asyncio
+import functools
+import json
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone, timedelta
+
+import asyncpg
+
+from metrics import db_timed, record_stage, DB_POOL_WAIT_SECONDS
+from utils import (
+    DATABASE_URL, DB_POOL_TIMEOUT, Turn, day_bounds,
+    LOAD_TURN_SQL, CLAIM_WEBHOOK_EVENT_SQL, RELEASE_WEBHOOK_EVENT_SQL, DELETE_PROCESSED_EVENTS_SQL,
+    REMINDER_CLAIM_LEASE, REMINDER_RETENTION_DAYS, claim_params, finish_params,
+    UPCOMING_REMINDER_TIMES_SQL, CLAIM_DUE_REMINDERS_SQL, FINISH_REMINDERS_SQL, DELETE_FINISHED_REMINDERS_SQL,
+    DAILY_REMINDER_SUMMARIES_SQL, BIRTHDAY_USERS_SQL, UPSERT_USER_ROLLUP_SQL, user_rollup_params,
+)
+
+# =====================================
+# ฐานข้อมูลสำหรับโหมด asyncio (asgi.py): asyncpg pool + ฟังก์ชันเดียวกับใน utils
+# =====================================
+# ใช้ SQL ชุดเดียวกับ utils (placeholder %s ถูกแปลงเป็น $1, $2, ... ด้วย to_asyncpg)
+
+ASYNC_DB_POOL_MIN = int(os.getenv("ASYNC_DB_POOL_MIN", "2"))
+ASYNC_DB_POOL_MAX = int(os.getenv("ASYNC_DB_POOL_MAX", "20"))
+
+_PLACEHOLDER = re.compile(r"%s|%%")
+
+# asyncpg แยก error ของการเชื่อมต่อไว้หลายสาขา; DataError ฝั่ง client (แปลงค่าไม่ได้) เป็น subclass ของ InterfaceError
+# และ ValueError จึงถูกกันออกเพราะเป็นปัญหาของข้อมูล
+CONNECTION_ERRORS = (asyncpg.PostgresConnectionError, asyncpg.exceptions.OperatorInterventionError,
+                     asyncpg.exceptions.InsufficientResourcesError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError)
+
+def is_connection_error(exc):
+    """เหมือน utils.is_connection_error สำหรับ asyncpg"""
+    return isinstance(exc, CONNECTION_ERRORS) and not isinstance(exc, ValueError)
+
+@functools.lru_cache(maxsize=256)
+def to_asyncpg(sql):
+    """แปลง SQL แบบ psycopg2 (%s, %%) เป็นแบบ asyncpg ($1, $2, ..., %)"""
+    counter = iter(range(1, 10000))
+    return _PLACEHOLDER.sub(lambda m: "%" if m.group() == "%%" else f"${next(counter)}", sql)
+
+class AsyncConnectionPool:
+    """asyncpg pool ที่เก็บสถิติแบบเดียวกับ utils.ConnectionPool (opened / checkouts / waits)"""
+    def __init__(self, dsn, min_size, max_size, timeout):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self._pool = None
+        self.opened = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+
+    async def _on_connect(self, conn):
+        self.opened += 1
+
+    async def open(self):
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size,
+                                               init=self._on_connect, server_settings={"application_name": "smartbot-async"})
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        started = time.monotonic()
+        if self._pool.get_idle_size() == 0 and self._pool.get_size() >= self.max_size:
+            self.waits += 1
+        try:
+            conn = await self._pool.acquire(timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        waited = time.monotonic() - started
+        DB_POOL_WAIT_SECONDS.observe(waited)
+        record_stage("db_pool_wait", waited)
+        self.checkouts += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        try:
+            yield conn
+        finally:
+            await self._pool.release(conn)
+
+    def stats(self):
+        size = self._pool.get_size() if self._pool else 0
+        idle = self._pool.get_idle_size() if self._pool else 0
+        return {"size": self.max_size, "open": size, "in_use": size - idle, "idle": idle,
+                "opened": self.opened, "checkouts": self.checkouts, "waits": self.waits,
+                "wait_time_total": round(self.wait_total, 6), "wait_time_max": round(self.wait_max, 6),
+                "wait_time_avg": round(self.wait_total / self.checkouts, 6) if self.checkouts else 0.0,
+                "timeouts": self.timeouts}
+
+_pool = None
+
+async def open_pool(dsn=DATABASE_URL, min_size=ASYNC_DB_POOL_MIN, max_size=ASYNC_DB_POOL_MAX, timeout=DB_POOL_TIMEOUT):
+    global _pool
+    if not dsn:
+        raise ConnectionError("DATABASE_URL environment variable is not set.")
+    pool = AsyncConnectionPool(dsn, min_size, max_size, timeout)
+    await pool.open()
+    _pool = pool
+    return pool
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+def get_pool_stats():
+    return _pool.stats() if _pool is not None else {"size": ASYNC_DB_POOL_MAX, "in_use": 0, "opened": 0, "checkouts": 0}
+
+def acquire():
+    return _pool.acquire()
+
+async def _execute(conn, sql, params):
+    """รันคำสั่งแบบ psycopg2 บน asyncpg; คอลัมน์เวลาทั้งหมดเป็น TIMESTAMPTZ (migration 4) จึงส่ง datetime ที่มี timezone ไปตรงๆ
+    (ผู้เรียกทุกตัวใช้ datetime.now(timezone.utc)) asyncpg cache prepared statement ต่อ connection ให้เอง"""
+    return await conn.fetch(to_asyncpg(sql), *params)
+
+# --- Turn ---
+@db_timed
+async def load_turn(user_id):
+    async with acquire() as conn:
+        row = (await _execute(conn, LOAD_TURN_SQL, (user_id,)))[0]
+    profile = json.loads(row["profile_data"]) if row["profile_data"] else {}
+    return Turn(user_id, profile, row["context"])
+
+@db_timed
+async def commit_turn(turn):
+    """เขียนทุกอย่างที่สะสมใน turn ใน transaction เดียว (คำสั่งเดียวกับ Turn.commit)
+    การแจ้งเตือนใหม่ถูกประกาศผ่าน NOTIFY ใน INSERT_REMINDER_SQL ซึ่ง AsyncReminderDispatcher ฟังอยู่"""
+    if not turn.has_writes:
+        return
+    async with acquire() as conn:
+        async with conn.transaction():
+            for sql, params in turn.statements():
+                await _execute(conn, sql, params)
+
+# --- Idempotency ของ webhook event ---
+@db_timed
+async def claim_webhook_event(event_id):
+    async with acquire() as conn:
+        return bool(await _execute(conn, CLAIM_WEBHOOK_EVENT_SQL, (event_id,)))
+
+@db_timed
+async def release_webhook_event(event_id):
+    async with acquire() as conn:
+        await conn.execute(to_asyncpg(RELEASE_WEBHOOK_EVENT_SQL), event_id)
+
+@db_timed
+async def delete_processed_events_before(cutoff):
+    async with acquire() as conn:
+        status = await conn.execute(to_asyncpg(DELETE_PROCESSED_EVENTS_SQL), cutoff)
+    return int(status.split()[-1])
+
+# --- Chat log ---
+@db_timed
+async def insert_chat_rows(rows):
+    """rows คือ list ของ (user_id, user_message, bot_response, timestamp); เขียนด้วย COPY พร้อมอัปเดต rollup ของ users"""
+    rollup = user_rollup_params(rows)
+    async with acquire() as conn:
+        async with conn.transaction():
+            await conn.copy_records_to_table("chat_history", columns=("user_id", "user_message", "bot_response", "timestamp"),
+                                             records=rows)
+            if rollup:
+                await _execute(conn, UPSERT_USER_ROLLUP_SQL, rollup)
+
+# --- Reminders ---
+async def listen(channel, callback):
+    """เปิด connection เฉพาะสำหรับ LISTEN (ไม่ใช้จาก pool); callback(conn, pid, channel, payload) ถูกเรียกบน event loop"""
+    conn = await asyncpg.connect(_pool.dsn if _pool else DATABASE_URL, server_settings={"application_name": "smartbot-listener"})
+    await conn.add_listener(channel, callback)
+    return conn
+
+@db_timed
+async def get_upcoming_reminder_times(until):
+    async with acquire() as conn:
+        return [row[0] for row in await _execute(conn, UPCOMING_REMINDER_TIMES_SQL, (until, REMINDER_CLAIM_LEASE))]
+
+@db_timed
+async def claim_due_reminders(limit=100, exclude_ids=()):
+    """เหมือน utils.claim_due_reminders: แถวถูกเปลี่ยนเป็น 'sending' และ commit ก่อนคืน connection"""
+    async with acquire() as conn:
+        return [tuple(row) for row in await _execute(conn, CLAIM_DUE_REMINDERS_SQL, claim_params(limit, exclude_ids))]
+
+@db_timed
+async def finish_reminders(claimed_ids, sent_ids, failed_ids=()):
+    if claimed_ids:
+        async with acquire() as conn:
+            await _execute(conn, FINISH_REMINDERS_SQL, finish_params(claimed_ids, sent_ids, failed_ids))
+
+@db_timed
+async def cleanup_finished_reminders(retention_days=REMINDER_RETENTION_DAYS):
+    if retention_days <= 0:
+        return 0
+    async with acquire() as conn:
+        status = await conn.execute(to_asyncpg(DELETE_FINISHED_REMINDERS_SQL), datetime.now(timezone.utc) - timedelta(days=retention_days))
+    return int(status.split()[-1])
+
+# --- งานประจำวัน ---
+@db_timed
+async def get_daily_reminder_summaries(tz):
+    async with acquire() as conn:
+        rows = await _execute(conn, DAILY_REMINDER_SUMMARIES_SQL, day_bounds(tz))
+    return [(user_id, list(zip(messages, times))) for user_id, messages, times in rows]
+
+@db_timed
+async def get_birthday_users(day_month):
+    async with acquire() as conn:
+        return [row[0] for row in await _execute(conn, BIRTHDAY_USERS_SQL, (day_month,))]
@@ -0,0 +1,121 @@
+# background.py
+
+import os
+import time
+import atexit
+from datetime import datetime
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from dotenv import load_dotenv
+from linebot import LineBotApi
+from linebot.models import TextSendMessage
+
+from utils import get_daily_reminder_summaries, get_birthday_users, cleanup_finished_reminders
+from messaging import PushPool
+from reminders import ReminderDispatcher
+from idempotency import EventDeduplicator
+from leader import LeaderElection
+from partitions import run_chat_maintenance
+from turns import bangkok_tz, BIRTHDAY_MESSAGE, build_reminder_message, build_daily_summary
+from metrics import GaugeFunc, timed_job
+
+# =====================================
+# งานเบื้องหลัง (reminder dispatcher + scheduler) ใช้ร่วมกันระหว่าง app.py และ worker.py
+# =====================================
+# import แล้วยังไม่เริ่มอะไร (สร้างแค่ pool ที่ยังไม่มี thread) จนกว่าจะเรียก run_background_jobs()
+# worker.py จึงไม่ต้องโหลด Flask, turn worker, OCR pool หรือ chat log writer
+load_dotenv()
+LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
+if not LINE_CHANNEL_ACCESS_TOKEN:
+    raise ValueError("Missing required environment variables.")
+
+# LINE_API_ENDPOINT ใช้ชี้ไปยัง LINE API ปลอมตอนทำ load test (ดู bench/)
+line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, endpoint=os.getenv("LINE_API_ENDPOINT", LineBotApi.DEFAULT_API_ENDPOINT))
+
+push_pool = PushPool(
+    line_bot_api,
+    max_workers=int(os.getenv("LINE_PUSH_WORKERS", "8")),
+    rate_per_sec=float(os.getenv("LINE_PUSH_RATE_PER_SEC", "20")),
+)
+# การแจ้งเตือนมีเวลากำหนด จึงส่งผ่าน pool (thread + token bucket) ของตัวเอง ไม่ต่อคิวหลังสรุปรายวันหรือ multicast วันเกิด
+reminder_push_pool = PushPool(
+    line_bot_api,
+    max_workers=int(os.getenv("REMINDER_PUSH_WORKERS", os.getenv("LINE_PUSH_WORKERS", "8"))),
+    rate_per_sec=float(os.getenv("REMINDER_PUSH_RATE_PER_SEC", os.getenv("LINE_PUSH_RATE_PER_SEC", "20"))),
+    name="reminder-push",
+)
+reminder_dispatcher = ReminderDispatcher(reminder_push_pool, build_reminder_message)
+# app.py ใช้ตัวเดียวกันกันข้อความซ้ำ ส่วน scheduler ใช้ลบแถวเก่าใน processed_events
+event_dedup = EventDeduplicator()
+
+last_daily_run = {}
+
+@timed_job("daily_proactive")
+def run_daily_proactive_tasks():
+    """คำนวณข้อความของทุกคนด้วยคิวรีแบบ set-based แล้วส่ง: สรุปรายวัน (ข้อความเฉพาะคน) ผ่าน push แบบขนาน,
+    คำอวยพรวันเกิด (ข้อความเดียวกัน) ผ่าน multicast ชุดละ 500 คน"""
+    started = time.monotonic()
+    now = datetime.now(bangkok_tz)
+    print(f"[{now.strftime('%Y-%m-%d %H:%M')}] Running ALL Daily Proactive Jobs...")
+    # Job 1: Daily Summary
+    summaries = get_daily_reminder_summaries(bangkok_tz)
+    results = push_pool.push_many((user_id, build_daily_summary(reminders_today)) for user_id, reminders_today in summaries)
+    summary_failed = 0
+    for user_id, error in results:
+        if error is not None:
+            summary_failed += 1
+            print(f"ERROR sending daily summary to {user_id}: {error}")
+    # Job 2: Birthday Greeting
+    birthday_users = get_birthday_users(now.strftime('%d-%m'))
+    birthday_sent, birthday_failed = push_pool.multicast(birthday_users, TextSendMessage(text=BIRTHDAY_MESSAGE))
+
+    last_daily_run.clear()
+    last_daily_run.update({
+        "started_at": now.isoformat(),
+        "duration_seconds": round(time.monotonic() - started, 3),
+        "summaries_sent": len(results) - summary_failed, "summaries_failed": summary_failed,
+        "birthdays_sent": birthday_sent, "birthdays_failed": birthday_failed,
+    })
+    print(f"Daily proactive jobs finished: {last_daily_run}")
+    return last_daily_run
+
+# งานเบื้องหลังต้องรันแค่ process เดียว (gunicorn -w N มีหลาย process) กำหนดด้วย RUN_SCHEDULER:
+# auto = เลือก leader ด้วย Postgres advisory lock (ค่าเริ่มต้น), always = รันเสมอ, never = ไม่รัน (เช่น web ที่มี worker.py แยก)
+RUN_SCHEDULER = os.getenv("RUN_SCHEDULER", "auto").lower()
+background_jobs = {}
+
+def start_background_jobs():
+    reminder_dispatcher.start()
+    scheduler = BackgroundScheduler(timezone=bangkok_tz)
+    scheduler.add_job(run_daily_proactive_tasks, 'cron', hour=8, minute=0, id='daily_proactive_job')
+    scheduler.add_job(timed_job("processed_events_cleanup")(event_dedup.cleanup), 'interval', hours=1, id='processed_events_cleanup')
+    scheduler.add_job(timed_job("reminder_cleanup")(cleanup_finished_reminders), 'interval', hours=1, id='reminder_cleanup')
+    # partition ล่วงหน้า + retention ของ chat_history: รันทันทีที่เป็น leader แล้ววันละครั้ง
+    scheduler.add_job(timed_job("chat_partitions")(run_chat_maintenance), 'cron', hour=3, minute=30, id='chat_partition_maintenance',
+                      next_run_time=datetime.now(bangkok_tz))
+    scheduler.start()
+    background_jobs["scheduler"] = scheduler
+    print("Scheduler started: Reminder dispatcher (event-driven), Proactive Daily Jobs (8 AM) and chat partition maintenance (3:30 AM).")
+
+def stop_background_jobs():
+    scheduler = background_jobs.pop("scheduler", None)
+    if scheduler is not None:
+        scheduler.shutdown(wait=False)
+    reminder_dispatcher.stop()
+
+def run_background_jobs(mode=RUN_SCHEDULER):
+    """เริ่มงานเบื้องหลังตาม mode (ดู RUN_SCHEDULER) คืน LeaderElection ถ้าเป็น auto ไม่งั้นคืน None"""
+    if mode == "always":
+        start_background_jobs()
+        atexit.register(stop_background_jobs)
+    elif mode == "auto":
+        leader_election = LeaderElection(start_background_jobs, stop_background_jobs,
+                                         interval=float(os.getenv("LEADER_ELECTION_INTERVAL", "10")))
+        leader_election.start()
+        atexit.register(leader_election.stop)
+        return leader_election
+    else:
+        print(f"Background jobs disabled in this process (RUN_SCHEDULER={mode}).")
+    return None
+
+GaugeFunc("smartbot_scheduler_leader", "1 if this process runs the background jobs.", lambda: int("scheduler" in background_jobs))
@@ -0,0 +1,2 @@
+# bench/__init__.py
+# เครื่องมือ load test แบบ offline (python -m bench.run --help)
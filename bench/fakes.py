@@ -0,0 +1,151 @@
+# bench/fakes.py
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# =====================================
+# Server ปลอมของ Gemini และ LINE Messaging API สำหรับ load test (รันใน process เดียวกับ harness)
+# =====================================
+
+class _FakeServer:
+    """ThreadingHTTPServer บน 127.0.0.1 (port ว่างที่ OS เลือกให้) ที่รันใน daemon thread"""
+    def __init__(self, handler):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive เหมือน API จริง
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, status, body, headers=()):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+class _GeminiHandler(_Handler):
+    def do_POST(self):
+        fake = self.server.fake
+        payload = self._read_json()
+        status, body = fake.respond(self.path, payload)
+        self._send_json(status, body)
+
+class FakeGemini(_FakeServer):
+    """ตอบ generateContent หลังหน่วงเวลา latency ± jitter วินาที; error_rate คือสัดส่วนที่ตอบ 503 (ให้ client retry)
+    ค่าสุ่มมาจาก seed จึงได้ลำดับ error เดิมทุกครั้งที่รันด้วยจำนวน request เท่ากัน"""
+    def __init__(self, latency=0.3, jitter=0.1, error_rate=0.0, seed=1):
+        super().__init__(_GeminiHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+
+    def respond(self, path, payload):
+        with self._lock:
+            self.requests += 1
+            number = self.requests
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        time.sleep(delay)
+        if ":generateContent" not in path:
+            return 404, {"error": {"code": 404, "message": f"unknown path {path}"}}
+        if failed:
+            return 503, {"error": {"code": 503, "message": "fake overload", "status": "UNAVAILABLE"}}
+        turns = len(payload.get("contents") or [])
+        text = f"รับทราบค่ะ 😊 (fake reply #{number}, {turns} turns)"
+        return 200, {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+                     "usageMetadata": {"promptTokenCount": turns * 20, "candidatesTokenCount": 12}}
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "errors": self.errors}
+
+class _LineHandler(_Handler):
+    def do_POST(self):
+        received = time.monotonic()
+        payload = self._read_json()
+        time.sleep(self.server.fake.latency)
+        self.server.fake.record(self.path, payload, received)
+        self._send_json(200, {})
+
+class FakeLine(_FakeServer):
+    """รับ reply/push/multicast แล้วบันทึกเวลาที่ได้รับ (time.monotonic) ไว้ให้ harness คำนวณ latency:
+    replies: replyToken -> เวลา, pushes: list ของ (to, ข้อความแรก, เวลา), multicasts: list ของ (จำนวนผู้รับ, เวลา)"""
+    def __init__(self, latency=0.02):
+        super().__init__(_LineHandler)
+        self.latency = latency
+        self.replies = {}
+        self.pushes = []
+        self.multicasts = []
+        self.unknown = 0
+        self._changed = threading.Condition(self._lock)
+
+    def record(self, path, payload, received):
+        messages = payload.get("messages") or [{}]
+        with self._changed:
+            if path == "/v2/bot/message/reply":
+                self.replies[payload.get("replyToken")] = received
+            elif path == "/v2/bot/message/push":
+                self.pushes.append((payload.get("to"), messages[0].get("text"), received))
+            elif path == "/v2/bot/message/multicast":
+                self.multicasts.append((len(payload.get("to") or []), received))
+            else:
+                self.unknown += 1
+            self._changed.notify_all()
+
+    def wait_for(self, predicate, timeout):
+        """รอจนกว่า predicate(self) เป็นจริง; คืน False ถ้าหมดเวลา"""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while not predicate(self):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._changed.wait(min(remaining, 1.0))
+        return True
+
+    def reset(self):
+        with self._lock:
+            self.replies.clear()
+            self.pushes.clear()
+            self.multicasts.clear()
+            self.unknown = 0
+
+    def stats(self):
+        with self._lock:
+            return {"replies": len(self.replies), "pushes": len(self.pushes),
+                    "multicasts": len(self.multicasts), "multicast_recipients": sum(n for n, _ in self.multicasts),
+                    "unknown": self.unknown}
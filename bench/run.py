@@ -0,0 +1,432 @@
+# bench/run.py
+"""Load test / benchmark แบบ offline: รันแอปทั้งตัวใน process นี้ โดยชี้ Gemini และ LINE ไปที่ server ปลอม (bench/fakes.py)
+และใช้ Postgres ในเครื่องที่ระบุด้วย --database-url (หรือ BENCH_DATABASE_URL) เท่านั้น
+
+    python -m bench.run --database-url postgresql://localhost/smartbot_bench
+    python -m bench.run chat_burst reminder_storm --users 500 --gemini-latency 0.8 --gemini-error-rate 0.05 --json out.json
+
+ข้อมูลทดสอบทั้งหมดใช้ user_id ที่ขึ้นต้นด้วย "bench-" และถูกลบเมื่อจบ (ยกเว้นใส่ --keep)
+ห้ามชี้ไปที่ฐานข้อมูล production: scenario สร้างข้อมูลหลักล้านแถว และงาน 8 โมงเช้าจะส่งหาทุกคนในตาราง"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from bench.fakes import FakeGemini, FakeLine
+
+SCENARIOS = ("chat_burst", "reminder_storm", "proactive", "dashboard")
+BENCH_PREFIX = "bench-"
+CHANNEL_SECRET = "bench-secret"
+
+CHAT_TEXTS = ["สวัสดีค่ะ", "วันนี้อากาศเป็นยังไงบ้าง", "ช่วยแนะนำเมนูอาหารเย็นหน่อย", "ฉันชอบกินส้มตำ",
+              "เล่าเรื่องตลกให้ฟังหน่อย", "ขอบคุณนะ", "what should I read this weekend?", "ช่วยสรุปสิ่งที่คุยกันเมื่อกี้"]
+# ข้อความที่ router ตอบเองได้โดยไม่เรียก Gemini
+INTENT_TEXTS = ["เตือนกินยาพรุ่งนี้ 9 โมงเช้า", "ตั้งเตือนประชุมอีก 2 ชั่วโมง", "/profile", "ล้างความจำ"]
+REMINDER_TEXT = re.compile(r"bench reminder #(\d+)")
+
+# =====================================
+# สถิติ
+# =====================================
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(seconds):
+    """p50/p95/p99/max เป็นมิลลิวินาที"""
+    values = sorted(seconds)
+    result = {"count": len(values)}
+    for name, q in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100)):
+        value = percentile(values, q)
+        result[f"{name}_ms"] = round(value * 1000, 1) if value is not None else None
+    return result
+
+class PoolDelta:
+    """จำนวน connection ที่ pool เปิดใหม่ / จำนวนครั้งที่ยืม connection ระหว่างช่วงที่วัด"""
+    def __init__(self, utils):
+        self._utils = utils
+        self._before = utils.get_pool_stats()
+
+    def per(self, units):
+        after = self._utils.get_pool_stats()
+        opened = after.get("opened", 0) - self._before.get("opened", 0)
+        checkouts = after.get("checkouts", 0) - self._before.get("checkouts", 0)
+        return {"db_connections_opened": opened, "db_checkouts": checkouts,
+                "db_connections_opened_per_unit": round(opened / units, 4) if units else None,
+                "db_checkouts_per_unit": round(checkouts / units, 3) if units else None,
+                "db_pool_waits": after.get("waits", 0) - self._before.get("waits", 0)}
+
+def db_time_by_function(before, after):
+    """เวลารวมที่ใช้ในแต่ละฟังก์ชันฐานข้อมูลระหว่างช่วงที่วัด (จาก histogram smartbot_db_query_seconds)"""
+    result = {}
+    for labels, (count, total) in after.items():
+        old_count, old_total = before.get(labels, (0, 0.0))
+        if count > old_count:
+            result[labels[0]] = {"calls": count - old_count, "total_ms": round((total - old_total) * 1000, 1)}
+    return dict(sorted(result.items(), key=lambda item: -item[1]["total_ms"]))
+
+# =====================================
+# Webhook ที่ลงลายเซ็นถูกต้อง
+# =====================================
+
+def sign(body):
+    return base64.b64encode(hmac.new(CHANNEL_SECRET.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()).decode("ascii")
+
+def text_event(user_id, text, reply_token, event_id):
+    return {
+        "type": "message", "mode": "active", "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": event_id, "deliveryContext": {"isRedelivery": False},
+        "replyToken": reply_token,
+        "message": {"id": event_id, "type": "text", "text": text},
+    }
+
+def post_webhook(client, events):
+    body = json.dumps({"destination": "Ubench", "events": events}, ensure_ascii=False)
+    return client.post("/callback", data=body.encode("utf-8"), content_type="application/json",
+                       headers={"X-Line-Signature": sign(body)}).status_code
+
+# =====================================
+# Scenarios
+# =====================================
+
+def chat_burst(ctx):
+    """ผู้ใช้ --users คน ส่งคนละ --messages ข้อความ ยิงเข้า /callback เร็วที่สุด (หรือตาม --rate)
+    latency ของ turn = ตั้งแต่ส่ง webhook จนถึง LINE ปลอมได้รับ reply ของ replyToken นั้น"""
+    args, app, line = ctx.args, ctx.app, ctx.line
+    rng = random.Random(args.seed)
+    items = []
+    for _ in range(args.messages):
+        users = list(range(args.users))
+        rng.shuffle(users)  # สลับลำดับผู้ใช้ในแต่ละรอบ แต่ข้อความของผู้ใช้คนเดียวกันยังเรียงตามเดิม
+        for u in users:
+            text = rng.choice(INTENT_TEXTS) if rng.random() < args.intent_ratio else rng.choice(CHAT_TEXTS)
+            n = len(items)
+            items.append((f"{BENCH_PREFIX}u{u:06d}", text, f"{BENCH_PREFIX}rt-{ctx.run_id}-{n}", f"{BENCH_PREFIX}ev-{ctx.run_id}-{n}"))
+
+    line.reset()
+    sent_at, rejected = {}, []
+    lock = threading.Lock()
+    cursor = iter(enumerate(items))
+    pool = PoolDelta(ctx.utils)
+    db_before = ctx.metrics.DB_SECONDS.totals()
+    started = time.monotonic()
+
+    def sender():
+        client = app.app.test_client()
+        while True:
+            with lock:
+                item = next(cursor, None)
+            if item is None:
+                return
+            n, (user_id, text, reply_token, event_id) = item
+            if args.rate:
+                delay = started + n / args.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            sent = time.monotonic()
+            status = post_webhook(client, [text_event(user_id, text, reply_token, event_id)])
+            with lock:
+                if status == 200:
+                    sent_at[reply_token] = sent
+                else:
+                    rejected.append(status)
+
+    senders = [threading.Thread(target=sender) for _ in range(args.senders)]
+    for t in senders: t.start()
+    for t in senders: t.join()
+    send_seconds = time.monotonic() - started
+    complete = line.wait_for(lambda f: len(f.replies) >= len(sent_at), args.timeout)
+    with line._lock:
+        replies = {token: line.replies[token] for token in sent_at if token in line.replies}
+    latencies = [replies[token] - sent_at[token] for token in replies]
+    finished = max(replies.values()) if replies else time.monotonic()
+    elapsed = finished - started
+    return {
+        "messages": len(items), "accepted": len(sent_at), "rejected": len(rejected), "replied": len(replies),
+        "complete": complete, "send_seconds": round(send_seconds, 3), "elapsed_seconds": round(elapsed, 3),
+        "messages_per_second": round(len(replies) / elapsed, 1) if elapsed > 0 else None,
+        "turn_latency": summarize(latencies),
+        **pool.per(len(replies)),
+        "db_time": db_time_by_function(db_before, ctx.metrics.DB_SECONDS.totals()),
+        "intents": app.intent_router.stats()["by_intent"],
+        "gemini": {**app.gemini.stats(), "fake_requests": ctx.gemini.stats()["requests"], "fake_errors": ctx.gemini.stats()["errors"]},
+        "webhook_queue": {k: v for k, v in app.turn_workers.stats().items() if k != "depth_per_worker"},
+    }
+
+def reminder_storm(ctx):
+    """การแจ้งเตือน --reminders รายการที่ถึงกำหนดพร้อมกัน (หรือกระจายใน --spread วินาที) หลังจากนี้ --lead วินาที
+    สร้างด้วย INSERT เดียวพร้อม NOTIFY แบบเดียวกับ web process อื่น; lag = เวลาที่ LINE ปลอมได้รับ push - เวลาที่กำหนด"""
+    args, app, line, utils = ctx.args, ctx.app, ctx.line, ctx.utils
+    rng = random.Random(args.seed)
+    line.reset()
+    dispatcher = app.reminder_dispatcher
+    dispatcher.start()
+    deadline = time.monotonic() + 10
+    while not dispatcher.stats()["listening"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    wall_base, mono_base = datetime.now(timezone.utc), time.monotonic()
+    offsets = [args.lead + (rng.uniform(0, args.spread) if args.spread else 0.0) for _ in range(args.reminders)]
+    rows = ([f"{BENCH_PREFIX}r{i % max(1, args.users):06d}" for i in range(args.reminders)],
+            [f"bench reminder #{i}" for i in range(args.reminders)],
+            [wall_base + timedelta(seconds=o) for o in offsets])
+    with utils.db_cursor() as cur:
+        cur.execute(f"""
+            WITH r AS (INSERT INTO reminders (user_id, reminder_message, notify_at)
+                       SELECT * FROM unnest(%s::text[], %s::text[], %s::timestamptz[]) RETURNING notify_at)
+            SELECT pg_notify('{utils.REMINDER_CHANNEL}', extract(epoch FROM notify_at)::text) FROM (SELECT DISTINCT notify_at FROM r) d
+        """, rows)
+    pool = PoolDelta(utils)
+    dispatcher_before = dispatcher.stats()
+
+    complete = line.wait_for(lambda f: len(f.pushes) >= args.reminders, args.lead + args.spread + args.timeout)
+    with line._lock:
+        pushes = list(line.pushes)
+    lags, first, last = [], None, None
+    for _, text, received in pushes:
+        m = REMINDER_TEXT.search(text or "")
+        if m:
+            lags.append(received - (mono_base + offsets[int(m.group(1))]))
+            first = received if first is None else min(first, received)
+            last = received if last is None else max(last, received)
+    # ตัวนับของ dispatcher อัปเดตหลัง commit ของ batch สุดท้าย (ช้ากว่า push เล็กน้อย)
+    deadline = time.monotonic() + 5
+    while dispatcher.stats()["sent"] - dispatcher_before["sent"] < len(lags) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    dispatcher_after = dispatcher.stats()
+    dispatcher.stop()
+    return {
+        "reminders": args.reminders, "delivered": len(lags), "complete": complete,
+        "dispatch_lag": summarize(lags),
+        "pushes_per_second": round(len(lags) / (last - first), 1) if lags and last > first else None,
+        "dispatcher_sent": dispatcher_after["sent"] - dispatcher_before["sent"],
+        "dispatcher_failed": dispatcher_after["failed"] - dispatcher_before["failed"],
+        **pool.per(len(lags)),
+    }
+
+def proactive(ctx):
+    """งาน 8 โมงเช้า (run_daily_proactive_tasks) กับผู้ใช้ --proactive-users คน:
+    ทุกๆ 3 คนมีการแจ้งเตือนของวันนี้ 1-3 รายการ (สรุปรายวันแบบ push) และทุกๆ 20 คนมีวันเกิดวันนี้ (multicast)"""
+    args, app, line, utils = ctx.args, ctx.app, ctx.line, ctx.utils
+    n = args.proactive_users
+    now = datetime.now(app.bangkok_tz)
+    start_of_day = app.bangkok_tz.localize(datetime.combine(now.date(), datetime.min.time()))
+    seed_started = time.monotonic()
+    with utils.db_cursor() as cur:
+        cur.execute("""
+            INSERT INTO user_profiles (user_id, profile_data, last_updated)
+            SELECT %s || lpad(i::text, 6, '0'),
+                   CASE WHEN i %% 20 = 0 THEN jsonb_build_object('ชื่อเล่น', 'u' || i, 'วันเกิด', %s)
+                        ELSE jsonb_build_object('ชื่อเล่น', 'u' || i) END,
+                   now()
+            FROM generate_series(1, %s) i
+            ON CONFLICT (user_id) DO NOTHING
+        """, (f"{BENCH_PREFIX}p", now.strftime("%d-%m"), n))
+        cur.execute("""
+            INSERT INTO reminders (user_id, reminder_message, notify_at)
+            SELECT %s || lpad(i::text, 6, '0'), 'bench daily #' || i || '.' || k,
+                   %s + make_interval(secs => (i * 37 + k * 3600) %% 86000)
+            FROM generate_series(1, %s) i CROSS JOIN LATERAL generate_series(1, 1 + i %% 3) k
+            WHERE i %% 3 = 0
+        """, (f"{BENCH_PREFIX}p", start_of_day, n))
+        cur.execute("ANALYZE user_profiles; ANALYZE reminders;")
+    seed_seconds = time.monotonic() - seed_started
+
+    line.reset()
+    pool = PoolDelta(utils)
+    db_before = ctx.metrics.DB_SECONDS.totals()
+    started = time.monotonic()
+    from background import run_daily_proactive_tasks  # import หลัง configure_environment เหมือน app
+    result = run_daily_proactive_tasks()
+    elapsed = time.monotonic() - started
+    line_stats = line.stats()
+    sends = line_stats["pushes"] + line_stats["multicasts"]
+    return {
+        "users": n, "seed_seconds": round(seed_seconds, 2), "elapsed_seconds": round(elapsed, 3),
+        **{k: v for k, v in result.items() if k != "started_at"},
+        "line_requests": sends, "line_requests_per_second": round(sends / elapsed, 1) if elapsed else None,
+        "multicast_recipients": line_stats["multicast_recipients"],
+        **pool.per(sends),
+        "db_time": db_time_by_function(db_before, ctx.metrics.DB_SECONDS.totals()),
+    }
+
+def dashboard(ctx):
+    """Dashboard บน chat_history --chat-rows แถว: วัดหน้าแรก, keyset ต่อกัน 20 หน้า, offset ลึก, ค้นหา, เรียงตาม user"""
+    args, app, utils = ctx.args, ctx.app, ctx.utils
+    seed_started = time.monotonic()
+    with utils.db_cursor() as cur:
+        cur.execute("SELECT count(*) FROM chat_history WHERE user_id LIKE %s", (f"{BENCH_PREFIX}c%",))
+        existing = cur.fetchone()[0]
+        if existing < args.chat_rows:
+            # ทุกๆ 1000 แถวมีคำว่า needle สำหรับทดสอบการค้นหา; เวลาย้อนหลังแถวละ 7 วินาที (~81 วันต่อล้านแถว)
+            cur.execute("""
+                INSERT INTO chat_history (user_id, user_message, bot_response, timestamp)
+                SELECT %s || lpad((i %% 10000)::text, 5, '0'),
+                       'ข้อความทดสอบที่ ' || i || CASE WHEN i %% 1000 = 0 THEN ' needle' ELSE '' END,
+                       'ตอบกลับข้อความที่ ' || i,
+                       (now() AT TIME ZONE 'utc') - make_interval(secs => i * 7)
+                FROM generate_series(%s, %s) i
+            """, (f"{BENCH_PREFIX}c", existing + 1, args.chat_rows))
+            cur.execute("ANALYZE chat_history;")
+    seed_seconds = time.monotonic() - seed_started
+
+    client = app.app.test_client()
+    base = {"draw": 1, "length": 25, "order[0][column]": 0, "order[0][dir]": "desc"}
+    queries = {
+        "first_page": dict(base, start=0),
+        "offset_page_400": dict(base, start=10000),
+        "search_hit": dict(base, start=0, **{"search[value]": "needle"}),
+        "search_miss": dict(base, start=0, **{"search[value]": "ไม่มีคำนี้แน่นอน"}),
+        "order_by_user": dict(base, start=0, **{"order[0][column]": 1, "order[0][dir]": "asc"}),
+    }
+    pool = PoolDelta(utils)
+    results, requests_made = {}, 0
+    for name, params in queries.items():
+        timings = []
+        for _ in range(args.repeat):
+            t = time.perf_counter()
+            response = client.get("/api/dashboard/chats", query_string=params)
+            timings.append(time.perf_counter() - t)
+            assert response.status_code == 200, (name, response.status_code)
+        results[name] = summarize(timings)
+        requests_made += args.repeat
+    # กด "หน้าถัดไป" ต่อกัน 20 หน้าด้วย cursor (keyset pagination)
+    timings = []
+    for _ in range(args.repeat):
+        params, cursor = dict(base, start=0), None
+        for page in range(20):
+            if cursor:
+                params = dict(base, start=page * 25, after=cursor)
+            t = time.perf_counter()
+            body = client.get("/api/dashboard/chats", query_string=params).get_json()
+            timings.append(time.perf_counter() - t)
+            cursor = body["cursor"]
+        requests_made += 20
+    results["keyset_20_pages"] = summarize(timings)
+    for name, path in (("stats", "/api/dashboard/stats"), ("html", "/")):
+        timings = []
+        for _ in range(args.repeat):
+            t = time.perf_counter()
+            client.get(path)
+            timings.append(time.perf_counter() - t)
+        results[name] = summarize(timings)
+        requests_made += args.repeat
+    return {"chat_rows": args.chat_rows, "seed_seconds": round(seed_seconds, 2), "requests": results,
+            **pool.per(requests_made)}
+
+# =====================================
+# Runner
+# =====================================
+
+class Context:
+    def __init__(self, args, gemini, line, app, utils, metrics):
+        self.args, self.gemini, self.line = args, gemini, line
+        self.app, self.utils, self.metrics = app, utils, metrics
+        self.run_id = f"{args.seed}-{int(time.time())}"
+
+def configure_environment(args, gemini, line):
+    """ต้องตั้งก่อน import app (ค่าถูกอ่านตอน import)"""
+    os.environ.update({
+        "DATABASE_URL": args.database_url,
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench-token", "LINE_CHANNEL_SECRET": CHANNEL_SECRET, "GEMINI_API_KEY": "bench-key",
+        "GEMINI_API_BASE": f"{gemini.url}/v1beta", "LINE_API_ENDPOINT": line.url,
+        # scenario เริ่ม/หยุด reminder dispatcher และเรียกงาน 8 โมงเช้าเอง
+        "RUN_SCHEDULER": "never", "SKIP_MIGRATIONS": "0",
+        "GEMINI_RATE_PER_SEC": str(args.gemini_rate), "GEMINI_BURST": str(args.gemini_rate),
+        "LINE_PUSH_RATE_PER_SEC": str(args.line_push_rate),
+    })
+    # ค่าที่ผู้ใช้ตั้งเองใน environment มีผลเหนือกว่า
+    os.environ.setdefault("WEBHOOK_QUEUE_SIZE", "100000")
+    os.environ.setdefault("DASHBOARD_CACHE_TTL", "0")  # วัดคิวรีนับจำนวนทุกครั้ง (กรณี cache หมดอายุ)
+    os.environ.setdefault("SLOW_TURN_SECONDS", "3600")  # ไม่ให้ log รกระหว่าง load test
+    os.environ.setdefault("SLOW_QUERY_SECONDS", "3600")
+
+def cleanup(utils):
+    like = f"{BENCH_PREFIX}%"
+    with utils.db_cursor() as cur:
+        for table, column in (("chat_history", "user_id"), ("reminders", "user_id"), ("user_profiles", "user_id"),
+                              ("session_data", "user_id"), ("processed_events", "event_id"), ("users", "user_id")):
+            cur.execute(f"DELETE FROM {table} WHERE {column} LIKE %s", (like,))
+
+def print_result(name, result, indent="  "):
+    print(f"{indent}{name}:")
+    for key, value in result.items():
+        if isinstance(value, dict):
+            print_result(key, value, indent + "  ")
+        else:
+            print(f"{indent}  {key}: {value}")
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="python -m bench.run", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("scenarios", nargs="*", metavar="scenario", help=f"หนึ่งหรือหลายตัวจาก {', '.join(SCENARIOS)} (ค่าเริ่มต้น: ทั้งหมด)")
+    p.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"), help="Postgres สำหรับทดสอบเท่านั้น")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--messages", type=int, default=5, help="ข้อความต่อผู้ใช้ใน chat_burst")
+    p.add_argument("--intent-ratio", type=float, default=0.2, help="สัดส่วนข้อความที่เป็นคำสั่ง (ไม่เรียก Gemini)")
+    p.add_argument("--senders", type=int, default=4, help="จำนวน thread ที่ยิง webhook")
+    p.add_argument("--rate", type=float, default=0, help="webhook ต่อวินาที (0 = เร็วที่สุด)")
+    p.add_argument("--reminders", type=int, default=2000)
+    p.add_argument("--lead", type=float, default=3.0, help="วินาทีก่อนการแจ้งเตือนชุดแรกถึงกำหนด")
+    p.add_argument("--spread", type=float, default=0.0, help="กระจายเวลาแจ้งเตือนในช่วงกี่วินาที (0 = พร้อมกันหมด)")
+    p.add_argument("--proactive-users", type=int, default=100000)
+    p.add_argument("--chat-rows", type=int, default=1000000)
+    p.add_argument("--repeat", type=int, default=20, help="จำนวนครั้งต่อคิวรีของ dashboard")
+    p.add_argument("--gemini-latency", type=float, default=0.3)
+    p.add_argument("--gemini-jitter", type=float, default=0.1)
+    p.add_argument("--gemini-error-rate", type=float, default=0.0)
+    p.add_argument("--gemini-rate", type=float, default=1000, help="GEMINI_RATE_PER_SEC ของแอประหว่างทดสอบ")
+    p.add_argument("--line-latency", type=float, default=0.02)
+    p.add_argument("--line-push-rate", type=float, default=1000, help="LINE_PUSH_RATE_PER_SEC ของแอประหว่างทดสอบ")
+    p.add_argument("--timeout", type=float, default=120, help="วินาทีที่รอผลหลังส่งครบ")
+    p.add_argument("--keep", action="store_true", help="ไม่ลบข้อมูล bench- หลังจบ")
+    p.add_argument("--json", help="บันทึกผลเป็นไฟล์ JSON")
+    args = p.parse_args(argv)
+    if not args.database_url:
+        p.error("ต้องระบุ --database-url หรือ BENCH_DATABASE_URL (ฐานข้อมูลสำหรับทดสอบเท่านั้น)")
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        p.error(f"unknown scenario: {', '.join(unknown)}")
+    scenarios = args.scenarios or list(SCENARIOS)
+
+    gemini = FakeGemini(args.gemini_latency, args.gemini_jitter, args.gemini_error_rate, seed=args.seed).start()
+    line = FakeLine(args.line_latency).start()
+    configure_environment(args, gemini, line)
+    import app
+    import metrics
+    import utils
+    ctx = Context(args, gemini, line, app, utils, metrics)
+
+    report = {"config": {k: v for k, v in vars(args).items() if k not in ("database_url", "json")}, "results": {}}
+    try:
+        for name in scenarios:
+            print(f"Running {name}...")
+            result = globals()[name](ctx)
+            report["results"][name] = result
+            print_result(name, result)
+    finally:
+        app.chat_writer.stop()
+        if not args.keep:
+            print("Cleaning up bench rows...")
+            cleanup(utils)
+        gemini.stop()
+        line.stop()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,291 @@
+# chatlog.py
+
+import asyncio
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from metrics import ERRORS, JOB_SECONDS
+from utils import insert_chat_rows, is_connection_error
+from workers import LatencyStats
+
+# =====================================
+# Write-behind buffer สำหรับ chat_history
+# =====================================
+
+class ChatLogWriter:
+    """เก็บแชทไว้ในคิวแล้วเขียนลง chat_history เป็นชุด (multi-row INSERT) บน background thread
+    flush เมื่อครบ `batch_size` แถวหรือครบ `flush_interval` วินาที ถ้าฐานข้อมูลเขียนไม่ทัน คิวจะเต็ม
+    และ log() จะรอได้ไม่เกิน `put_timeout` วินาที (backpressure) ก่อนทิ้งแถวนั้นและนับเป็น dropped
+    error ของการเชื่อมต่อจะ retry แบบ backoff ส่วน error อื่น (ข้อมูลเสีย) จะแบ่ง batch ครึ่งๆ จนเหลือแถวที่เสียแล้วทิ้งแถวนั้น (นับเป็น rejected)"""
+    def __init__(self, batch_size=200, flush_interval=1.0, max_queue=10000, put_timeout=0.5, max_backoff=5.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_backoff = max_backoff
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.flush_errors = 0
+        self.blocked = LatencyStats()
+        self.flush_time = LatencyStats()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="chatlog-writer", daemon=True)
+            self._thread.start()
+
+    def log(self, user_id, user_message, bot_response):
+        """ใส่แชทเข้าคิว (ไม่รอการเขียนฐานข้อมูล); คืน False ถ้าคิวเต็มจนต้องทิ้ง"""
+        row = (user_id, user_message, bot_response, datetime.now(timezone.utc))
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            started = time.monotonic()
+            try:
+                self._queue.put(row, timeout=self.put_timeout)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                print(f"WARNING: chat log queue full, dropping message from {user_id}")
+                return False
+            finally:
+                self.blocked.observe(time.monotonic() - started)
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _take_batch(self):
+        """รอแถวแรกไม่เกิน flush_interval แล้วเก็บต่อจนครบ batch_size หรือหมดเวลา"""
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        """เขียน batch; คืน False ถ้าสั่งหยุดระหว่างที่ฐานข้อมูลยังเชื่อมต่อไม่ได้ (แถวที่ยังไม่ได้เขียนนับเป็น dropped)
+        ถ้าเชื่อมต่อไม่ได้จะ retry ชุดเดิมแบบ backoff ไปเรื่อยๆ ถ้าเป็น error อื่นจะแบ่งครึ่งแล้วเขียนแต่ละครึ่งใหม่
+        จนแถวที่ทำให้ล้มเหลวเหลือแถวเดียวแล้วทิ้งแถวนั้น แถวที่เขียนสำเร็จแล้วจึงไม่ถูกเขียนซ้ำ"""
+        pending = [batch]
+        backoff = 0.1
+        while pending:
+            rows = pending.pop()
+            started = time.monotonic()
+            try:
+                insert_chat_rows(rows)
+            except Exception as e:
+                ERRORS.inc("chat_log")
+                with self._lock:
+                    self.flush_errors += 1
+                if not is_connection_error(e):
+                    self._split(rows, pending, e)
+                    continue
+                print(f"ERROR writing {len(rows)} chat rows: {e}")
+                if self._stopping.is_set():
+                    with self._lock:
+                        self.dropped += len(rows) + sum(len(p) for p in pending)
+                    return False
+                pending.append(rows)
+                self._stopping.wait(backoff)
+                backoff = min(self.max_backoff, backoff * 2)
+                continue
+            backoff = 0.1
+            elapsed = time.monotonic() - started
+            self.flush_time.observe(elapsed)
+            JOB_SECONDS.observe(elapsed, "chat_log_flush")
+            with self._lock:
+                self.written += len(rows)
+                self.batches += 1
+        return True
+
+    def _split(self, rows, pending, error):
+        """แบ่ง rows ที่เขียนไม่ได้เพราะข้อมูลเป็นสองครึ่งเข้า pending (ครึ่งแรกถูกเขียนก่อน) หรือทิ้งถ้าเหลือแถวเดียว"""
+        if len(rows) == 1:
+            with self._lock:
+                self.rejected += 1
+            print(f"ERROR dropping chat row from {rows[0][0]}: {error}")
+            return
+        mid = len(rows) // 2
+        pending.extend((rows[mid:], rows[:mid]))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+        self.flush()
+
+    def flush(self):
+        """เขียนทุกแถวที่ค้างอยู่ในคิวทันที (ใช้ตอนปิดระบบ)"""
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            if not self._write(batch):
+                # ฐานข้อมูลยังล่มขณะปิดระบบ: แถวที่เหลือในคิวก็เขียนไม่ได้เช่นกัน นับเป็น dropped ให้ครบ
+                with self._lock:
+                    while True:
+                        try:
+                            self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        self.dropped += 1
+                return
+
+    def stop(self, timeout=10.0):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        else:
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            counters = {"enqueued": self.enqueued, "written": self.written, "batches": self.batches,
+                        "dropped": self.dropped, "rejected": self.rejected, "flush_errors": self.flush_errors}
+        return {**counters, "depth": self._queue.qsize(), "avg_batch": round(counters["written"] / counters["batches"], 2) if counters["batches"] else 0.0,
+                "flush_seconds": self.flush_time.snapshot(), "blocked_seconds": self.blocked.snapshot()}
+
+class AsyncChatLogWriter:
+    """ChatLogWriter สำหรับโหมด asyncio: asyncio.Queue + task เดียวที่เขียนเป็นชุดด้วย write_func (async_db.insert_chat_rows)
+    log() ห้ามบล็อก event loop จึงทิ้งแถวทันทีเมื่อคิวเต็ม (นับเป็น dropped)
+    is_transient(exc) บอกว่า error ไหนเป็นปัญหาการเชื่อมต่อ (retry) ที่เหลือจัดการแบบเดียวกับ ChatLogWriter (แบ่งครึ่งแล้วทิ้งแถวเสีย)"""
+    def __init__(self, write_func, is_transient, batch_size=200, flush_interval=1.0, max_queue=10000, max_backoff=5.0):
+        self.write_func = write_func
+        self.is_transient = is_transient
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.max_backoff = max_backoff
+        self._queue = None
+        self._task = None
+        self._stopping = None
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.flush_errors = 0
+        self.flush_time = LatencyStats()
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._stopping = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def log(self, user_id, user_message, bot_response):
+        try:
+            self._queue.put_nowait((user_id, user_message, bot_response, datetime.now(timezone.utc)))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            print(f"WARNING: chat log queue full, dropping message from {user_id}")
+            return False
+        self.enqueued += 1
+        return True
+
+    async def _take_batch(self):
+        try:
+            batch = [await asyncio.wait_for(self._queue.get(), self.flush_interval)]
+        except asyncio.TimeoutError:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if self._queue.empty():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _write(self, batch):
+        pending = [batch]
+        backoff = 0.1
+        while pending:
+            rows = pending.pop()
+            started = time.monotonic()
+            try:
+                await self.write_func(rows)
+            except Exception as e:
+                ERRORS.inc("chat_log")
+                self.flush_errors += 1
+                if not self.is_transient(e):
+                    self._split(rows, pending, e)
+                    continue
+                print(f"ERROR writing {len(rows)} chat rows: {e}")
+                if self._stopping.is_set():
+                    self.dropped += len(rows) + sum(len(p) for p in pending)
+                    return False
+                pending.append(rows)
+                await asyncio.sleep(backoff)
+                backoff = min(self.max_backoff, backoff * 2)
+                continue
+            backoff = 0.1
+            elapsed = time.monotonic() - started
+            self.flush_time.observe(elapsed)
+            JOB_SECONDS.observe(elapsed, "chat_log_flush")
+            self.written += len(rows)
+            self.batches += 1
+        return True
+
+    def _split(self, rows, pending, error):
+        if len(rows) == 1:
+            self.rejected += 1
+            print(f"ERROR dropping chat row from {rows[0][0]}: {error}")
+            return
+        mid = len(rows) // 2
+        pending.extend((rows[mid:], rows[:mid]))
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            batch = await self._take_batch()
+            if batch:
+                await self._write(batch)
+
+    async def stop(self):
+        """หยุด task แล้วเขียนแถวที่ค้างในคิวทั้งหมด"""
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+        while not self._queue.empty():
+            batch = [self._queue.get_nowait() for _ in range(min(self.batch_size, self._queue.qsize()))]
+            if not await self._write(batch):
+                self.dropped += self._queue.qsize()
+                return
+
+    def stats(self):
+        return {"enqueued": self.enqueued, "written": self.written, "batches": self.batches,
+                "dropped": self.dropped, "rejected": self.rejected, "flush_errors": self.flush_errors,
+                "depth": self._queue.qsize() if self._queue else 0,
+                "avg_batch": round(self.written / self.batches, 2) if self.batches else 0.0,
+                "flush_seconds": self.flush_time.snapshot()}
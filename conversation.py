@@ -0,0 +1,206 @@
+# conversation.py
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# =====================================
+# Conversation context: ประวัติแชทตามงบ token + สรุปบทสนทนาเก่า + cache system instruction
+# =====================================
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "300"))
+SUMMARY_LINE_CHARS = 120  # ตัดแต่ละข้อความที่ถูกย่อให้สั้นไม่เกินนี้
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "0"))  # วินาที; 0 = ปิด response cache
+ROLE_LABELS = {"user": "ผู้ใช้", "model": "ผู้ช่วย"}
+
+def estimate_tokens(text):
+    """ประมาณจำนวน token แบบเร็ว: อักษรละติน ~4 ตัวต่อ token, อักษรไทย/อื่นๆ ~2 ตัวต่อ token"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ch < "\x80")
+    return ascii_chars // 4 + (len(text) - ascii_chars + 1) // 2 + 1
+
+def _message_text(message):
+    return "".join(part.get("text", "") for part in message.get("parts", []))
+
+class Conversation:
+    """ประวัติบทสนทนาที่เก็บใน session_data.context: {"summary": "...", "history": [...]}
+    เมื่อประวัติเกินงบ token ข้อความเก่าสุดจะถูกย่อ (ตัดให้สั้น) แล้วพับเข้าไปใน summary
+    summary เองก็มีงบ token จำกัด บรรทัดเก่าสุดจะถูกทิ้งเมื่อเกิน"""
+    def __init__(self, history=None, summary=""):
+        self.history = list(history or [])
+        self.summary = summary or ""
+        self.folded = 0
+
+    @classmethod
+    def from_session(cls, context):
+        """รองรับทั้งรูปแบบใหม่ (dict) และรูปแบบเดิม (list ของข้อความ / JSON string)"""
+        if isinstance(context, str):
+            try: context = json.loads(context)
+            except ValueError as e:
+                print(f"Session load error: {e}")
+                context = None
+        if isinstance(context, list):
+            return cls(context)
+        if isinstance(context, dict):
+            return cls(context.get("history"), context.get("summary"))
+        return cls()
+
+    def add(self, role, text):
+        self.history.append({"role": role, "parts": [{"text": text}]})
+
+    def history_tokens(self):
+        return sum(estimate_tokens(_message_text(m)) for m in self.history)
+
+    def summary_tokens(self):
+        return estimate_tokens(self.summary)
+
+    def fit(self, budget=CONTEXT_TOKEN_BUDGET, summary_budget=SUMMARY_TOKEN_BUDGET):
+        """พับข้อความเก่าเข้า summary จนประวัติไม่เกิน budget (เก็บข้อความล่าสุดไว้เสมออย่างน้อยหนึ่งข้อความ)"""
+        folded_lines = []
+        while len(self.history) > 1 and self.history_tokens() > budget:
+            # พับทีละคู่ (ผู้ใช้ + ผู้ช่วย) เพื่อให้ประวัติยังเริ่มด้วยข้อความของผู้ใช้
+            count = 2 if len(self.history) > 2 and self.history[1].get("role") == "model" else 1
+            for message in self.history[:count]:
+                text = " ".join(_message_text(message).split())
+                if len(text) > SUMMARY_LINE_CHARS:
+                    text = text[:SUMMARY_LINE_CHARS] + "…"
+                folded_lines.append(f"{ROLE_LABELS.get(message.get('role'), message.get('role'))}: {text}")
+            del self.history[:count]
+            self.folded += count
+        if folded_lines:
+            lines = [line for line in self.summary.split("\n") if line] + folded_lines
+            while len(lines) > 1 and estimate_tokens("\n".join(lines)) > summary_budget:
+                lines.pop(0)
+            self.summary = "\n".join(lines)
+        return self
+
+    def contents(self):
+        return self.history
+
+    def to_session(self):
+        return {"summary": self.summary, "history": self.history}
+
+class SystemPromptCache:
+    """cache system instruction ที่ render แล้วตาม "เวอร์ชัน" ของ profile (hash ของข้อมูล profile)
+    render_func(profile) ต้องคืน dict ของ systemInstruction; ค่าที่ cache ไว้ห้ามแก้ไขโดยตรง"""
+    IGNORED_KEYS = ("pending_action", "pending_data")
+
+    def __init__(self, render_func, maxsize=PROMPT_CACHE_SIZE):
+        self.render_func = render_func
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def profile_version(cls, profile):
+        data = {k: v for k, v in (profile or {}).items() if k not in cls.IGNORED_KEYS}
+        return hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _rendered(self, profile):
+        version = self.profile_version(profile)
+        with self._lock:
+            cached = self._cache.get(version)
+            if cached is not None:
+                self._cache.move_to_end(version)
+                self.hits += 1
+                return cached
+            self.misses += 1
+        rendered = self.render_func(profile)
+        rendered = (rendered, estimate_tokens("".join(p.get("text", "") for p in rendered["parts"])))
+        with self._lock:
+            self._cache[version] = rendered
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return rendered
+
+    def get(self, profile, summary=""):
+        """คืน (systemInstruction, จำนวน token โดยประมาณ); summary ของบทสนทนาจะถูกต่อเป็น part แยก"""
+        instruction, tokens = self._rendered(profile)
+        if not summary:
+            return instruction, tokens
+        summary_text = f"สรุปบทสนทนาก่อนหน้า:\n{summary}"
+        return {**instruction, "parts": instruction["parts"] + [{"text": summary_text}]}, tokens + estimate_tokens(summary_text)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+class ResponseCache:
+    """cache คำตอบของ Gemini สำหรับคำถามที่ไม่ขึ้นกับบทสนทนาก่อนหน้า (ยังไม่มีประวัติ)
+    key คือข้อความที่ normalize แล้ว + เวอร์ชันของ profile; หมดอายุตาม ttl และถูกไล่ออกแบบ LRU"""
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._cache = OrderedDict()  # key -> (expires_at, reply)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.maxsize > 0
+
+    def key(self, text, profile):
+        normalized = " ".join(text.casefold().split()).strip(" ?!.~ๆ")
+        return f"{SystemPromptCache.profile_version(profile)}:{normalized}"
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._cache[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, reply):
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.ttl, reply)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"enabled": self.enabled, "size": len(self._cache), "hits": self.hits, "misses": self.misses,
+                    "expired": self.expired, "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0}
+
+class PromptStats:
+    """ขนาด prompt (token โดยประมาณ) ต่อ request ที่ส่งไป Gemini"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.total = 0
+        self.max = 0
+        self.last = 0
+        self.folded_messages = 0
+
+    def observe(self, tokens, folded=0):
+        with self._lock:
+            self.requests += 1
+            self.total += tokens
+            self.max = max(self.max, tokens)
+            self.last = tokens
+            self.folded_messages += folded
+
+    def snapshot(self):
+        with self._lock:
+            return {"requests": self.requests, "avg_tokens": round(self.total / self.requests, 1) if self.requests else 0.0,
+                    "max_tokens": self.max, "last_tokens": self.last, "folded_messages": self.folded_messages}
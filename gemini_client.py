@@ -0,0 +1,293 @@
+# gemini_client.py
+
+import asyncio
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import ERRORS, GEMINI_SECONDS, record_stage
+from ratelimit import TokenBucket, AsyncTokenBucket, CircuitBreaker, CircuitOpen
+
+# =====================================
+# Gemini API client (keep-alive + rate limit + retry + circuit breaker)
+# =====================================
+
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+class GeminiError(Exception):
+    """Gemini ตอบกลับด้วย error ที่ retry ไม่ได้ (เช่น 400 request ผิดรูปแบบ)"""
+
+class GeminiUnavailable(GeminiError):
+    """Gemini ใช้งานไม่ได้ชั่วคราว: circuit เปิด, retry ครบแล้ว หรือรอคิวนานเกินไป"""
+
+class _GeminiBase:
+    """ค่าตั้งต้น, circuit breaker, backoff และสถิติที่ใช้ร่วมกันระหว่าง client แบบ thread และแบบ asyncio"""
+    def __init__(self, api_key, model, base_url=GEMINI_API_BASE, timeout=(5, 30),
+                 max_concurrency=8, rate_per_sec=5.0, burst=10, queue_timeout=10.0,
+                 max_retries=3, backoff_base=0.5, backoff_max=8.0,
+                 breaker_threshold=5, breaker_reset=30.0):
+        self.api_key = api_key
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._counts = {"requests": 0, "retries": 0, "failures": 0, "short_circuited": 0, "throttled": 0}
+
+    @property
+    def url(self):
+        return f"{self.base_url}/models/{self.model}:generateContent"
+
+    def _count(self, key, delta=1):
+        with self._lock:
+            self._counts[key] += delta
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(self.backoff_max, retry_after)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _before_call(self):
+        try:
+            self.breaker.before_call()
+        except CircuitOpen as e:
+            self._count("short_circuited")
+            raise GeminiUnavailable(str(e)) from e
+
+    @staticmethod
+    def _payload(contents, system_instruction, generation_config):
+        payload = {"contents": contents}
+        if system_instruction:
+            payload["systemInstruction"] = system_instruction
+        if generation_config:
+            payload["generationConfig"] = generation_config
+        return payload
+
+    @staticmethod
+    def _first_text(result):
+        candidates = result.get("candidates") or []
+        if candidates:
+            parts = candidates[0].get("content", {}).get("parts") or []
+            if parts:
+                return parts[0].get("text")
+        return None
+
+    @staticmethod
+    def _retry_after(headers):
+        try:
+            return float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return None
+
+    def _throttled(self, reason):
+        """ติด limit ฝั่งเราเอง (slot หรือ token bucket) ก่อนส่ง request: ไม่ใช่ความผิดของ Gemini จึงไม่นับใน circuit
+        แต่ต้องคืนสิทธิ์ request ทดลองของ half-open ให้คนถัดไป"""
+        self._count("throttled")
+        self.breaker.release_trial()
+        return GeminiUnavailable(reason)
+
+    @contextmanager
+    def _breaker_guard(self):
+        """ทุกทางออกที่ไม่ได้บันทึกผลกับ circuit เอง (exception ที่ไม่คาดคิด) นับเป็นความล้มเหลว
+        ถ้าถูกยกเลิก (เช่น task ถูก cancel) แค่คืนสิทธิ์ request ทดลอง จึงไม่มีทางค้าง half-open ไว้ตลอดไป"""
+        try:
+            yield
+        except GeminiError:
+            raise
+        except Exception:
+            self._count("failures")
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.breaker.release_trial()
+            raise
+
+    def _gave_up(self, last_error):
+        self._count("failures")
+        self.breaker.record_failure()
+        return GeminiUnavailable(f"Gemini request failed after {self.max_retries + 1} attempts: {last_error}")
+
+    def _observe(self, started, outcome):
+        elapsed = time.perf_counter() - started
+        GEMINI_SECONDS.observe(elapsed, outcome)
+        record_stage("gemini", elapsed)
+        if outcome != "ok":
+            ERRORS.inc("gemini")
+
+    def stats(self):
+        with self._lock:
+            return {**self._counts, "in_flight": self._in_flight, "circuit": self.breaker.state,
+                    "circuit_opened": self.breaker.opened_count}
+
+class GeminiClient(_GeminiBase):
+    """Client ที่ใช้ร่วมกันทั้ง process: มี HTTP session แบบ keep-alive, จำกัดจำนวน request พร้อมกัน,
+    จำกัดอัตรา request ด้วย token bucket, retry แบบ jittered backoff และ circuit breaker"""
+    def __init__(self, api_key, model, max_concurrency=8, rate_per_sec=5.0, burst=10, **kwargs):
+        super().__init__(api_key, model, max_concurrency=max_concurrency, **kwargs)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.bucket = TokenBucket(rate_per_sec, burst)
+
+    def generate(self, contents, system_instruction=None, generation_config=None):
+        """เรียก generateContent แล้วคืน JSON ที่ได้ ถ้าใช้งานไม่ได้จะ raise GeminiUnavailable ทันทีโดยไม่รอ timeout"""
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = self._generate(contents, system_instruction, generation_config)
+            outcome = "ok"
+            return result
+        except GeminiUnavailable:
+            outcome = "unavailable"
+            raise
+        finally:
+            self._observe(started, outcome)
+
+    def _generate(self, contents, system_instruction, generation_config):
+        self._before_call()
+        payload = self._payload(contents, system_instruction, generation_config)
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise self._throttled(f"no free Gemini slot after {self.queue_timeout}s")
+        with self._lock:
+            self._in_flight += 1
+        try:
+            with self._breaker_guard():
+                return self._post_with_retry(payload)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+    def _post_with_retry(self, payload):
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._count("retries")
+            if not self.bucket.acquire(timeout=self.queue_timeout):
+                if last_error is None:
+                    raise self._throttled(f"rate limit wait exceeded {self.queue_timeout}s")
+                self._count("throttled")
+                break
+            self._count("requests")
+            retry_after = None
+            try:
+                response = self.session.post(self.url, params={"key": self.api_key}, json=payload, timeout=self.timeout)
+            except requests.RequestException as e:
+                last_error = e
+            else:
+                if response.status_code < 400:
+                    self.breaker.record_success()
+                    return response.json()
+                if response.status_code not in RETRYABLE_STATUS:
+                    # API ยังทำงานอยู่ แค่ request ผิด จึงไม่นับเป็นความล้มเหลวของ circuit
+                    self.breaker.record_success()
+                    raise GeminiError(f"Gemini returned {response.status_code}: {response.text[:500]}")
+                last_error = f"HTTP {response.status_code}"
+                retry_after = self._retry_after(response.headers)
+            if attempt < self.max_retries:
+                time.sleep(self._backoff(attempt, retry_after))
+        raise self._gave_up(last_error)
+
+    def generate_text(self, contents, system_instruction=None, generation_config=None):
+        """เหมือน generate แต่คืนเฉพาะข้อความของ candidate แรก (หรือ None ถ้าไม่มี)"""
+        return self._first_text(self.generate(contents, system_instruction, generation_config))
+
+class AsyncGeminiClient(_GeminiBase):
+    """GeminiClient สำหรับโหมด asyncio (asgi.py): ใช้ aiohttp session เดียว, asyncio.Semaphore และ AsyncTokenBucket
+    พฤติกรรม retry / circuit breaker / สถิติเหมือน GeminiClient ทุกอย่าง; ต้องเรียก start() บน event loop ก่อนใช้"""
+    def __init__(self, api_key, model, rate_per_sec=5.0, burst=10, **kwargs):
+        super().__init__(api_key, model, **kwargs)
+        self.bucket = AsyncTokenBucket(rate_per_sec, burst)
+        self.session = None
+        self._slots = None
+
+    async def start(self):
+        connect, read = self.timeout
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60),
+            headers={"Content-Type": "application/json"})
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def generate(self, contents, system_instruction=None, generation_config=None):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await self._generate(contents, system_instruction, generation_config)
+            outcome = "ok"
+            return result
+        except GeminiUnavailable:
+            outcome = "unavailable"
+            raise
+        finally:
+            self._observe(started, outcome)
+
+    async def _generate(self, contents, system_instruction, generation_config):
+        self._before_call()
+        payload = self._payload(contents, system_instruction, generation_config)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise self._throttled(f"no free Gemini slot after {self.queue_timeout}s")
+        with self._lock:
+            self._in_flight += 1
+        try:
+            with self._breaker_guard():
+                return await self._post_with_retry(payload)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+    async def _post_with_retry(self, payload):
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._count("retries")
+            if not await self.bucket.acquire(timeout=self.queue_timeout):
+                if last_error is None:
+                    raise self._throttled(f"rate limit wait exceeded {self.queue_timeout}s")
+                self._count("throttled")
+                break
+            self._count("requests")
+            retry_after = None
+            try:
+                async with self.session.post(self.url, params={"key": self.api_key}, json=payload) as response:
+                    if response.status < 400:
+                        result = await response.json(content_type=None)
+                        self.breaker.record_success()
+                        return result
+                    if response.status not in RETRYABLE_STATUS:
+                        self.breaker.record_success()
+                        raise GeminiError(f"Gemini returned {response.status}: {(await response.text())[:500]}")
+                    last_error = f"HTTP {response.status}"
+                    retry_after = self._retry_after(response.headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                last_error = e
+            if attempt < self.max_retries:
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+        raise self._gave_up(last_error)
+
+    async def generate_text(self, contents, system_instruction=None, generation_config=None):
+        return self._first_text(await self.generate(contents, system_instruction, generation_config))
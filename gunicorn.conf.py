@@ -0,0 +1,45 @@
+# gunicorn.conf.py
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# =====================================
+# gunicorn: หลาย process (ใช้ได้ทุก core) x หลาย thread ต่อ process
+# =====================================
+# งานเบื้องหลังรันแค่ process เดียวที่ได้เป็น leader (ดู leader.py และ RUN_SCHEDULER ใน background.py)
+# แต่ละ worker มี connection pool ของตัวเอง (DB_POOL_MAX) จำนวน connection รวมจึงเป็น workers x DB_POOL_MAX
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+# หลาย worker: ให้ /metrics รวมค่าจากทุก worker ผ่านไฟล์ใน directory ร่วม (ดู metrics.py) ไม่งั้นค่ากระโดดตาม worker ที่รับ scrape
+# ชื่อ directory มี pid ของ master จึงไม่ชนกับ gunicorn อีกชุดบนเครื่องเดียวกัน
+metrics_dir = os.path.join(tempfile.gettempdir(), f"smartbot-metrics-{os.getpid()}")
+if workers > 1:
+    os.environ.setdefault("METRICS_MULTIPROC_DIR", metrics_dir)
+# ห้าม preload: app.py เริ่ม thread และเปิด connection ตอน import ซึ่งใช้ต่อหลัง fork ไม่ได้
+preload_app = False
+
+def on_starting(server):
+    """รัน migration ครั้งเดียวใน master ก่อน fork worker; worker จึงข้ามขั้นนี้ได้ (migration offline ไม่รันที่นี่ ดู migrations.py)"""
+    from migrations import migrate
+    from metrics import clear_metrics_dir
+    clear_metrics_dir()
+    migrate()
+    os.environ["SKIP_MIGRATIONS"] = "1"
+
+def child_exit(server, worker):
+    """worker ตายหรือถูก recycle: รวม counter ของมันเข้า archive และลบ gauge ทันที ไม่ให้ /metrics นับซ้ำกับ worker ใหม่ (ดู metrics.py)"""
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
+
+def on_exit(server):
+    """ลบ directory ของ metrics ที่สร้างเอง (directory ที่ผู้ใช้ตั้งเองใน METRICS_MULTIPROC_DIR ไม่ถูกลบ)"""
+    if os.getenv("METRICS_MULTIPROC_DIR") == metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
@@ -0,0 +1,136 @@
+# idempotency.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone, timedelta
+
+from utils import claim_webhook_event, release_webhook_event, delete_processed_events_before
+
+# =====================================
+# กัน webhook event ซ้ำ (LINE ส่งซ้ำเมื่อ timeout)
+# =====================================
+
+EVENT_DEDUP_TTL = float(os.getenv("EVENT_DEDUP_TTL", str(24 * 3600)))  # วินาที
+EVENT_DEDUP_CACHE_SIZE = int(os.getenv("EVENT_DEDUP_CACHE_SIZE", "10000"))
+
+class EventDeduplicator:
+    """ตรวจ webhookEventId ก่อนประมวลผล: ดูใน LRU ในหน่วยความจำก่อน แล้วจึงบันทึกลงตาราง processed_events
+    (INSERT ... ON CONFLICT DO NOTHING) ซึ่งใช้ร่วมกันได้หลาย process ถ้าฐานข้อมูลใช้ไม่ได้จะยอมให้ประมวลผล (fail open)
+    claim ก่อนเริ่ม turn (event ซ้ำที่มาระหว่างทำงานจึงถูกทิ้ง) ถ้า turn ล้มเหลวก่อน commit ต้องเรียก release()
+    ไม่งั้นครั้งที่ LINE ส่งซ้ำจะถูกทิ้งเป็นของซ้ำและข้อความนั้นหายไป"""
+    def __init__(self, ttl=EVENT_DEDUP_TTL, maxsize=EVENT_DEDUP_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._seen = OrderedDict()  # event_id -> เวลาที่เห็น (monotonic)
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.duplicates_memory = 0
+        self.duplicates_db = 0
+        self.db_errors = 0
+        self.released = 0
+        self.cleaned = 0
+
+    def _remember(self, event_id, now):
+        self._seen[event_id] = now
+        self._seen.move_to_end(event_id)
+        while len(self._seen) > self.maxsize:
+            self._seen.popitem(last=False)
+
+    def _seen_recently(self, event_id, now):
+        with self._lock:
+            self.checked += 1
+            seen_at = self._seen.get(event_id)
+            if seen_at is not None and now - seen_at < self.ttl:
+                self.duplicates_memory += 1
+                return True
+        return False
+
+    def _record(self, event_id, now, first):
+        with self._lock:
+            self._remember(event_id, now)
+            if not first:
+                self.duplicates_db += 1
+        return first
+
+    def _db_error(self, event_id, error):
+        print(f"ERROR recording webhook event {event_id}: {error}")
+        with self._lock:
+            self.db_errors += 1
+        return True
+
+    def _forget(self, event_id):
+        with self._lock:
+            self._seen.pop(event_id, None)
+            self.released += 1
+
+    def claim(self, event_id):
+        """คืน True ถ้าควรประมวลผล event นี้ (ยังไม่เคยเห็น), False ถ้าเป็น event ซ้ำ"""
+        if not event_id:
+            return True
+        now = time.monotonic()
+        if self._seen_recently(event_id, now):
+            return False
+        try:
+            first = claim_webhook_event(event_id)
+        except Exception as e:
+            first = self._db_error(event_id, e)
+        return self._record(event_id, now, first)
+
+    def release(self, event_id):
+        """คืน claim ของ event ที่ประมวลผลไม่สำเร็จ เพื่อให้ครั้งที่ LINE ส่งซ้ำถูกประมวลผลใหม่"""
+        if not event_id:
+            return
+        self._forget(event_id)
+        try:
+            release_webhook_event(event_id)
+        except Exception as e:
+            self._db_error(event_id, e)
+
+    def cleanup(self):
+        """ลบ event ที่เก่ากว่า TTL ออกจากตาราง (รันเป็นระยะจาก scheduler)"""
+        deleted = delete_processed_events_before(datetime.now(timezone.utc) - timedelta(seconds=self.ttl))
+        with self._lock:
+            self.cleaned += deleted
+        return deleted
+
+    def stats(self):
+        with self._lock:
+            return {"checked": self.checked, "duplicates_memory": self.duplicates_memory, "duplicates_db": self.duplicates_db,
+                    "db_errors": self.db_errors, "released": self.released, "cleaned": self.cleaned, "cache_size": len(self._seen)}
+
+class AsyncEventDeduplicator(EventDeduplicator):
+    """EventDeduplicator สำหรับโหมด asyncio; claim_func / release_func / delete_func คือฟังก์ชันใน async_db"""
+    def __init__(self, claim_func, release_func, delete_func, **kwargs):
+        super().__init__(**kwargs)
+        self._claim_func = claim_func
+        self._release_func = release_func
+        self._delete_func = delete_func
+
+    async def claim(self, event_id):
+        if not event_id:
+            return True
+        now = time.monotonic()
+        if self._seen_recently(event_id, now):
+            return False
+        try:
+            first = await self._claim_func(event_id)
+        except Exception as e:
+            first = self._db_error(event_id, e)
+        return self._record(event_id, now, first)
+
+    async def release(self, event_id):
+        if not event_id:
+            return
+        self._forget(event_id)
+        try:
+            await self._release_func(event_id)
+        except Exception as e:
+            self._db_error(event_id, e)
+
+    async def cleanup(self):
+        deleted = await self._delete_func(datetime.now(timezone.utc) - timedelta(seconds=self.ttl))
+        with self._lock:
+            self.cleaned += deleted
+        return deleted
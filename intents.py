@@ -0,0 +1,157 @@
+# intents.py
+
+import re
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from thai_datetime import normalize, parse_datetime
+from workers import LatencyStats
+
+# =====================================
+# Local intent router: คำสั่งที่ตอบได้แน่นอนโดยไม่ต้องเรียก Gemini
+# =====================================
+# route() คืน IntentResult ถ้าข้อความเป็นคำสั่งที่มั่นใจได้ (การเขียนทั้งหมดสะสมไว้ใน turn เหมือน ask_gemini)
+# หรือคืน None เมื่อข้อความกำกวม/เป็นบทสนทนา เพื่อให้ส่งต่อไปที่ Gemini
+
+IntentResult = namedtuple("IntentResult", "intent reply log_chat")
+
+RESET_COMMANDS = {"/reset", "ล้างความจำ", "reset", "clear"}
+FORGET_ME_COMMANDS = {"/forgetme", "/ลบข้อมูลทั้งหมด", "/ลบข้อมูลถาวร"}
+SHOW_PROFILE_COMMANDS = {"/profile", "/ข้อมูลของฉัน", "จำอะไรเกี่ยวกับฉันได้บ้าง", "what do you know about me"}
+
+REMINDER_PREFIX = re.compile(
+    r"^\s*(?:ช่วย\s*)?(?:ตั้ง(?:การ)?(?:แจ้ง)?เตือน|แจ้งเตือน|เตือน)(?:\s*(?:ความจำ|ฉัน|ผม|หนู|เรา|ด้วย|หน่อย|ที))*"
+    r"|^\s*(?:please\s+)?(?:remind\s+me|set\s+(?:a\s+)?reminder)\b")
+# คำสั่งที่ router ไม่รองรับ (แจ้งเตือนซ้ำ, ยกเลิก/แก้ไข, คำถาม) ให้ Gemini จัดการ
+REMINDER_UNSUPPORTED = re.compile(r"ทุก|every|daily|weekly|ยกเลิก|ลบ|เลื่อน|เปลี่ยน|แก้|cancel|delete|change|ไหม|มั้ย|หรือเปล่า|\?")
+FILLER_WORDS = sorted([
+    "ให้", "ว่า", "เรื่อง", "ตอน", "เวลา", "ในวัน", "วัน", "นะคะ", "นะครับ", "นะ", "ด้วย", "หน่อย", "ครับ", "ค่ะ", "คะ", "จ้า",
+    "at", "on", "to", "that", "about", "please", ",",
+], key=len, reverse=True)
+FORGET_KEY = re.compile(
+    r"^\s*(?:ช่วย\s*)?ลืม(?P<key>.+?)(?:\s*ของ)?(?:\s*(?:ฉัน|ผม|หนู|เรา))?"
+    r"(?:\s*(?:ไปเลย|ได้เลย|ด้วย|ไป|เลย|นะคะ|นะครับ|นะ|หน่อย|ที|ครับ|ค่ะ|คะ|จ้า))*\s*$"
+    r"|^\s*forget\s+my\s+(?P<key_en>.+?)\s*[.!]?\s*$")
+
+def _strip_fillers(text):
+    text = text.strip()
+    changed = True
+    while text and changed:
+        changed = False
+        for word in FILLER_WORDS:
+            if text.startswith(word) and (not word.isascii() or len(text) == len(word) or not text[len(word)].isalnum()):
+                text, changed = text[len(word):].strip(), True
+            if text.endswith(word) and (not word.isascii() or len(text) == len(word) or not text[-len(word) - 1].isalnum()):
+                text, changed = text[:-len(word)].strip(), True
+    return text.strip(" \"'“”")
+
+def _remove_spans(text, spans):
+    for start, end in sorted(spans, reverse=True):
+        text = text[:start] + " " + text[end:]
+    return " ".join(text.split())
+
+def format_notify_time(notify_at, now):
+    if notify_at.date() == now.date():
+        return notify_at.strftime('%H:%M น.')
+    return notify_at.strftime('%d/%m/') + str(notify_at.year + 543) + notify_at.strftime(' %H:%M น.')
+
+class IntentRouter:
+    def __init__(self, tz):
+        self.tz = tz
+        self._lock = threading.Lock()
+        self.hits = {}
+        self.misses = 0
+        self.latency = LatencyStats()
+
+    def route(self, turn, user_text, now=None):
+        started = time.perf_counter()
+        now = now or datetime.now(self.tz)
+        result = None
+        for handler in (self._reset, self._pending_reminder, self._reminder, self._forget_key, self._show_profile):
+            result = handler(turn, user_text, now)
+            if result is not None:
+                break
+        self.latency.observe(time.perf_counter() - started)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits[result.intent] = self.hits.get(result.intent, 0) + 1
+        return result
+
+    def _reset(self, turn, user_text, now):
+        command = user_text.strip().lower()
+        if command in RESET_COMMANDS:
+            turn.clear_session()
+            return IntentResult("reset", "🧠 ความจำระยะสั้น (บทสนทนา) ถูกล้างแล้วค่ะ!", False)
+        if command in FORGET_ME_COMMANDS:
+            turn.delete_profile()
+            return IntentResult("forget_me", "🗑️ ข้อมูลถาวรทั้งหมดของคุณ (ชื่อเล่น, ของโปรด, ฯลฯ) ถูกลบเรียบร้อยแล้วค่ะ", False)
+        return None
+
+    def _pending_reminder(self, turn, user_text, now):
+        """ข้อความถัดจาก "จะให้เตือนเรื่องอะไรดีคะ?" คือข้อความของการแจ้งเตือน"""
+        profile = turn.profile
+        if profile.get('pending_action') != 'set_reminder_message':
+            return None
+        time_str = (profile.get('pending_data') or {}).get('time')
+        if not time_str:
+            return None
+        turn.clear_pending_action()
+        try:
+            notify_at = self.tz.localize(datetime.strptime(time_str, "%Y-%m-%d %H:%M:%S"))
+        except ValueError as e:
+            print(f"ERROR completing pending reminder: {e}")
+            return IntentResult("pending_reminder", "ขออภัยค่ะ มีปัญหาในการสร้างการแจ้งเตือน", True)
+        message = _strip_fillers(user_text) or user_text
+        turn.add_reminder(message, notify_at)
+        return IntentResult("pending_reminder",
+                            f"รับทราบค่ะ ตั้งการแจ้งเตือน '{message}' ในเวลา {format_notify_time(notify_at, now)} ให้แล้วนะคะ 👍", True)
+
+    def _reminder(self, turn, user_text, now):
+        text = normalize(user_text)
+        prefix = REMINDER_PREFIX.match(text)
+        if not prefix or REMINDER_UNSUPPORTED.search(text, prefix.end()):
+            return None
+        parsed = parse_datetime(text, now)
+        if parsed.value is None or parsed.value <= now:
+            return None  # ไม่มีเวลา / เวลากำกวม / เวลาที่ผ่านไปแล้ว
+        message = _strip_fillers(_remove_spans(user_text, [prefix.span()] + parsed.spans))
+        if not message:
+            turn.update_profile({"pending_action": "set_reminder_message",
+                                 "pending_data": {"time": parsed.value.strftime("%Y-%m-%d %H:%M:%S")}})
+            return IntentResult("reminder_pending", "จะให้เตือนเรื่องอะไรดีคะ?", True)
+        turn.add_reminder(message, parsed.value)
+        return IntentResult("reminder",
+                            f"รับทราบค่ะ ตั้งการแจ้งเตือน '{message}' ในเวลา {format_notify_time(parsed.value, now)} ให้แล้วนะคะ 👍", True)
+
+    def _forget_key(self, turn, user_text, now):
+        """ลืมข้อมูลเฉพาะเมื่อชื่อ key ตรงกับข้อมูลที่มีอยู่ใน profile เท่านั้น"""
+        m = FORGET_KEY.match(user_text)
+        if not m:
+            return None
+        wanted = (m.group("key") or m.group("key_en")).strip().lower()
+        for key in turn.profile:
+            if key not in turn.PENDING_KEYS and key.strip().lower() == wanted:
+                turn.delete_profile_key(key)
+                return IntentResult("forget_key", f"ได้เลยค่ะ ลืม{key}ของคุณเรียบร้อยแล้วนะคะ", True)
+        return None
+
+    def _show_profile(self, turn, user_text, now):
+        if user_text.strip().lower().rstrip("?") not in SHOW_PROFILE_COMMANDS:
+            return None
+        items = [f"- {k}: {v}" for k, v in turn.profile.items() if k not in turn.PENDING_KEYS]
+        if not items:
+            return IntentResult("show_profile", "ตอนนี้ยังไม่มีข้อมูลถาวรของคุณเลยค่ะ", True)
+        return IntentResult("show_profile", "ข้อมูลที่จำไว้เกี่ยวกับคุณค่ะ:\n" + "\n".join(items), True)
+
+    def stats(self):
+        with self._lock:
+            hits = dict(self.hits)
+            misses = self.misses
+        total = sum(hits.values()) + misses
+        return {"routed": total, "local_hits": sum(hits.values()), "gemini_fallthrough": misses,
+                "hit_rate": round(sum(hits.values()) / total, 4) if total else 0.0,
+                "by_intent": hits, "route_seconds": self.latency.snapshot()}
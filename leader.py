@@ -0,0 +1,102 @@
+# leader.py
+
+import threading
+import time
+
+import psycopg2
+
+from utils import DATABASE_URL
+
+# =====================================
+# เลือก process เดียวให้รันงานเบื้องหลัง (leader) ด้วย Postgres advisory lock
+# =====================================
+# lock ผูกกับ session: ถ้า process ของ leader ตายหรือ connection หลุด Postgres จะปล่อย lock เอง
+# process อื่นที่ลองขอ lock ทุก `interval` วินาทีจะได้เป็น leader แทน (failover)
+
+SCHEDULER_LOCK_ID = 7305_0002
+
+class LeaderElection:
+    """ลองขอ pg_try_advisory_lock บน connection เฉพาะของตัวเองเป็นระยะ
+    ได้ lock -> เรียก on_elected(); connection ที่ถือ lock ใช้ไม่ได้หรือสั่ง stop -> เรียก on_demoted()"""
+    def __init__(self, on_elected, on_demoted, lock_id=SCHEDULER_LOCK_ID, dsn=DATABASE_URL, interval=10.0):
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.lock_id = lock_id
+        self.dsn = dsn
+        self.interval = interval
+        self._conn = None
+        self._thread = None
+        self._stopping = threading.Event()
+        self.is_leader = False
+        self.elected_count = 0
+        self.leader_since = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="leader-election", daemon=True)
+            self._thread.start()
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+                                application_name="smartbot-leader")
+        conn.autocommit = True
+        return conn
+
+    def _close(self):
+        if self._conn is not None:
+            try: self._conn.close()
+            except Exception: pass
+            self._conn = None
+
+    def _step_down(self, reason):
+        if not self.is_leader:
+            return
+        print(f"Leader: stepping down ({reason})")
+        self.is_leader = False
+        self.leader_since = None
+        try: self.on_demoted()
+        except Exception as e: print(f"ERROR stopping background jobs: {e}")
+
+    def _tick(self):
+        if self._conn is None:
+            self._conn = self._connect()
+        with self._conn.cursor() as cur:
+            if self.is_leader:
+                cur.execute("SELECT 1")  # session ยังอยู่ = ยังถือ lock อยู่
+                return
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (self.lock_id,))
+            if not cur.fetchone()[0]:
+                return
+        print("Leader: elected, starting background jobs")
+        self.is_leader = True
+        self.leader_since = time.time()
+        self.elected_count += 1
+        self.on_elected()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self._tick()
+            except Exception as e:
+                print(f"Leader election connection error: {e}")
+                self._step_down("lost database session")
+                self._close()
+            self._stopping.wait(self.interval)
+
+    def stop(self, timeout=10.0):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self._step_down("shutting down")
+        if self._conn is not None:
+            try:
+                with self._conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock_all()")
+            except Exception:
+                pass
+        self._close()
+
+    def stats(self):
+        return {"is_leader": self.is_leader, "elected_count": self.elected_count,
+                "leader_for_seconds": round(time.time() - self.leader_since, 1) if self.leader_since else None}
@@ -0,0 +1,167 @@
+# messaging.py
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot.exceptions import LineBotApiError
+
+from metrics import ERRORS, LINE_SECONDS, record_stage
+from ratelimit import TokenBucket, AsyncTokenBucket
+
+# =====================================
+# ส่งข้อความ LINE แบบขนาน (สำหรับงานเบื้องหลัง)
+# =====================================
+
+def is_permanent_error(error):
+    """error 4xx (ยกเว้น 429) เช่น ผู้ใช้บล็อกบอท ส่งซ้ำก็ไม่สำเร็จ"""
+    return isinstance(error, LineBotApiError) and 400 <= error.status_code < 500 and error.status_code != 429
+
+def call_line_api(api, func, *args):
+    """เรียก LINE API หนึ่งครั้งพร้อมเก็บ latency (histogram ตาม api และผลลัพธ์ + stage ของ turn ปัจจุบัน)"""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        result = func(*args)
+        outcome = "ok"
+        return result
+    finally:
+        elapsed = time.perf_counter() - started
+        LINE_SECONDS.observe(elapsed, api, outcome)
+        record_stage(f"line_{api}", elapsed)
+        if outcome != "ok":
+            ERRORS.inc("line")
+
+async def call_line_api_async(api, func, *args):
+    """call_line_api สำหรับ AsyncLineBotApi (func เป็น coroutine function)"""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await func(*args)
+        outcome = "ok"
+        return result
+    finally:
+        elapsed = time.perf_counter() - started
+        LINE_SECONDS.observe(elapsed, api, outcome)
+        record_stage(f"line_{api}", elapsed)
+        if outcome != "ok":
+            ERRORS.inc("line")
+
+MULTICAST_BATCH_SIZE = 500  # LINE รับผู้รับได้สูงสุด 500 คนต่อการ multicast หนึ่งครั้ง
+
+class PushPool:
+    """ส่ง push/multicast message หลายรายการพร้อมกันบน thread pool โดยจำกัดอัตราด้วย token bucket"""
+    def __init__(self, line_bot_api, max_workers=8, rate_per_sec=20.0, burst=20, name="line-push"):
+        self.line_bot_api = line_bot_api
+        self.bucket = TokenBucket(rate_per_sec, burst)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.multicast_sent = 0
+        self.multicast_failed = 0
+
+    def push(self, to, messages):
+        """ส่ง push หนึ่งรายการ (รอ token ก่อนส่ง); คืน None ถ้าสำเร็จ หรือ exception ที่เกิดขึ้น"""
+        self.bucket.acquire()
+        try:
+            call_line_api("push", self.line_bot_api.push_message, to, messages)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            return e
+        with self._lock:
+            self.sent += 1
+        return None
+
+    def push_many(self, items):
+        """items คือ iterable ของ (to, messages); คืน list ของ (to, error หรือ None) ตามลำดับเดิม"""
+        items = list(items)
+        futures = [self._executor.submit(self.push, to, messages) for to, messages in items]
+        return [(to, f.result()) for (to, _), f in zip(items, futures)]
+
+    def _multicast_batch(self, user_ids, messages):
+        self.bucket.acquire()
+        try:
+            call_line_api("multicast", self.line_bot_api.multicast, user_ids, messages)
+        except Exception as e:
+            print(f"ERROR sending multicast to {len(user_ids)} users: {e}")
+            with self._lock:
+                self.multicast_failed += len(user_ids)
+            return 0
+        with self._lock:
+            self.multicast_sent += len(user_ids)
+        return len(user_ids)
+
+    def multicast(self, user_ids, messages, batch_size=MULTICAST_BATCH_SIZE):
+        """ส่งข้อความเดียวกันให้ผู้ใช้หลายคนเป็นชุดละ batch_size คนแบบขนาน; คืน (จำนวนที่ส่งสำเร็จ, จำนวนที่ล้มเหลว)"""
+        user_ids = list(user_ids)
+        batches = [user_ids[i:i + batch_size] for i in range(0, len(user_ids), batch_size)]
+        futures = [self._executor.submit(self._multicast_batch, batch, messages) for batch in batches]
+        sent = sum(f.result() for f in futures)
+        return sent, len(user_ids) - sent
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            return {"sent": self.sent, "failed": self.failed,
+                    "multicast_sent": self.multicast_sent, "multicast_failed": self.multicast_failed}
+
+class AsyncPushPool:
+    """PushPool สำหรับโหมด asyncio: จำกัดจำนวนการส่งพร้อมกันด้วย asyncio.Semaphore แทน thread pool"""
+    def __init__(self, line_bot_api, max_concurrency=8, rate_per_sec=20.0, burst=20):
+        self.line_bot_api = line_bot_api  # AsyncLineBotApi
+        self.bucket = AsyncTokenBucket(rate_per_sec, burst)
+        self.max_concurrency = max_concurrency
+        self._slots = None
+        self.sent = 0
+        self.failed = 0
+        self.multicast_sent = 0
+        self.multicast_failed = 0
+
+    def _semaphore(self):
+        # สร้างตอนใช้ครั้งแรกเพื่อให้ผูกกับ event loop ที่กำลังรันอยู่
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        return self._slots
+
+    async def push(self, to, messages):
+        async with self._semaphore():
+            await self.bucket.acquire()
+            try:
+                await call_line_api_async("push", self.line_bot_api.push_message, to, messages)
+            except Exception as e:
+                self.failed += 1
+                return e
+        self.sent += 1
+        return None
+
+    async def push_many(self, items):
+        items = list(items)
+        results = await asyncio.gather(*(self.push(to, messages) for to, messages in items))
+        return [(to, error) for (to, _), error in zip(items, results)]
+
+    async def _multicast_batch(self, user_ids, messages):
+        async with self._semaphore():
+            await self.bucket.acquire()
+            try:
+                await call_line_api_async("multicast", self.line_bot_api.multicast, user_ids, messages)
+            except Exception as e:
+                print(f"ERROR sending multicast to {len(user_ids)} users: {e}")
+                self.multicast_failed += len(user_ids)
+                return 0
+        self.multicast_sent += len(user_ids)
+        return len(user_ids)
+
+    async def multicast(self, user_ids, messages, batch_size=MULTICAST_BATCH_SIZE):
+        user_ids = list(user_ids)
+        batches = [user_ids[i:i + batch_size] for i in range(0, len(user_ids), batch_size)]
+        sent = sum(await asyncio.gather(*(self._multicast_batch(batch, messages) for batch in batches)))
+        return sent, len(user_ids) - sent
+
+    def stats(self):
+        return {"sent": self.sent, "failed": self.failed,
+                "multicast_sent": self.multicast_sent, "multicast_failed": self.multicast_failed}
@@ -0,0 +1,420 @@
+# metrics.py
+
+import atexit
+import contextvars
+import functools
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# =====================================
+# Metrics แบบเบา (histogram / counter / gauge) + export เป็น Prometheus text format ที่ /metrics
+# =====================================
+# ค่าเก็บในหน่วยความจำของแต่ละ process; ทุก series มี label pid เพื่อให้ Prometheus แยก worker ของ gunicorn ได้
+# (รวมด้วย sum without (pid) (...))
+# gunicorn หลาย worker: scrape แต่ละครั้งตกไปที่ worker ใดก็ได้ ค่าจึงกระโดดไปมาระหว่าง pid ถ้าไม่ได้ตั้ง METRICS_MULTIPROC_DIR
+# (gunicorn.conf.py ตั้งให้เองเมื่อ workers > 1) ตั้งแล้วแต่ละ process เขียนค่าลง {dir}/metrics-{pid}-*.json ทุก METRICS_DUMP_INTERVAL วินาที
+# และ /metrics ของ worker ใดก็ได้รวมทุกไฟล์: counter / histogram รวมเป็นค่าเดียว (รวม process ที่ตายแล้วด้วย ค่าจึงไม่ลดลง)
+# ส่วน gauge แยกตาม pid และนับเฉพาะ process ที่ยังอยู่ ไม่ได้ตั้ง = ใช้ /metrics ได้ถูกต้องเฉพาะ WEB_CONCURRENCY=1
+# worker ที่ตาย/ถูก recycle: gunicorn master เรียก mark_process_dead (child_exit) รวม counter / histogram เข้า metrics-archive.json แล้วลบไฟล์ของ pid นั้น
+
+SLOW_TURN_SECONDS = float(os.getenv("SLOW_TURN_SECONDS", "3.0"))
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS", "0.2"))
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR")
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", "5"))
+
+_registry = []
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}
+        _registry.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def snapshot(self):
+        """[(labels, ค่า)] ของทุก series ณ ตอนนี้ (สำเนา อ่านต่อนอก lock ได้)"""
+        with self._lock:
+            return [(labels, self._copy(value)) for labels, value in self._series.items()]
+
+    def _copy(self, value):
+        return value
+
+    def render(self, extra):
+        return self.render_series(self.snapshot(), extra)
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def header(self):
+        return [f"# HELP {self.name}_total {self.documentation}", f"# TYPE {self.name}_total counter"]
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def merge(self, a, b):
+        return a + b
+
+    def render_series(self, series, extra):
+        return [f"{self.name}_total{_format_labels(self.labelnames, labels, extra)} {_format_value(value)}"
+                for labels, value in series]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labels, stage=None):
+        """จับเวลาบล็อกโค้ด; ถ้าระบุ stage จะบวกเวลาเข้า breakdown ของ turn ที่กำลังทำอยู่ด้วย"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe(elapsed, *labels)
+            if stage:
+                record_stage(stage, elapsed)
+
+    def totals(self):
+        """{labels: (จำนวน, ผลรวมวินาที)} ของทุก series (ใช้เทียบก่อน/หลังในการวัดผล)"""
+        with self._lock:
+            return {labels: (count, total) for labels, (_, total, count) in self._series.items()}
+
+    def _copy(self, value):
+        counts, total, count = value
+        return [list(counts), total, count]
+
+    def merge(self, a, b):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]]
+
+    def render_series(self, series, extra):
+        lines = []
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, extra + (('le', le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels, extra)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels, extra)} {count}")
+        return lines
+
+class GaugeFunc(_Metric):
+    """gauge ที่อ่านค่าตอน scrape จาก func() ซึ่งคืนตัวเลข หรือ dict ของ {label value: ตัวเลข} (label เดียว)"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, func, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+
+    def snapshot(self):
+        try:
+            value = self.func()
+        except Exception as e:
+            print(f"ERROR reading gauge {self.name}: {e}")
+            return []
+        if isinstance(value, dict):
+            return [((k,), v) for k, v in value.items()]
+        return [((), value)]
+
+    def render_series(self, series, extra):
+        return [f"{self.name}{_format_labels(self.labelnames if labels else (), labels, extra)} {_format_value(value)}"
+                for labels, value in series]
+
+def render_metrics():
+    if METRICS_MULTIPROC_DIR:
+        return _render_multiprocess()
+    extra = (("pid", os.getpid()),)
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.header())
+        lines.extend(metric.render(extra))
+    return "\n".join(lines) + "\n"
+
+# =====================================
+# โหมดหลาย process: แต่ละ process เขียนค่าลงไฟล์ของตัวเองใน METRICS_MULTIPROC_DIR แล้ว /metrics รวมทุกไฟล์
+# =====================================
+_export = {"pid": None, "path": None}
+ARCHIVE_FILE = "metrics-archive.json"  # counter / histogram ของ process ที่ตายแล้ว (ไม่มี pid และไม่มี gauge)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def dump_metrics():
+    """เขียนค่าปัจจุบันของ process นี้ลงไฟล์ (เขียน .tmp แล้ว rename จึงไม่มีใครอ่านได้ไฟล์ครึ่งๆ)
+    ชื่อไฟล์มีเวลาเริ่มด้วย process ใหม่ที่ได้ pid ซ้ำจึงไม่เขียนทับ counter ของ process เก่า"""
+    pid = os.getpid()
+    if _export["pid"] != pid:
+        _export.update(pid=pid, path=os.path.join(METRICS_MULTIPROC_DIR, f"metrics-{pid}-{time.time_ns()}.json"))
+    state = {"pid": pid, "metrics": {m.name: [[list(labels), value] for labels, value in m.snapshot()] for m in _registry}}
+    _write_state(_export["path"], state)
+
+def _write_state(path, state):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def _read_states():
+    """{ชื่อไฟล์: state} ของทุกไฟล์ใน METRICS_MULTIPROC_DIR (รวม archive)"""
+    states = {}
+    for name in os.listdir(METRICS_MULTIPROC_DIR):
+        if not (name.startswith("metrics-") and name.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(METRICS_MULTIPROC_DIR, name)) as f:
+                states[name] = json.load(f)
+        except FileNotFoundError:
+            pass  # ถูก mark_process_dead ลบไประหว่างอ่าน (ค่าอยู่ใน archive แล้ว)
+        except (OSError, ValueError) as e:
+            print(f"ERROR reading metrics file {name}: {e}")
+    return states
+
+def _merge_series(metric, states):
+    merged = {}
+    for state in states:
+        for labels, value in state.get("metrics", {}).get(metric.name, []):
+            labels = tuple(labels)
+            merged[labels] = metric.merge(merged[labels], value) if labels in merged else value
+    return merged
+
+def _render_multiprocess():
+    dump_metrics()
+    states = _read_states()
+    # ไฟล์ที่รวมเข้า archive แล้วแต่ master ยังลบไม่ทัน ต้องไม่นับซ้ำ
+    folded = set(states.get(ARCHIVE_FILE, {}).get("folded", ()))
+    states = [state for name, state in states.items() if name not in folded]
+    live = [state for state in states if state["pid"] is not None and _pid_alive(state["pid"])]
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.header())
+        if isinstance(metric, GaugeFunc):
+            for state in live:
+                series = [(tuple(labels), value) for labels, value in state["metrics"].get(metric.name, [])]
+                lines.extend(metric.render_series(series, (("pid", state["pid"]),)))
+            continue
+        lines.extend(metric.render_series(_merge_series(metric, states).items(), ()))
+    return "\n".join(lines) + "\n"
+
+def mark_process_dead(pid):
+    """เรียกใน gunicorn master (child_exit) เมื่อ worker ตาย: รวม counter / histogram ของ pid นั้นเข้า ARCHIVE_FILE แล้วลบไฟล์ของมัน
+    gauge ของ worker ที่ตายจึงหายทันทีแม้ pid ถูก process ใหม่นำไปใช้ (เหมือน mark_process_dead ของ prometheus_client)
+    counter / histogram ทั้งหมดประกาศใน metrics.py master จึงรู้จักทุกตัว; ส่วน gauge (ประกาศใน app.py) ไม่ถูกเก็บ"""
+    if not METRICS_MULTIPROC_DIR or not os.path.isdir(METRICS_MULTIPROC_DIR):
+        return
+    states = _read_states()
+    archive = states.pop(ARCHIVE_FILE, {"pid": None, "folded": [], "metrics": {}})
+    folded = [name for name in archive["folded"] if name in states]  # ลบไม่สำเร็จในรอบก่อน
+    dead = [name for name in states if name.startswith(f"metrics-{pid}-") and name not in folded]
+    if not dead:
+        return
+    merging = [archive] + [states[name] for name in dead]
+    _write_state(os.path.join(METRICS_MULTIPROC_DIR, ARCHIVE_FILE), {
+        "pid": None, "folded": folded + dead,
+        "metrics": {m.name: [[list(labels), value] for labels, value in _merge_series(m, merging).items()]
+                    for m in _registry if not isinstance(m, GaugeFunc)},
+    })
+    for name in dead:
+        try:
+            os.remove(os.path.join(METRICS_MULTIPROC_DIR, name))
+        except FileNotFoundError:
+            pass
+
+def start_metrics_export():
+    """เริ่ม thread ที่เขียนค่าลงไฟล์เป็นระยะ (ไม่มีผลถ้าไม่ได้ตั้ง METRICS_MULTIPROC_DIR) เรียกครั้งเดียวต่อ process"""
+    if not METRICS_MULTIPROC_DIR:
+        return
+    os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+
+    def loop():
+        while True:
+            time.sleep(METRICS_DUMP_INTERVAL)
+            try:
+                dump_metrics()
+            except Exception as e:
+                print(f"ERROR writing metrics file: {e}")
+
+    dump_metrics()
+    threading.Thread(target=loop, name="metrics-export", daemon=True).start()
+    atexit.register(dump_metrics)
+
+def clear_metrics_dir():
+    """ลบไฟล์ของรอบก่อน (เรียกใน gunicorn master ก่อน fork worker)"""
+    if not METRICS_MULTIPROC_DIR or not os.path.isdir(METRICS_MULTIPROC_DIR):
+        return
+    for name in os.listdir(METRICS_MULTIPROC_DIR):
+        if name.startswith("metrics-"):
+            os.remove(os.path.join(METRICS_MULTIPROC_DIR, name))
+
+def _reset_after_fork():
+    """process ลูกเริ่มนับใหม่ ไม่งั้นค่าที่ master นับไว้ (เช่นคิวรีตอน migrate) จะถูกนับซ้ำในทุก worker"""
+    for metric in _registry:
+        metric._lock = threading.Lock()
+        if not isinstance(metric, GaugeFunc):
+            metric._series.clear()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+# --- Metrics หลักของระบบ ---
+DB_SECONDS = Histogram("smartbot_db_query_seconds", "Time spent in each database helper.", ["function"])
+DB_POOL_WAIT_SECONDS = Histogram("smartbot_db_pool_wait_seconds", "Time waiting to check out a pooled connection.")
+GEMINI_SECONDS = Histogram("smartbot_gemini_request_seconds", "Gemini generateContent latency including retries.", ["outcome"])
+LINE_SECONDS = Histogram("smartbot_line_api_seconds", "LINE Messaging API call latency.", ["api", "outcome"])
+TURN_SECONDS = Histogram("smartbot_turn_seconds", "End-to-end webhook turn latency.", ["kind", "route"])
+JOB_SECONDS = Histogram("smartbot_job_seconds", "Background job run duration.", ["job"],
+                        buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0))
+CONTROL_TAGS = Counter("smartbot_control_tags", "Control tags found in Gemini replies.", ["tag", "outcome"])
+ERRORS = Counter("smartbot_errors", "Errors by component.", ["component"])
+
+# =====================================
+# Turn trace: เวลาแต่ละ stage ของ turn ปัจจุบัน สำหรับ slow-turn log
+# =====================================
+# ใช้ ContextVar: แยกกันทั้งต่อ thread (โหมด Flask) และต่อ task (โหมด asyncio ที่หลาย turn รันบน thread เดียว)
+_current_trace = contextvars.ContextVar("turn_trace", default=None)
+
+def user_hash(user_id):
+    """hash ของ user id สำหรับ log (ไม่เก็บ id จริง)"""
+    return hashlib.sha256(str(user_id).encode("utf-8")).hexdigest()[:12] if user_id else "-"
+
+class TurnTrace:
+    def __init__(self, user_id, kind):
+        self.user_hash = user_hash(user_id)
+        self.kind = kind
+        self.route = "unknown"
+        self.stages = {}  # stage -> [seconds, count]
+
+    def add(self, stage, seconds):
+        entry = self.stages.setdefault(stage, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+    def breakdown(self):
+        return " ".join(f"{stage}={seconds * 1000:.1f}ms" + (f"(x{count})" if count > 1 else "")
+                        for stage, (seconds, count) in sorted(self.stages.items(), key=lambda s: -s[1][0]))
+
+def current_trace():
+    return _current_trace.get()
+
+def record_stage(stage, seconds):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+@contextmanager
+def trace_turn(user_id, kind):
+    """จับเวลาทั้ง turn; ถ้าเกิน SLOW_TURN_SECONDS จะ log พร้อม hash ของผู้ใช้และเวลาแต่ละ stage"""
+    trace = TurnTrace(user_id, kind)
+    token = _current_trace.set(trace)
+    started = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        elapsed = time.perf_counter() - started
+        TURN_SECONDS.observe(elapsed, kind, trace.route)
+        if elapsed > SLOW_TURN_SECONDS:
+            print(f"SLOW TURN user={trace.user_hash} kind={kind} route={trace.route} total={elapsed * 1000:.1f}ms {trace.breakdown()}")
+
+def _observe_query(name, elapsed):
+    DB_SECONDS.observe(elapsed, name)
+    record_stage("db", elapsed)
+    if elapsed > SLOW_QUERY_SECONDS:
+        trace = current_trace()
+        print(f"SLOW QUERY {name} {elapsed * 1000:.1f}ms user={trace.user_hash if trace else '-'}")
+
+def db_timed(func):
+    """decorator สำหรับฟังก์ชันฐานข้อมูล (utils / async_db): histogram ต่อฟังก์ชัน + stage "db" + slow-query log"""
+    name = func.__qualname__
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                ERRORS.inc("db")
+                raise
+            finally:
+                _observe_query(name, time.perf_counter() - started)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            ERRORS.inc("db")
+            raise
+        finally:
+            _observe_query(name, time.perf_counter() - started)
+    return wrapper
+
+def timed_job(job):
+    """decorator สำหรับงานของ scheduler"""
+    def decorate(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with JOB_SECONDS.time(job):
+                    try:
+                        return await func(*args, **kwargs)
+                    except Exception:
+                        ERRORS.inc(f"job:{job}")
+                        raise
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with JOB_SECONDS.time(job):
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    ERRORS.inc(f"job:{job}")
+                    raise
+        return wrapper
+    return decorate
@@ -0,0 +1,280 @@
+# migrations.py
+
+import json
+import os
+import sys
+from collections import namedtuple
+from datetime import datetime, timezone, timedelta
+
+import psycopg2
+
+from partitions import DEFAULT_PARTITION, LEGACY_PARTITION, ensure_chat_partitions, month_start
+from utils import (
+    DATABASE_URL, LOAD_TURN_SQL, CLAIM_WEBHOOK_EVENT_SQL, RELEASE_WEBHOOK_EVENT_SQL, DELETE_PROCESSED_EVENTS_SQL, CHAT_HISTORY_SQL, ALL_UNIQUE_USERS_SQL,
+    REMINDER_CLAIM_LEASE, UPCOMING_REMINDER_TIMES_SQL, CLAIM_DUE_REMINDERS_SQL, FINISH_REMINDERS_SQL, DELETE_FINISHED_REMINDERS_SQL,
+    REMINDERS_FOR_TODAY_SQL, DAILY_REMINDER_SUMMARIES_SQL, BIRTHDAY_USERS_SQL, claim_params, finish_params,
+)
+
+# =====================================
+# Versioned schema migrations (แทน create_tables เดิม)
+# =====================================
+# แต่ละ migration รันครั้งเดียวและถูกบันทึกไว้ใน schema_migrations
+# migration ที่ transactional=False จะรันแบบ autocommit ทีละคำสั่ง (จำเป็นสำหรับ CREATE INDEX CONCURRENTLY)
+# จึงต้องเขียนให้รันซ้ำได้ (idempotent) เผื่อ process ตายกลางคัน
+# migration ที่ offline=True ล็อกตารางนานตามขนาดข้อมูล จึงไม่รันเองตอน start (gunicorn / app / asgi / worker):
+# startup จะ log ว่ามี migration ค้างแล้วให้บริการต่อ (ไม่รัน migration ถัดไปด้วย เพื่อรักษาลำดับ version)
+# ต้องหยุดแอปแล้วรัน python migrations.py migrate --offline (หรือตั้ง ALLOW_OFFLINE_MIGRATIONS=1)
+# ยกเว้นฐานข้อมูลใหม่ที่ยังไม่เคย migrate ซึ่งตารางยังว่าง จึงรันได้ทันที
+
+MIGRATION_LOCK_ID = 7305_0001  # pg_advisory_lock: ให้มีแค่ process เดียวที่ migrate ในเวลาเดียวกัน
+ALLOW_OFFLINE_MIGRATIONS = os.getenv("ALLOW_OFFLINE_MIGRATIONS") == "1"
+
+Migration = namedtuple("Migration", "version name statements transactional offline", defaults=(False,))
+
+def create_index_concurrently(name, definition):
+    """สร้าง index แบบไม่ล็อกตาราง; ถ้าเคยสร้างค้างไว้จนเป็น INVALID จะลบแล้วสร้างใหม่"""
+    def run(cur):
+        cur.execute("""
+            SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s AND pg_table_is_visible(c.oid)
+        """, (name,))
+        row = cur.fetchone()
+        if row and row[0]:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+        cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition};")
+    run.__name__ = f"create_index_concurrently({name})"
+    return run
+
+def partition_chat_history(cur):
+    """แปลง chat_history เป็นตารางแบบ partition รายเดือน (ดู partitions.py) โดยไม่คัดลอกข้อมูลเก่าทั้งตาราง:
+    ตารางเดิมกลายเป็น partition chat_history_legacy ครอบคลุมทุกอย่างก่อนเดือนนี้ ส่วนแถวของเดือนนี้ถูกย้ายไป partition ใหม่
+    (เปลี่ยน id เป็น BIGINT ทำให้ตารางเดิมถูกเขียนใหม่หนึ่งครั้ง)
+    ทั้งหมดอยู่ใน transaction เดียวที่ถือ ACCESS EXCLUSIVE lock ของ chat_history จนจบ (นานตามขนาดตาราง)
+    จึงเป็น migration offline (ไม่รันเองตอน start): หยุด web / worker ก่อนแล้วรัน python migrations.py migrate --offline ไม่งั้น webhook ทุกตัวค้างรอ lock จน timeout"""
+    current = month_start(datetime.now(timezone.utc))
+    cur.execute(f"ALTER TABLE chat_history RENAME TO {LEGACY_PARTITION};")
+    cur.execute(f"ALTER INDEX IF EXISTS chat_history_pkey RENAME TO {LEGACY_PARTITION}_pkey;")
+    cur.execute(f"ALTER INDEX IF EXISTS idx_chat_history_timestamp RENAME TO {LEGACY_PARTITION}_timestamp_idx;")
+    cur.execute(f"ALTER INDEX IF EXISTS idx_chat_history_user_timestamp RENAME TO {LEGACY_PARTITION}_user_id_timestamp_idx;")
+    # partition key ต้องไม่เป็น NULL
+    cur.execute(f"UPDATE {LEGACY_PARTITION} SET timestamp = 'epoch' WHERE timestamp IS NULL;")
+    cur.execute(f"ALTER TABLE {LEGACY_PARTITION} ALTER COLUMN timestamp SET NOT NULL, ALTER COLUMN id TYPE BIGINT;")
+    cur.execute("ALTER SEQUENCE chat_history_id_seq AS BIGINT;")
+    cur.execute("""
+        CREATE TABLE chat_history (
+            id BIGINT NOT NULL DEFAULT nextval('chat_history_id_seq'), user_id TEXT, user_message TEXT, bot_response TEXT,
+            timestamp TIMESTAMPTZ NOT NULL DEFAULT now()
+        ) PARTITION BY RANGE (timestamp);
+    """)
+    cur.execute("ALTER SEQUENCE chat_history_id_seq OWNED BY chat_history.id;")
+    cur.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF chat_history DEFAULT;")
+    # index บนตารางแม่ถูกสร้างในทุก partition; ตอน attach ตารางเดิม Postgres ใช้ index เดิมที่ตรงกันแทนการสร้างใหม่
+    cur.execute("CREATE INDEX idx_chat_history_timestamp ON chat_history (timestamp);")
+    cur.execute("CREATE INDEX idx_chat_history_user_timestamp ON chat_history (user_id, timestamp);")
+    ensure_chat_partitions(cur, current)
+    cur.execute(f"""
+        WITH moved AS (DELETE FROM {LEGACY_PARTITION} WHERE timestamp >= %s RETURNING id, user_id, user_message, bot_response, timestamp)
+        INSERT INTO chat_history (id, user_id, user_message, bot_response, timestamp) SELECT * FROM moved;
+    """, (current,))
+    # CHECK ที่ตรงกับขอบของ partition (validate แล้ว) ทำให้ ATTACH ไม่ต้องสแกนตารางเดิมทั้งตารางซ้ำเพื่อตรวจขอบ
+    # หลัง attach ก็ไม่จำเป็นแล้ว (partition constraint ทำหน้าที่แทน) จึงลบทิ้ง
+    cur.execute(f"ALTER TABLE {LEGACY_PARTITION} ADD CONSTRAINT {LEGACY_PARTITION}_bound CHECK (timestamp < '{current.isoformat()}') NOT VALID;")
+    cur.execute(f"ALTER TABLE {LEGACY_PARTITION} VALIDATE CONSTRAINT {LEGACY_PARTITION}_bound;")
+    cur.execute(f"ALTER TABLE chat_history ATTACH PARTITION {LEGACY_PARTITION} FOR VALUES FROM (MINVALUE) TO ('{current.isoformat()}');")
+    cur.execute(f"ALTER TABLE {LEGACY_PARTITION} DROP CONSTRAINT {LEGACY_PARTITION}_bound;")
+
+MIGRATIONS = [
+    Migration(1, "initial tables", [
+        "CREATE TABLE IF NOT EXISTS chat_history (id SERIAL PRIMARY KEY, user_id TEXT, user_message TEXT, bot_response TEXT, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP);",
+        "CREATE TABLE IF NOT EXISTS session_data (user_id TEXT PRIMARY KEY, context TEXT, last_updated TIMESTAMP);",
+        "CREATE TABLE IF NOT EXISTS user_profiles (user_id TEXT PRIMARY KEY, profile_data JSONB, last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP);",
+        "CREATE TABLE IF NOT EXISTS reminders (id SERIAL PRIMARY KEY, user_id TEXT NOT NULL, reminder_message TEXT NOT NULL, notify_at TIMESTAMP WITH TIME ZONE NOT NULL, status TEXT DEFAULT 'pending');",
+    ], True),
+    Migration(2, "indexes for hot queries", [
+        # dispatcher / daily summary: เฉพาะแถว pending เรียงตามเวลาแจ้งเตือน
+        create_index_concurrently("idx_reminders_pending_notify_at", "ON reminders (notify_at) WHERE status = 'pending'"),
+        # get_reminders_for_today
+        create_index_concurrently("idx_reminders_user_notify_at", "ON reminders (user_id, notify_at)"),
+        # dashboard / get_chat_history (ORDER BY timestamp DESC) และตัวนับข้อความ 24 ชั่วโมง
+        create_index_concurrently("idx_chat_history_timestamp", "ON chat_history (timestamp)"),
+        # ประวัติรายผู้ใช้ และ get_all_unique_users (loose index scan)
+        create_index_concurrently("idx_chat_history_user_timestamp", "ON chat_history (user_id, timestamp)"),
+        # get_birthday_users
+        create_index_concurrently("idx_user_profiles_birthday", "ON user_profiles ((profile_data->>'วันเกิด'))"),
+    ], False),
+    Migration(3, "session_data.context as jsonb", [
+        "ALTER TABLE session_data ALTER COLUMN context TYPE JSONB USING NULLIF(context, '')::jsonb;",
+    ], True),
+    # ค่า TIMESTAMP เดิมถูกเขียนตามเวลาของ session (TimeZone) จึงแปลงกลับด้วย timezone เดียวกัน
+    Migration(4, "timestamptz columns", [
+        "ALTER TABLE chat_history ALTER COLUMN timestamp TYPE TIMESTAMPTZ USING timestamp AT TIME ZONE current_setting('TimeZone');",
+        "ALTER TABLE session_data ALTER COLUMN last_updated TYPE TIMESTAMPTZ USING last_updated AT TIME ZONE current_setting('TimeZone');",
+        "ALTER TABLE user_profiles ALTER COLUMN last_updated TYPE TIMESTAMPTZ USING last_updated AT TIME ZONE current_setting('TimeZone');",
+    ], True),
+    # webhook event ที่ประมวลผลแล้ว (กัน LINE ส่งซ้ำ); แถวเก่ากว่า TTL ถูกลบเป็นระยะ
+    Migration(5, "processed webhook events", [
+        "CREATE TABLE IF NOT EXISTS processed_events (event_id TEXT PRIMARY KEY, processed_at TIMESTAMPTZ NOT NULL DEFAULT now());",
+        "CREATE INDEX IF NOT EXISTS idx_processed_events_processed_at ON processed_events (processed_at);",
+    ], True),
+    # rollup ต่อผู้ใช้ อัปเดตใน transaction เดียวกับการเขียนแชท (utils.insert_chat_rows / async_db.insert_chat_rows)
+    # ล็อก chat_history ตลอดการแปลง (เขียนตารางใหม่ + backfill users): รันแบบ offline เท่านั้น (ดู partition_chat_history)
+    Migration(6, "monthly chat_history partitions and users rollup", [
+        partition_chat_history,
+        "CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, first_seen TIMESTAMPTZ NOT NULL, last_seen TIMESTAMPTZ NOT NULL, message_count BIGINT NOT NULL DEFAULT 0);",
+        """INSERT INTO users (user_id, first_seen, last_seen, message_count)
+           SELECT user_id, min(timestamp), max(timestamp), count(*) FROM chat_history WHERE user_id IS NOT NULL GROUP BY user_id
+           ON CONFLICT (user_id) DO NOTHING;""",
+        "CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen);",
+    ], True, offline=True),
+    # reminders: claim เปลี่ยนเป็น 'sending' แล้ว commit ก่อนส่ง (utils.claim_due_reminders) + retention ของแถวที่จบแล้ว
+    Migration(7, "reminder claim lease and retention", [
+        "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ;",
+        # แถวที่ process ตายระหว่างส่ง (lease หมดอายุ)
+        create_index_concurrently("idx_reminders_sending_claimed_at", "ON reminders (claimed_at) WHERE status = 'sending'"),
+        # cleanup_finished_reminders
+        create_index_concurrently("idx_reminders_finished_notify_at", "ON reminders (notify_at) WHERE status IN ('sent', 'failed')"),
+    ], False),
+]
+
+def _connect(dsn):
+    if not dsn:
+        raise ConnectionError("DATABASE_URL environment variable is not set.")
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    return conn
+
+def _run_statement(cur, statement):
+    if callable(statement):
+        statement(cur)
+    else:
+        cur.execute(statement)
+
+def applied_versions(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TIMESTAMPTZ NOT NULL DEFAULT now());")
+    cur.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+def migrate(dsn=DATABASE_URL, migrations=MIGRATIONS, allow_offline=ALLOW_OFFLINE_MIGRATIONS):
+    """รัน migration ที่ยังไม่เคยรันตามลำดับ version; คืน list ของ version ที่รันในครั้งนี้
+    หยุดที่ migration offline ตัวแรกที่ยังค้าง ถ้าไม่ได้ allow_offline (และไม่ใช่ฐานข้อมูลใหม่)"""
+    conn = _connect(dsn)
+    ran = []
+    blocked = None
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            try:
+                done = applied_versions(cur)
+                allow_offline = allow_offline or not done
+                for m in sorted(migrations, key=lambda m: m.version):
+                    if m.version in done:
+                        continue
+                    if m.offline and not allow_offline:
+                        print(f"WARNING: pending offline migration {m.version}: {m.name} (this and later migrations were not applied). "
+                              "Stop the app and run: python migrations.py migrate --offline")
+                        blocked = m
+                        break
+                    print(f"Applying migration {m.version}: {m.name}")
+                    if m.transactional:
+                        conn.autocommit = False
+                        try:
+                            for statement in m.statements:
+                                _run_statement(cur, statement)
+                            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (m.version, m.name))
+                            conn.commit()
+                        except Exception:
+                            conn.rollback()
+                            raise
+                        finally:
+                            conn.autocommit = True
+                    else:
+                        for statement in m.statements:
+                            _run_statement(cur, statement)
+                        cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (m.version, m.name))
+                    ran.append(m.version)
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+    finally:
+        conn.close()
+    if blocked is None:
+        print(f"Database schema up to date (applied now: {ran or 'none'}).")
+    else:
+        print(f"Database schema waiting for offline migration {blocked.version} (applied now: {ran or 'none'}).")
+    return ran
+
+# =====================================
+# EXPLAIN check: hot query ต้องใช้ index ไม่ใช่ Seq Scan
+# =====================================
+# ปิด enable_seqscan ในการ EXPLAIN: ถ้ามี index ที่ใช้ได้ planner จะเลือก index เสมอ
+# ถ้ายังเห็น Seq Scan แปลว่าไม่มี index รองรับคิวรีนั้น (ไม่ขึ้นกับขนาดข้อมูลในตาราง)
+
+def _hot_queries():
+    # ใช้ SQL ตัวเดียวกับที่แอปรันจริง (utils) จึงตรวจตรงกับ plan ที่ใช้งานเสมอ; EXPLAIN ไม่ได้รันคำสั่งเขียนจริง
+    # ส่วนที่ไม่มีค่าคงที่คือชิ้นส่วนของคิวรี dashboard (query_dashboard_table / get_dashboard_counts)
+    now = datetime.now(timezone.utc)
+    return [
+        ("load_turn", LOAD_TURN_SQL, ("U0",)),
+        ("claim_due_reminders", CLAIM_DUE_REMINDERS_SQL, claim_params(100, [])),
+        ("finish_reminders", FINISH_REMINDERS_SQL, finish_params([1], [1], [])),
+        ("get_upcoming_reminder_times", UPCOMING_REMINDER_TIMES_SQL, (now, REMINDER_CLAIM_LEASE)),
+        ("cleanup_finished_reminders", DELETE_FINISHED_REMINDERS_SQL, (now - timedelta(days=30),)),
+        ("get_reminders_for_today", REMINDERS_FOR_TODAY_SQL, ("U0", now, now + timedelta(days=1))),
+        ("get_daily_reminder_summaries", DAILY_REMINDER_SUMMARIES_SQL, (now, now + timedelta(days=1))),
+        ("get_birthday_users", BIRTHDAY_USERS_SQL, ("01-01",)),
+        ("claim_webhook_event", CLAIM_WEBHOOK_EVENT_SQL, ("ev0",)),
+        ("release_webhook_event", RELEASE_WEBHOOK_EVENT_SQL, ("ev0",)),
+        ("delete_processed_events_before", DELETE_PROCESSED_EVENTS_SQL, (now,)),
+        ("get_chat_history", CHAT_HISTORY_SQL, (100,)),
+        ("dashboard chats page", "SELECT timestamp, user_id, id FROM chat_history ORDER BY timestamp DESC, id DESC LIMIT 25", ()),
+        ("messages in last 24h", "SELECT count(*) FROM chat_history WHERE timestamp >= now() - interval '24 hours'", ()),
+        ("get_all_unique_users", ALL_UNIQUE_USERS_SQL, ()),
+        ("active users in last 24h", "SELECT count(*) FROM users WHERE last_seen >= now() - interval '24 hours'", ()),
+    ]
+
+def _seq_scans(plan):
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        found.extend(_seq_scans(child))
+    return found
+
+def check_query_plans(dsn=DATABASE_URL):
+    """EXPLAIN ทุก hot query; คืน list ของ (ชื่อคิวรี, ตารางที่ถูก Seq Scan) ที่ไม่ผ่าน"""
+    conn = psycopg2.connect(dsn)
+    failures = []
+    try:
+        with conn.cursor() as cur:
+            for name, sql, params in _hot_queries():
+                cur.execute("SET LOCAL enable_seqscan = off")
+                cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                plan = cur.fetchone()[0]
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                tables = _seq_scans(plan[0]["Plan"])
+                if tables:
+                    failures.append((name, tables))
+                conn.rollback()
+    finally:
+        conn.close()
+    return failures
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    if command == "migrate":
+        migrate(allow_offline=ALLOW_OFFLINE_MIGRATIONS or "--offline" in sys.argv[2:])
+    elif command == "status":
+        conn = _connect(DATABASE_URL)
+        with conn.cursor() as cur:
+            done = applied_versions(cur)
+        conn.close()
+        for m in MIGRATIONS:
+            print(f"{'applied' if m.version in done else 'pending':8} {m.version:3} {m.name}" + (" (offline)" if m.offline else ""))
+    elif command == "check":
+        failures = check_query_plans()
+        for name, tables in failures:
+            print(f"FAIL {name}: sequential scan on {', '.join(tables)}")
+        if failures:
+            sys.exit(1)
+        print(f"OK: all {len(_hot_queries())} hot queries use indexes.")
+    else:
+        sys.exit("usage: python migrations.py [migrate [--offline]|status|check]")
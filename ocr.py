@@ -0,0 +1,201 @@
+# ocr.py
+
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import pytesseract
+from PIL import Image, ImageOps
+
+from metrics import ERRORS
+from workers import LatencyStats
+
+# =====================================
+# OCR รูปภาพจาก LINE บน process pool (ไม่บล็อก webhook thread / GIL)
+# =====================================
+# worker process import แค่โมดูลนี้ (PIL, pytesseract และ metrics / workers ที่ใช้แค่ stdlib) ไม่แตะ utils หรือฐานข้อมูล
+
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "2"))
+OCR_MAX_PENDING = int(os.getenv("OCR_MAX_PENDING", "8"))  # จำนวนรูปที่รอ/กำลัง OCR ได้พร้อมกันสูงสุด
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "256"))
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "60"))
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", "1600"))  # ย่อรูปให้ด้านยาวไม่เกินนี้ก่อน OCR
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+class OcrBusy(Exception):
+    """คิว OCR เต็ม"""
+
+def read_stream(chunks, max_bytes=MAX_IMAGE_BYTES):
+    """อ่านเนื้อหาที่ stream มาจาก LINE (iter_content) เข้าหน่วยความจำโดยไม่ใช้ไฟล์ชั่วคราว"""
+    buffer = io.BytesIO()
+    for chunk in chunks:
+        buffer.write(chunk)
+        if buffer.tell() > max_bytes:
+            raise ValueError(f"image larger than {max_bytes} bytes")
+    return buffer.getvalue()
+
+async def read_stream_async(chunks, max_bytes=MAX_IMAGE_BYTES):
+    """read_stream สำหรับ AsyncLineBotApi (iter_content เป็น async iterator)"""
+    buffer = io.BytesIO()
+    async for chunk in chunks:
+        buffer.write(chunk)
+        if buffer.tell() > max_bytes:
+            raise ValueError(f"image larger than {max_bytes} bytes")
+    return buffer.getvalue()
+
+def _otsu_threshold(histogram):
+    """หาค่า threshold ที่แยกตัวอักษรกับพื้นหลังได้ดีที่สุดจาก histogram ระดับเทา (Otsu)"""
+    total = sum(histogram)
+    sum_all = sum(i * h for i, h in enumerate(histogram))
+    best, best_variance, weight_bg, sum_bg = 127, 0.0, 0, 0
+    for i, h in enumerate(histogram):
+        weight_bg += h
+        if weight_bg == 0:
+            continue
+        weight_fg = total - weight_bg
+        if weight_fg == 0:
+            break
+        sum_bg += i * h
+        mean_bg, mean_fg = sum_bg / weight_bg, (sum_all - sum_bg) / weight_fg
+        variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+        if variance > best_variance:
+            best, best_variance = i, variance
+    return best
+
+def preprocess_image(data, max_side=OCR_MAX_SIDE):
+    """bytes ของรูป -> รูปขาวดำ (หมุนตาม EXIF, ย่อขนาด, ปรับ contrast, binarize)"""
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert("L")
+    img.thumbnail((max_side, max_side))
+    img = ImageOps.autocontrast(img)
+    threshold = _otsu_threshold(img.histogram())
+    return img.point([255 if i > threshold else 0 for i in range(256)], mode="1")
+
+def _ocr_job(data, max_side):
+    """รันใน worker process; คืน (ข้อความ, เวลาที่ใช้ OCR)"""
+    started = time.monotonic()
+    img = preprocess_image(data, max_side)
+    try:
+        text = pytesseract.image_to_string(img, lang='tha+eng').strip()
+    except Exception as e:
+        print(f"OCR error: {e}")
+        text = ""
+    return text, time.monotonic() - started
+
+class OcrPool:
+    """OCR บน ProcessPoolExecutor ที่จำกัดจำนวนงานค้าง (เกินแล้ว submit จะ raise OcrBusy)
+    ผลลัพธ์ถูก cache ด้วย sha256 ของไฟล์ รูปเดิมที่ส่งซ้ำจึงไม่ต้อง OCR ใหม่"""
+    def __init__(self, max_workers=OCR_WORKERS, max_pending=OCR_MAX_PENDING, cache_size=OCR_CACHE_SIZE,
+                 timeout=OCR_TIMEOUT, max_side=OCR_MAX_SIDE):
+        # ห้าม fork: executor สร้าง process ตอน submit ครั้งแรกซึ่งอยู่ใน server ที่มีหลาย thread แล้ว (turn worker, chat writer,
+        # dispatcher) process ลูกอาจได้ lock ที่ถูกถือค้างไว้แล้ว deadlock; forkserver / spawn เริ่ม interpreter ใหม่
+        # ที่ import แค่ __main__ (gunicorn / uvicorn) กับ ocr ไม่ใช่ app.py จึงไม่รัน migration หรือ scheduler ซ้ำ
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self._executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method))
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self.max_pending = max_pending
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self.max_side = max_side
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.processed = 0
+        self.cache_hits = 0
+        self.rejected = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.latency = LatencyStats()  # ตั้งแต่รับรูปจนได้ข้อความ (รวมเวลารอคิว)
+        self.ocr_time = LatencyStats()  # เวลา OCR จริงใน worker
+
+    def submit(self, data, callback):
+        """เริ่ม OCR โดยไม่รอผล; callback(text) ถูกเรียกครั้งเดียวเมื่อได้ข้อความ ("" ถ้าอ่านไม่ได้ ล้มเหลว หรือเกิน timeout)
+        ถ้ารูปอยู่ใน cache จะเรียก callback ทันทีใน thread ที่เรียก ไม่เช่นนั้นจะเรียกจาก thread ภายในของ executor / timer
+        callback จึงต้องทำงานสั้นๆ เท่านั้น (เช่น ส่งผลต่อเข้าคิว) slot คืนเมื่องานใน worker process จบจริง
+        ไม่ใช่เมื่อครบ timeout จำนวนงานที่ใช้ CPU อยู่จึงไม่เกิน max_pending แม้รูปที่ช้าจะหมดเวลาไปแล้ว"""
+        started = time.monotonic()
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            cached = self._cache.get(digest)
+            if cached is not None:
+                self._cache.move_to_end(digest)
+                self.cache_hits += 1
+        if cached is not None:
+            callback(cached)
+            return
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise OcrBusy(f"{self.max_pending} images already waiting for OCR")
+        with self._lock:
+            self.pending += 1
+        delivered = threading.Lock()
+
+        def deliver(text):
+            if delivered.acquire(blocking=False):
+                try:
+                    callback(text)
+                except Exception as e:
+                    print(f"ERROR in OCR callback: {e}")
+
+        def timed_out():
+            print(f"ERROR running OCR: no result after {self.timeout}s")
+            ERRORS.inc("ocr")
+            with self._lock:
+                self.timed_out += 1
+            deliver("")
+
+        def done(future):
+            timer.cancel()
+            self._release()
+            try:
+                text, seconds = future.result()
+            except Exception as e:  # รวมถึง worker process ตายและงานที่ถูกยกเลิกตอนปิดระบบ
+                print(f"ERROR running OCR: {e}")
+                ERRORS.inc("ocr")
+                with self._lock:
+                    self.failed += 1
+                deliver("")
+                return
+            self.ocr_time.observe(seconds)
+            self.latency.observe(time.monotonic() - started)
+            with self._lock:
+                self.processed += 1
+                if text:
+                    self._cache[digest] = text
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+            deliver(text)
+
+        timer = threading.Timer(self.timeout, timed_out)
+        timer.daemon = True
+        try:
+            future = self._executor.submit(_ocr_job, data, self.max_side)
+        except Exception as e:  # pool ถูกปิดหรือเสีย (BrokenProcessPool)
+            self._release()
+            print(f"ERROR running OCR: {e}")
+            ERRORS.inc("ocr")
+            with self._lock:
+                self.failed += 1
+            deliver("")
+            return
+        timer.start()
+        future.add_done_callback(done)
+
+    def _release(self):
+        self._slots.release()
+        with self._lock:
+            self.pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            counters = {"queue_depth": self.pending, "processed": self.processed, "cache_hits": self.cache_hits,
+                        "rejected": self.rejected, "failed": self.failed, "timed_out": self.timed_out, "cache_size": len(self._cache)}
+        return {**counters, "latency_seconds": self.latency.snapshot(), "ocr_seconds": self.ocr_time.snapshot()}
@@ -0,0 +1,152 @@
+# partitions.py
+
+import gzip
+import json
+import os
+import sys
+from datetime import datetime, timezone
+
+import psycopg2
+
+from utils import DATABASE_URL
+
+# =====================================
+# chat_history แบ่ง partition รายเดือน + retention
+# =====================================
+# partition ชื่อ chat_history_pYYYYMM ครอบคลุม [ต้นเดือน, ต้นเดือนถัดไป) ตามเวลา UTC และถูกสร้างล่วงหน้า CHAT_PARTITIONS_AHEAD เดือน
+# chat_history_default รับแถวที่ยังไม่มี partition รองรับ แถวพวกนี้ถูกย้ายเข้า partition ตอนสร้างเดือนนั้น
+# chat_history_legacy คือตารางเดิมก่อน migration 6 (ทุกแถวก่อนเดือนที่ migrate) ถูกจัดการด้วย retention เหมือน partition อื่น
+# retention: partition ที่ทั้งช่วงเก่ากว่า CHAT_RETENTION_MONTHS เดือนเต็มถูกลบ (drop) หรือเขียนออกเป็น JSONL.gz ก่อนลบ (archive)
+
+CHAT_PARTITIONS_AHEAD = int(os.getenv("CHAT_PARTITIONS_AHEAD", "2"))
+CHAT_RETENTION_MONTHS = int(os.getenv("CHAT_RETENTION_MONTHS", "0"))  # 0 = เก็บตลอดไป
+CHAT_RETENTION_MODE = os.getenv("CHAT_RETENTION_MODE", "archive").lower()  # archive | drop
+CHAT_ARCHIVE_DIR = os.getenv("CHAT_ARCHIVE_DIR", "archive")
+ARCHIVE_FETCH_SIZE = 5000
+
+DEFAULT_PARTITION = "chat_history_default"
+LEGACY_PARTITION = "chat_history_legacy"
+
+# ขอบบนของแต่ละ partition อ่านจาก bound ที่ Postgres เก็บไว้ (default partition ได้ NULL)
+PARTITION_BOUNDS_SQL = r"""
+    SELECT c.relname, substring(pg_get_expr(c.relpartbound, c.oid) FROM 'TO \(''([^'']+)''\)')::timestamptz
+    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'chat_history'::regclass
+"""
+
+def month_start(dt, offset=0):
+    """ต้นเดือน (UTC) ของ dt เลื่อนไป offset เดือน"""
+    dt = dt.astimezone(timezone.utc)
+    index = dt.year * 12 + dt.month - 1 + offset
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+def partition_name(start):
+    return f"chat_history_p{start:%Y%m}"
+
+def create_month_partition(cur, start):
+    """สร้าง partition ของเดือนที่เริ่มที่ start ถ้ายังไม่มี คืน True ถ้าสร้างใหม่
+    แถวของเดือนนั้นที่ตกไปอยู่ใน default partition จะถูกย้ายเข้ามาก่อน attach (CREATE ... PARTITION OF จะ error ถ้ามีแถวค้าง)"""
+    name = partition_name(start)
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+    if cur.fetchone()[0]:
+        return False
+    end = month_start(start, 1)
+    cur.execute(f"CREATE TABLE {name} (LIKE chat_history INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    cur.execute(f"""
+        WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE timestamp >= %s AND timestamp < %s RETURNING *)
+        INSERT INTO {name} SELECT * FROM moved
+    """, (start, end))
+    cur.execute(f"ALTER TABLE chat_history ATTACH PARTITION {name} FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')")
+    return True
+
+def ensure_chat_partitions(cur, now=None, ahead=CHAT_PARTITIONS_AHEAD):
+    """สร้าง partition ของเดือนนี้และอีก ahead เดือนข้างหน้า; คืนชื่อ partition ที่สร้างใหม่"""
+    now = now or datetime.now(timezone.utc)
+    created = []
+    for offset in range(ahead + 1):
+        start = month_start(now, offset)
+        if create_month_partition(cur, start):
+            created.append(partition_name(start))
+    return created
+
+def chat_partitions(cur):
+    """[(ชื่อ partition, ขอบบนของช่วงเวลา)] ไม่รวม default partition เรียงจากเก่าไปใหม่"""
+    cur.execute(PARTITION_BOUNDS_SQL)
+    return sorted(((name, upper) for name, upper in cur.fetchall() if upper is not None), key=lambda p: p[1])
+
+def expired_partitions(cur, keep_months, now=None):
+    """partition ที่ทุกแถวเก่ากว่าต้นเดือนของ keep_months เดือนก่อน (เก็บเดือนปัจจุบัน + keep_months เดือนเต็มก่อนหน้า)"""
+    cutoff = month_start(now or datetime.now(timezone.utc), -keep_months)
+    return [name for name, upper in chat_partitions(cur) if upper <= cutoff]
+
+def archive_partition(conn, name, archive_dir=CHAT_ARCHIVE_DIR):
+    """เขียนทุกแถวของ partition เป็น JSON บรรทัดละแถวลง {archive_dir}/{name}.jsonl.gz คืนจำนวนแถว
+    อ่านผ่าน server-side cursor ทีละ ARCHIVE_FETCH_SIZE แถว จึงไม่โหลดทั้งเดือนเข้าหน่วยความจำ
+    เขียนลงไฟล์ .tmp ก่อนแล้วค่อย rename ไฟล์ archive จึงไม่มีทางครึ่งๆ กลางๆ"""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.jsonl.gz")
+    tmp_path = path + ".tmp"
+    count = 0
+    with conn.cursor(name=f"archive_{name}") as cur:
+        cur.itersize = ARCHIVE_FETCH_SIZE
+        cur.execute(f"SELECT id, user_id, user_message, bot_response, timestamp FROM {name} ORDER BY timestamp, id")
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            for row_id, user_id, user_message, bot_response, ts in cur:
+                f.write(json.dumps({"id": row_id, "user_id": user_id, "user_message": user_message,
+                                    "bot_response": bot_response, "timestamp": ts.isoformat()}, ensure_ascii=False) + "\n")
+                count += 1
+    conn.commit()
+    os.replace(tmp_path, path)
+    return count
+
+def apply_retention(conn, keep_months=CHAT_RETENTION_MONTHS, mode=CHAT_RETENTION_MODE, archive_dir=CHAT_ARCHIVE_DIR, now=None):
+    """ลบ (หรือ archive แล้วลบ) partition ที่หมดอายุ คืน list ของ (ชื่อ partition, จำนวนแถวที่ archive หรือ None)"""
+    if keep_months <= 0:
+        return []
+    if mode not in ("archive", "drop"):
+        raise ValueError(f"CHAT_RETENTION_MODE must be 'archive' or 'drop', got {mode!r}")
+    with conn.cursor() as cur:
+        names = expired_partitions(cur, keep_months, now)
+    conn.commit()
+    removed = []
+    for name in names:
+        archived = archive_partition(conn, name, archive_dir) if mode == "archive" else None
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE {name}")
+        conn.commit()
+        print(f"Chat retention: dropped {name}" + (f" after archiving {archived} rows" if archived is not None else ""))
+        removed.append((name, archived))
+    return removed
+
+def run_chat_maintenance(dsn=DATABASE_URL, keep_months=CHAT_RETENTION_MONTHS, mode=CHAT_RETENTION_MODE, archive_dir=CHAT_ARCHIVE_DIR):
+    """งานประจำวันของ leader: สร้าง partition ล่วงหน้าแล้วใช้ retention
+    ใช้ connection ของตัวเอง (ไม่ยืมจาก pool) เพราะ server-side cursor ต้องถือ transaction ไว้ตลอดการ archive"""
+    conn = psycopg2.connect(dsn, application_name="smartbot-maintenance")
+    try:
+        with conn.cursor() as cur:
+            created = ensure_chat_partitions(cur)
+        conn.commit()
+        removed = apply_retention(conn, keep_months, mode, archive_dir)
+    finally:
+        conn.close()
+    result = {"created": created, "removed": [name for name, _ in removed],
+              "archived_rows": sum(rows or 0 for _, rows in removed)}
+    print(f"Chat partition maintenance finished: {result}")
+    return result
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "maintain"
+    if command == "maintain":
+        run_chat_maintenance()
+    elif command == "status":
+        conn = psycopg2.connect(DATABASE_URL)
+        with conn.cursor() as cur:
+            for name, upper in chat_partitions(cur):
+                cur.execute(f"SELECT count(*) FROM {name}")
+                print(f"{name:28} until {upper.isoformat()}  rows={cur.fetchone()[0]}")
+            cur.execute(f"SELECT count(*) FROM {DEFAULT_PARTITION}")
+            print(f"{DEFAULT_PARTITION:28} (default)  rows={cur.fetchone()[0]}")
+        conn.close()
+    else:
+        print(f"Unknown command {command!r}; use maintain or status")
+        sys.exit(2)
@@ -0,0 +1,126 @@
+# ratelimit.py
+
+import asyncio
+import threading
+import time
+
+# =====================================
+# Rate limiting / Circuit breaker ที่ใช้ร่วมกันระหว่าง client ภายนอก (Gemini, LINE)
+# =====================================
+
+class TokenBucket:
+    """Token bucket แบบ thread-safe: เติม `rate` token ต่อวินาที เก็บได้สูงสุด `burst` token"""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1.0):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1.0, timeout=None):
+        """รอจนได้ token; คืน False ถ้ารอเกิน timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+class AsyncTokenBucket(TokenBucket):
+    """TokenBucket สำหรับ asyncio: acquire() รอด้วย asyncio.sleep แทนการบล็อก thread"""
+    async def acquire(self, tokens=1.0, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            await asyncio.sleep(wait)
+
+class CircuitOpen(Exception):
+    """Circuit breaker เปิดอยู่ (ปลายทางล่ม) จึงไม่ส่ง request"""
+
+class CircuitBreaker:
+    """เปิดวงจรเมื่อล้มเหลวติดกัน `failure_threshold` ครั้ง แล้วรอ `reset_timeout` วินาที
+    ก่อนยอมให้ request ทดลอง (half-open) ผ่านไปทีละหนึ่ง"""
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self.opened_count = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def before_call(self):
+        """เรียกก่อนส่ง request; raise CircuitOpen ถ้ายังไม่ควรส่ง"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            self.rejected += 1
+            raise CircuitOpen("circuit is open")
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """ปล่อยสิทธิ์ request ทดลองโดยไม่นับผล ใช้เมื่อ request ไม่ได้ออกไปถึงปลายทาง (เช่นติด limit ฝั่งเราเอง)"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.opened_count += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
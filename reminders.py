@@ -0,0 +1,386 @@
+# reminders.py
+
+import asyncio
+import heapq
+import os
+import select
+import threading
+import time
+import traceback
+from datetime import datetime, timezone, timedelta
+
+import psycopg2
+
+from messaging import is_permanent_error
+from metrics import ERRORS, JOB_SECONDS
+from utils import (DATABASE_URL, REMINDER_CHANNEL, add_reminder_listener, claim_due_reminders, finish_reminders,
+                   get_upcoming_reminder_times)
+from workers import LatencyStats
+
+# =====================================
+# Reminder dispatcher: ตื่นตรงเวลาที่การแจ้งเตือนถัดไปถึงกำหนด แทนการ poll ทุกนาที
+# =====================================
+
+class DueTimes:
+    """heap ของเวลาที่ต้องตื่นมาส่ง (epoch seconds) โดยไม่เก็บเวลาซ้ำ (thread-safe)"""
+    def __init__(self):
+        self._heap = []
+        self._scheduled = set()
+        self._lock = threading.Lock()
+
+    def add(self, ts):
+        """คืน True ถ้าเวลานี้กลายเป็นเวลาที่เร็วที่สุด (ผู้เรียกต้องปลุก loop)"""
+        with self._lock:
+            if ts in self._scheduled:
+                return False
+            self._scheduled.add(ts)
+            is_earliest = not self._heap or ts < self._heap[0]
+            heapq.heappush(self._heap, ts)
+        return is_earliest
+
+    def pop_due(self, now):
+        due = False
+        with self._lock:
+            while self._heap and self._heap[0] <= now:
+                self._scheduled.discard(heapq.heappop(self._heap))
+                due = True
+        return due
+
+    def next_due(self):
+        with self._lock:
+            return self._heap[0] if self._heap else None
+
+    def clear(self):
+        with self._lock:
+            self._heap.clear()
+            self._scheduled.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+def classify_results(rows, results, retry_ids, lag):
+    """แยกผลการส่งของแถวที่ claim มาเป็น (sent_ids, failed_ids); แถวที่ควรลองใหม่ถูกเพิ่มเข้า retry_ids"""
+    sent_ids, failed_ids = [], []
+    now = datetime.now(timezone.utc)
+    for (r_id, _, _, notify_at), (_, error) in zip(rows, results):
+        if error is None:
+            sent_ids.append(r_id)
+            lag.observe((now - notify_at).total_seconds())
+        elif is_permanent_error(error):
+            print(f"ERROR sending reminder {r_id}, giving up: {error}")
+            failed_ids.append(r_id)
+        else:
+            print(f"ERROR sending reminder {r_id}, will retry: {error}")
+            retry_ids.append(r_id)
+    return sent_ids, failed_ids
+
+class ReminderDispatcher:
+    """เก็บเวลาแจ้งเตือนที่กำลังจะถึงไว้ใน heap (ป้อนจาก create_reminder ใน process เดียวกัน
+    และจาก LISTEN/NOTIFY ของ Postgres สำหรับ process อื่น) แล้วตื่นมาส่งเมื่อถึงเวลาพอดี
+    การส่งใช้ claim_due_reminders (SKIP LOCKED แล้ว commit สถานะ 'sending') จึงรันหลาย process พร้อมกันได้โดยไม่ส่งซ้ำ
+    และไม่ถือ connection ของ pool ไว้ระหว่างรอ LINE"""
+    def __init__(self, push_pool, build_messages, dsn=DATABASE_URL, batch_size=100,
+                 resync_interval=300.0, retry_delay=60.0, reconnect_delay=5.0):
+        self.push_pool = push_pool
+        self.build_messages = build_messages
+        self.dsn = dsn
+        self.batch_size = batch_size
+        self.resync_interval = resync_interval
+        self.retry_delay = retry_delay
+        self.reconnect_delay = reconnect_delay
+        self._due = DueTimes()
+        self._wake_r, self._wake_w = os.pipe()
+        self._listen_conn = None
+        self._thread = None
+        self._stopping = False
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.lag = LatencyStats()
+        add_reminder_listener(self.schedule)
+
+    def start(self):
+        """เริ่ม (หรือเริ่มใหม่หลัง stop) ได้; รายการที่ค้างจะถูกโหลดจากฐานข้อมูลตอนเชื่อมต่อ listener"""
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="reminder-dispatcher", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10.0):
+        self._stopping = True
+        self._wake()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self._close_listener()
+        self._due.clear()
+
+    def schedule(self, notify_at):
+        """เพิ่มเวลาที่ต้องตื่นมาส่ง (datetime หรือ epoch seconds); ไม่ทำอะไรถ้า dispatcher ไม่ได้รันอยู่ใน process นี้"""
+        if self._thread is None:
+            return
+        ts = notify_at.timestamp() if isinstance(notify_at, datetime) else float(notify_at)
+        if self._due.add(ts):
+            self._wake()
+
+    def _wake(self):
+        try: os.write(self._wake_w, b"x")
+        except OSError: pass
+
+    # --- LISTEN/NOTIFY ---
+    def _ensure_listener(self):
+        if self._listen_conn is not None:
+            return True
+        try:
+            conn = psycopg2.connect(self.dsn, keepalives_idle=60, keepalives_interval=10, keepalives_count=5)
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {REMINDER_CHANNEL};")
+            self._listen_conn = conn
+        except Exception as e:
+            print(f"ERROR connecting reminder listener: {e}")
+            return False
+        # อาจพลาด NOTIFY ระหว่างที่ไม่ได้เชื่อมต่อ จึงโหลดรายการใหม่ทั้งหมด
+        self._resync()
+        return True
+
+    def _close_listener(self):
+        if self._listen_conn is not None:
+            try: self._listen_conn.close()
+            except Exception: pass
+            self._listen_conn = None
+
+    def _drain_notifications(self):
+        try:
+            self._listen_conn.poll()
+        except Exception as e:
+            print(f"Reminder listener lost: {e}")
+            self._close_listener()
+            return
+        while self._listen_conn.notifies:
+            notify = self._listen_conn.notifies.pop(0)
+            try: self.schedule(float(notify.payload))
+            except ValueError: print(f"Ignoring malformed reminder notification: {notify.payload!r}")
+
+    def _resync(self):
+        try:
+            horizon = datetime.now(timezone.utc) + timedelta(seconds=self.resync_interval * 2)
+            for notify_at in get_upcoming_reminder_times(horizon):
+                self.schedule(notify_at)
+        except Exception as e:
+            print(f"ERROR loading upcoming reminders: {e}")
+
+    # --- Main loop ---
+    def _run(self):
+        next_resync = time.time() + self.resync_interval
+        while not self._stopping:
+            listening = self._ensure_listener()
+            now = time.time()
+            deadline = next_resync
+            next_due = self._due.next_due()
+            if next_due is not None:
+                deadline = min(deadline, next_due)
+            timeout = max(0.0, deadline - now)
+            if not listening:
+                timeout = min(timeout, self.reconnect_delay)
+            fds = [self._wake_r] + ([self._listen_conn] if self._listen_conn is not None else [])
+            try:
+                readable, _, _ = select.select(fds, [], [], timeout)
+            except (OSError, ValueError) as e:
+                print(f"Reminder listener select failed: {e}")
+                self._close_listener()
+                readable = []
+            if self._wake_r in readable:
+                os.read(self._wake_r, 4096)
+            if self._listen_conn is not None and self._listen_conn in readable:
+                self._drain_notifications()
+            if self._stopping:
+                break
+            now = time.time()
+            if now >= next_resync:
+                self._resync()
+                next_resync = now + self.resync_interval
+            if self._due.pop_due(now):
+                try:
+                    with JOB_SECONDS.time("reminder_dispatch"):
+                        self.dispatch_due()
+                except Exception as e:
+                    ERRORS.inc("reminder_dispatch")
+                    print(f"ERROR dispatching reminders: {e}\n{traceback.format_exc()}")
+                    self.schedule(time.time() + self.retry_delay)
+
+    def dispatch_due(self):
+        """ส่งการแจ้งเตือนที่ถึงเวลาแล้วทั้งหมดเป็น batch; คืนจำนวนที่ส่งสำเร็จ"""
+        total_sent = 0
+        retry_ids = []
+        while True:
+            rows = claim_due_reminders(self.batch_size, exclude_ids=retry_ids)
+            if not rows:
+                break
+            claimed_ids = [r_id for r_id, _, _, _ in rows]
+            try:
+                results = self.push_pool.push_many((user_id, self.build_messages(message)) for _, user_id, message, _ in rows)
+            except Exception:
+                finish_reminders(claimed_ids, [])
+                raise
+            sent_ids, failed_ids = classify_results(rows, results, retry_ids, self.lag)
+            finish_reminders(claimed_ids, sent_ids, failed_ids)
+            self.sent += len(sent_ids)
+            self.failed += len(failed_ids)
+            total_sent += len(sent_ids)
+            if len(rows) < self.batch_size:
+                break
+        if retry_ids:
+            self.retried += len(retry_ids)
+            self.schedule(time.time() + self.retry_delay)
+        return total_sent
+
+    def stats(self):
+        next_due = self._due.next_due()
+        return {
+            "sent": self.sent, "failed": self.failed, "retried": self.retried,
+            "scheduled": len(self._due),
+            "next_due_in": round(next_due - time.time(), 3) if next_due is not None else None,
+            "listening": self._listen_conn is not None,
+            "lag_seconds": self.lag.snapshot(),
+        }
+
+class AsyncReminderDispatcher:
+    """ReminderDispatcher สำหรับโหมด asyncio: รันเป็น task บน event loop เดียวกับ webhook
+    db คือโมดูล async_db (LISTEN ผ่าน db.listen, claim / finish แบบเดียวกับ ReminderDispatcher) และส่งด้วย AsyncPushPool"""
+    def __init__(self, db, push_pool, build_messages, batch_size=100,
+                 resync_interval=300.0, retry_delay=60.0, reconnect_delay=5.0):
+        self.db = db
+        self.push_pool = push_pool
+        self.build_messages = build_messages
+        self.batch_size = batch_size
+        self.resync_interval = resync_interval
+        self.retry_delay = retry_delay
+        self.reconnect_delay = reconnect_delay
+        self._due = DueTimes()
+        self._wake = None
+        self._listen_conn = None
+        self._task = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.lag = LatencyStats()
+
+    def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self._close_listener()
+        self._due.clear()
+
+    def schedule(self, notify_at):
+        if self._task is None:
+            return
+        ts = notify_at.timestamp() if isinstance(notify_at, datetime) else float(notify_at)
+        if self._due.add(ts):
+            self._wake.set()
+
+    def _on_notify(self, conn, pid, channel, payload):
+        try: self.schedule(float(payload))
+        except ValueError: print(f"Ignoring malformed reminder notification: {payload!r}")
+
+    async def _ensure_listener(self):
+        if self._listen_conn is not None and not self._listen_conn.is_closed():
+            return True
+        self._listen_conn = None
+        try:
+            self._listen_conn = await self.db.listen(REMINDER_CHANNEL, self._on_notify)
+        except Exception as e:
+            print(f"ERROR connecting reminder listener: {e}")
+            return False
+        await self._resync()
+        return True
+
+    async def _close_listener(self):
+        if self._listen_conn is not None:
+            try: await self._listen_conn.close()
+            except Exception: pass
+            self._listen_conn = None
+
+    async def _resync(self):
+        try:
+            horizon = datetime.now(timezone.utc) + timedelta(seconds=self.resync_interval * 2)
+            for notify_at in await self.db.get_upcoming_reminder_times(horizon):
+                self.schedule(notify_at)
+        except Exception as e:
+            print(f"ERROR loading upcoming reminders: {e}")
+
+    async def _run(self):
+        next_resync = time.time() + self.resync_interval
+        while True:
+            self._wake.clear()
+            listening = await self._ensure_listener()
+            deadline = next_resync
+            next_due = self._due.next_due()
+            if next_due is not None:
+                deadline = min(deadline, next_due)
+            timeout = max(0.0, deadline - time.time())
+            if not listening:
+                timeout = min(timeout, self.reconnect_delay)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            now = time.time()
+            if now >= next_resync:
+                await self._resync()
+                next_resync = now + self.resync_interval
+            if self._due.pop_due(now):
+                try:
+                    with JOB_SECONDS.time("reminder_dispatch"):
+                        await self.dispatch_due()
+                except Exception as e:
+                    ERRORS.inc("reminder_dispatch")
+                    print(f"ERROR dispatching reminders: {e}\n{traceback.format_exc()}")
+                    self.schedule(time.time() + self.retry_delay)
+
+    async def dispatch_due(self):
+        total_sent = 0
+        retry_ids = []
+        while True:
+            rows = await self.db.claim_due_reminders(self.batch_size, exclude_ids=retry_ids)
+            if not rows:
+                break
+            claimed_ids = [r_id for r_id, _, _, _ in rows]
+            try:
+                results = await self.push_pool.push_many((user_id, self.build_messages(message)) for _, user_id, message, _ in rows)
+            except BaseException:
+                await asyncio.shield(self.db.finish_reminders(claimed_ids, []))
+                raise
+            sent_ids, failed_ids = classify_results(rows, results, retry_ids, self.lag)
+            await self.db.finish_reminders(claimed_ids, sent_ids, failed_ids)
+            self.sent += len(sent_ids)
+            self.failed += len(failed_ids)
+            total_sent += len(sent_ids)
+            if len(rows) < self.batch_size:
+                break
+        if retry_ids:
+            self.retried += len(retry_ids)
+            self.schedule(time.time() + self.retry_delay)
+        return total_sent
+
+    def stats(self):
+        next_due = self._due.next_due()
+        return {
+            "sent": self.sent, "failed": self.failed, "retried": self.retried,
+            "scheduled": len(self._due),
+            "next_due_in": round(next_due - time.time(), 3) if next_due is not None else None,
+            "listening": self._listen_conn is not None and not self._listen_conn.is_closed(),
+            "lag_seconds": self.lag.snapshot(),
+        }
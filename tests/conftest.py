@@ -0,0 +1,7 @@
+# tests/conftest.py
+
+import os
+import sys
+
+# โมดูลของแอปอยู่ที่ root ของ repo (ไม่ใช่ package) จึงเพิ่ม root เข้า sys.path ก่อน import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,131 @@
+# tests/test_chatlog.py
+
+import asyncio
+import time
+
+import psycopg2
+import pytest
+
+import chatlog
+from chatlog import AsyncChatLogWriter, ChatLogWriter
+
+POISON = "bad\x00row"  # Postgres ไม่รับ NUL ใน TEXT -> DataError ทั้ง batch
+
+class FakeDatabase:
+    """แทน insert_chat_rows: ทั้ง batch ล้มเหลวถ้ามีแถวเสีย (เหมือน INSERT เดียว) และล้มเหลวแบบเชื่อมต่อไม่ได้ตาม outages"""
+    def __init__(self, outages=0):
+        self.outages = outages
+        self.rows = []
+        self.calls = 0
+
+    def insert(self, rows):
+        self.calls += 1
+        if self.outages:
+            self.outages -= 1
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        if any(row[1] == POISON for row in rows):
+            raise psycopg2.DataError("A string literal cannot contain NUL (0x00) characters.")
+        self.rows.extend(rows)
+
+    async def insert_async(self, rows):
+        self.insert(rows)
+
+def messages(n, poison_at=()):
+    return [POISON if i in poison_at else f"m{i}" for i in range(n)]
+
+def log_all(writer, texts):
+    for i, text in enumerate(texts):
+        assert writer.log(f"U{i}", text, "reply")
+
+def settled(writer, total):
+    """ทุกแถวถูกเขียนหรือทิ้งแล้ว (stop() ระหว่างฐานข้อมูลล่มจะทิ้งแถวแทนการ retry จึงต้องรอก่อนสั่งหยุด)"""
+    stats = writer.stats()
+    return stats["written"] + stats["rejected"] == total
+
+def written(db):
+    return sorted(row[1] for row in db.rows)
+
+def good(texts):
+    return sorted(t for t in texts if t != POISON)
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDatabase()
+    monkeypatch.setattr(chatlog, "insert_chat_rows", fake.insert)
+    return fake
+
+@pytest.mark.parametrize("n, poison_at", [(1, {0}), (50, {0}), (50, {49}), (50, {17}), (64, {3, 40}), (7, {0, 1, 2, 3, 4, 5, 6})])
+def test_bad_rows_are_dropped_alone(db, n, poison_at):
+    texts = messages(n, poison_at)
+    writer = ChatLogWriter(batch_size=n)
+    log_all(writer, texts)
+    writer.flush()
+    assert written(db) == good(texts)  # ทุกแถวที่ดีถูกเขียนครั้งเดียว ไม่ซ้ำ
+    stats = writer.stats()
+    assert stats["rejected"] == len(poison_at)
+    assert stats["written"] == n - len(poison_at)
+    assert stats["dropped"] == 0
+
+def test_connection_errors_retry_the_same_batch(db):
+    db.outages = 3
+    texts = messages(20)
+    writer = ChatLogWriter(batch_size=20, max_backoff=0.01)
+    log_all(writer, texts)
+    writer.flush()
+    assert written(db) == good(texts)
+    stats = writer.stats()
+    assert stats["flush_errors"] == 3
+    assert stats["rejected"] == 0 and stats["dropped"] == 0
+    assert stats["batches"] == 1
+
+def test_outage_then_bad_row(db):
+    db.outages = 2
+    texts = messages(30, {11})
+    writer = ChatLogWriter(batch_size=30, max_backoff=0.01)
+    log_all(writer, texts)
+    writer.flush()
+    assert written(db) == good(texts)
+    assert writer.stats()["rejected"] == 1
+
+def test_stop_during_outage_counts_dropped_without_writing(db):
+    db.outages = 10**6
+    texts = messages(25)
+    writer = ChatLogWriter(batch_size=10)
+    log_all(writer, texts)
+    writer.stop()  # ไม่มี thread: flush ครั้งสุดท้ายขณะสั่งหยุดแล้ว จึงไม่ retry
+    assert db.rows == []
+    assert writer.stats()["dropped"] == 25  # ทั้ง batch ที่ล้มเหลวและแถวที่ยังค้างในคิว
+    assert writer.stats()["depth"] == 0
+
+def test_background_thread_writes_everything_once(db):
+    db.outages = 2
+    texts = messages(300, {5, 150, 299})
+    writer = ChatLogWriter(batch_size=64, flush_interval=0.05, max_backoff=0.01)
+    writer.start()
+    log_all(writer, texts)
+    deadline = time.monotonic() + 10
+    while not settled(writer, len(texts)) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.stop()
+    assert written(db) == good(texts)
+    assert writer.stats()["rejected"] == 3
+
+def test_async_writer_splits_and_retries():
+    db = FakeDatabase(outages=2)
+    texts = messages(100, {0, 63})
+
+    async def run():
+        writer = AsyncChatLogWriter(db.insert_async, lambda e: isinstance(e, psycopg2.OperationalError),
+                                    batch_size=100, flush_interval=0.05, max_backoff=0.01)
+        writer.start()
+        log_all(writer, texts)
+        deadline = time.monotonic() + 10
+        while not settled(writer, len(texts)) and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await writer.stop()
+        return writer.stats()
+
+    stats = asyncio.run(run())
+    assert written(db) == good(texts)
+    assert stats["rejected"] == 2
+    assert stats["dropped"] == 0
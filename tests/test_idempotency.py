@@ -0,0 +1,86 @@
+# tests/test_idempotency.py
+
+import asyncio
+
+import psycopg2
+import pytest
+
+import idempotency
+from idempotency import AsyncEventDeduplicator, EventDeduplicator
+
+class FakeProcessedEvents:
+    """แทนตาราง processed_events: claim = INSERT ... ON CONFLICT DO NOTHING, release = DELETE ตาม event_id"""
+    def __init__(self):
+        self.ids = set()
+        self.down = False
+
+    def claim(self, event_id):
+        if self.down:
+            raise psycopg2.OperationalError("could not connect to server")
+        if event_id in self.ids:
+            return False
+        self.ids.add(event_id)
+        return True
+
+    def release(self, event_id):
+        if self.down:
+            raise psycopg2.OperationalError("could not connect to server")
+        self.ids.discard(event_id)
+
+    async def claim_async(self, event_id):
+        return self.claim(event_id)
+
+    async def release_async(self, event_id):
+        self.release(event_id)
+
+@pytest.fixture
+def table(monkeypatch):
+    fake = FakeProcessedEvents()
+    monkeypatch.setattr(idempotency, "claim_webhook_event", fake.claim)
+    monkeypatch.setattr(idempotency, "release_webhook_event", fake.release)
+    return fake
+
+def test_redelivery_is_dropped(table):
+    dedup = EventDeduplicator()
+    assert dedup.claim("ev1")
+    assert not dedup.claim("ev1")              # LRU ในหน่วยความจำ
+    assert not EventDeduplicator().claim("ev1")  # process อื่น: ตาราง processed_events
+    assert dedup.stats()["duplicates_memory"] == 1
+
+def test_released_event_is_processed_again(table):
+    # turn ล้มเหลวก่อน commit: ครั้งที่ LINE ส่งซ้ำต้องได้ทำใหม่ทั้งใน process เดิมและ process อื่น
+    dedup, other = EventDeduplicator(), EventDeduplicator()
+    assert dedup.claim("ev1")
+    dedup.release("ev1")
+    assert "ev1" not in table.ids
+    assert other.claim("ev1")
+    other.release("ev1")
+    assert dedup.claim("ev1")
+    assert not dedup.claim("ev1")
+    assert dedup.stats()["released"] == 1
+
+def test_release_without_database_still_forgets_locally(table):
+    dedup = EventDeduplicator()
+    assert dedup.claim("ev1")
+    table.down = True
+    dedup.release("ev1")
+    assert dedup.stats()["db_errors"] == 1
+    assert dedup.claim("ev1")  # fail open เหมือน claim
+
+def test_missing_event_id_is_always_processed(table):
+    dedup = EventDeduplicator()
+    assert dedup.claim(None) and dedup.claim(None)
+    dedup.release(None)
+    assert dedup.stats()["released"] == 0
+
+def test_async_release():
+    table = FakeProcessedEvents()
+    dedup = AsyncEventDeduplicator(table.claim_async, table.release_async, None)
+
+    async def run():
+        first = await dedup.claim("ev1")
+        duplicate = await dedup.claim("ev1")
+        await dedup.release("ev1")
+        return first, duplicate, await dedup.claim("ev1")
+
+    assert asyncio.run(run()) == (True, False, True)
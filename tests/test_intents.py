@@ -0,0 +1,101 @@
+# tests/test_intents.py
+
+from datetime import datetime
+
+import pytest
+import pytz
+
+from intents import IntentRouter
+from utils import Turn
+
+bangkok_tz = pytz.timezone('Asia/Bangkok')
+# วันเสาร์ 17 ต.ค. 2026 10:00 น.
+NOW = bangkok_tz.localize(datetime(2026, 10, 17, 10, 0))
+
+def route(text, profile=None):
+    turn = Turn("U1", dict(profile or {}), None)
+    return IntentRouter(bangkok_tz).route(turn, text, NOW), turn
+
+@pytest.mark.parametrize("text", ["/reset", "ล้างความจำ", " Reset ", "clear"])
+def test_reset_clears_session_only(text):
+    result, turn = route(text, {"ชื่อเล่น": "บี"})
+    assert result.intent == "reset"
+    assert not result.log_chat
+    assert turn._clear_session and not turn._delete_profile
+
+def test_forget_me_deletes_profile():
+    result, turn = route("/forgetme", {"ชื่อเล่น": "บี"})
+    assert result.intent == "forget_me"
+    assert turn._delete_profile
+
+@pytest.mark.parametrize("text", ["ลืมวันเกิดฉัน", "ลืมวันเกิดของผมไปเลย", "ช่วยลืมวันเกิดด้วยนะ", "forget my วันเกิด"])
+def test_forget_key(text):
+    result, turn = route(text, {"วันเกิด": "01-01", "ชื่อเล่น": "บี"})
+    assert result.intent == "forget_key"
+    assert turn._profile_delete_keys == ["วันเกิด"]
+
+@pytest.mark.parametrize("text", ["ลืมของโปรดฉัน", "ลืมpending_actionไป"])
+def test_forget_unknown_or_internal_key_falls_through(text):
+    result, turn = route(text, {"วันเกิด": "01-01", "pending_action": "set_reminder_message"})
+    assert result is None
+    assert not turn.has_writes
+
+def test_show_profile_hides_pending_keys():
+    result, _ = route("/profile", {"ชื่อเล่น": "บี", "pending_action": "set_reminder_message", "pending_data": {}})
+    assert result.intent == "show_profile"
+    assert "- ชื่อเล่น: บี" in result.reply
+    assert "pending" not in result.reply
+
+@pytest.mark.parametrize("text", ["/profile", "จำอะไรเกี่ยวกับฉันได้บ้าง?"])
+def test_show_empty_profile(text):
+    result, turn = route(text)
+    assert result.intent == "show_profile"
+    assert "ยังไม่มีข้อมูล" in result.reply
+    assert not turn.has_writes
+
+def test_pending_reminder_uses_saved_time():
+    profile = {"pending_action": "set_reminder_message", "pending_data": {"time": "2026-10-18 09:00:00"}}
+    result, turn = route("ให้ประชุมทีมนะ", profile)
+    assert result.intent == "pending_reminder"
+    assert turn._reminders == [("ประชุมทีม", bangkok_tz.localize(datetime(2026, 10, 18, 9)))]
+    assert sorted(turn._profile_delete_keys) == sorted(Turn.PENDING_KEYS)
+
+def test_pending_reminder_with_bad_time_clears_pending():
+    profile = {"pending_action": "set_reminder_message", "pending_data": {"time": "not a time"}}
+    result, turn = route("ประชุมทีม", profile)
+    assert result.intent == "pending_reminder"
+    assert turn._reminders == []
+    assert sorted(turn._profile_delete_keys) == sorted(Turn.PENDING_KEYS)
+
+def test_pending_reminder_takes_priority_over_commands():
+    # ข้อความถัดจาก "จะให้เตือนเรื่องอะไรดีคะ?" เป็นข้อความของการแจ้งเตือนเสมอ แม้หน้าตาเหมือนคำสั่งอื่น
+    profile = {"pending_action": "set_reminder_message", "pending_data": {"time": "2026-10-18 09:00:00"}}
+    result, turn = route("ลืมวันเกิด", {**profile, "วันเกิด": "01-01"})
+    assert result.intent == "pending_reminder"
+    assert turn._reminders[0][0] == "ลืมวันเกิด"
+
+@pytest.mark.parametrize("text, message, when", [
+    ("เตือนฉันพรุ่งนี้ 9 โมงให้ประชุม", "ประชุม", datetime(2026, 10, 18, 9)),
+    ("เตือนพรุ่งนี้บ่าย 3 ไปธนาคาร", "ไปธนาคาร", datetime(2026, 10, 18, 15)),
+    ("remind me tomorrow at 9am to call mom", "call mom", datetime(2026, 10, 18, 9)),
+])
+def test_reminder(text, message, when):
+    result, turn = route(text)
+    assert result.intent == "reminder"
+    assert turn._reminders == [(message, bangkok_tz.localize(when))]
+
+def test_reminder_without_message_asks_and_saves_pending():
+    result, turn = route("เตือนพรุ่งนี้ 9 โมง")
+    assert result.intent == "reminder_pending"
+    assert turn._profile_patch == {"pending_action": "set_reminder_message", "pending_data": {"time": "2026-10-18 09:00:00"}}
+
+@pytest.mark.parametrize("text", [
+    "เตือนทุกวัน 8 โมง กินยา",     # แจ้งเตือนซ้ำ: ให้ Gemini จัดการ
+    "เตือนฉัน 6 โมง กินยา",        # เวลากำกวม
+    "เตือน 30 ก.พ. 9 โมง กินยา",   # วันที่ใช้ไม่ได้
+    "สวัสดีค่ะ",
+])
+def test_falls_through_to_gemini(text):
+    result, turn = route(text)
+    assert result is None
+    assert not turn.has_writes
@@ -0,0 +1,69 @@
+# tests/test_metrics.py
+
+import json
+import os
+
+import pytest
+
+import metrics
+from metrics import ERRORS, ARCHIVE_FILE, mark_process_dead, render_metrics
+
+DEAD_PID = 2 ** 22 + 7  # เกิน pid_max ปกติ จึงไม่มี process นี้อยู่จริง
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_MULTIPROC_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "_export", {"pid": None, "path": None})
+    monkeypatch.setattr(metrics, "_pid_alive", lambda pid: pid in (os.getpid(), DEAD_PID))  # pid ถูกนำไปใช้ใหม่แล้ว
+    return tmp_path
+
+def write_worker(directory, pid, errors, leader, started=1):
+    state = {"pid": pid, "metrics": {
+        "smartbot_errors": [[["webhook_turn"], errors]],
+        "smartbot_db_query_seconds": [[["load_turn"], [[1] + [0] * len(metrics.DEFAULT_BUCKETS), 0.001, 1]]],
+        "smartbot_scheduler_leader": [[[], leader]],
+    }}
+    (directory / f"metrics-{pid}-{started}.json").write_text(json.dumps(state))
+
+def own_errors():
+    """ค่าของ process ที่รันเทส (render รวมไฟล์ของตัวเองด้วย)"""
+    return dict(ERRORS.snapshot()).get(("webhook_turn",), 0)
+
+def test_dead_worker_is_folded_into_archive(metrics_dir):
+    write_worker(metrics_dir, DEAD_PID, errors=3, leader=1)
+    base = own_errors()
+    mark_process_dead(DEAD_PID)
+    assert sorted(os.listdir(metrics_dir)) == [ARCHIVE_FILE]
+    text = render_metrics()
+    # counter / histogram ยังอยู่ (ไม่ลดลง) แต่ gauge ของ pid ที่ตายแล้วหายไปแม้ pid ถูกนำไปใช้ใหม่
+    assert f'smartbot_errors_total{{component="webhook_turn"}} {base + 3}' in text
+    assert 'smartbot_db_query_seconds_count{function="load_turn"}' in text
+    assert f'pid="{DEAD_PID}"' not in text
+
+def test_archive_accumulates_across_deaths(metrics_dir):
+    write_worker(metrics_dir, DEAD_PID, errors=3, leader=0, started=1)
+    mark_process_dead(DEAD_PID)
+    write_worker(metrics_dir, DEAD_PID, errors=4, leader=0, started=2)  # worker ใหม่ได้ pid เดิม
+    mark_process_dead(DEAD_PID)
+    archive = json.loads((metrics_dir / ARCHIVE_FILE).read_text())
+    assert archive["pid"] is None
+    assert archive["metrics"]["smartbot_errors"] == [[["webhook_turn"], 7]]
+    assert archive["metrics"]["smartbot_db_query_seconds"][0][1][2] == 2
+    assert "smartbot_scheduler_leader" not in archive["metrics"]
+
+def test_file_left_behind_after_fold_is_not_double_counted(metrics_dir):
+    # master รวมเข้า archive แล้วแต่ยังลบไฟล์ไม่ทัน (scrape มาระหว่างนั้น) หรือลบไม่สำเร็จ
+    write_worker(metrics_dir, DEAD_PID, errors=5, leader=0)
+    mark_process_dead(DEAD_PID)
+    write_worker(metrics_dir, DEAD_PID, errors=5, leader=0)
+    base = own_errors()
+    assert f'smartbot_errors_total{{component="webhook_turn"}} {base + 5}' in render_metrics()
+    mark_process_dead(DEAD_PID)
+    assert json.loads((metrics_dir / ARCHIVE_FILE).read_text())["metrics"]["smartbot_errors"] == [[["webhook_turn"], 5]]
+
+def test_other_pids_are_untouched(metrics_dir):
+    write_worker(metrics_dir, DEAD_PID, errors=1, leader=1)
+    mark_process_dead(DEAD_PID + 1)
+    assert sorted(os.listdir(metrics_dir)) == [f"metrics-{DEAD_PID}-1.json"]
+    base = own_errors()
+    assert f'smartbot_errors_total{{component="webhook_turn"}} {base + 1}' in render_metrics()
@@ -0,0 +1,141 @@
+# tests/test_thai_datetime.py
+
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from thai_datetime import normalize, parse_datetime
+
+bangkok_tz = pytz.timezone('Asia/Bangkok')
+# วันเสาร์ 17 ต.ค. 2026 10:00 น.
+NOW = bangkok_tz.localize(datetime(2026, 10, 17, 10, 0))
+
+def at(year, month, day, hour, minute=0):
+    return bangkok_tz.localize(datetime(year, month, day, hour, minute))
+
+@pytest.mark.parametrize("text, expected", [
+    # X โมง: 7-11 = เช้า, 12 = เที่ยง, 1-5 = บ่าย (ภาษาพูด), เวลาที่ผ่านไปแล้ววันนี้เลื่อนเป็นพรุ่งนี้
+    ("9 โมง", at(2026, 10, 18, 9)),
+    ("10 โมงครึ่ง", at(2026, 10, 17, 10, 30)),
+    ("11 โมง 15 นาที", at(2026, 10, 17, 11, 15)),
+    ("4 โมง", at(2026, 10, 17, 16)),
+    ("4 โมงเย็น", at(2026, 10, 17, 16)),
+    ("8 โมงเช้า", at(2026, 10, 18, 8)),
+    ("เก้าโมง", at(2026, 10, 18, 9)),
+    ("๙ โมง", at(2026, 10, 18, 9)),
+    # บ่าย / ทุ่ม / ตี / เที่ยง
+    ("บ่ายโมง", at(2026, 10, 17, 13)),
+    ("บ่าย 2 ครึ่ง", at(2026, 10, 17, 14, 30)),
+    ("บ่ายสาม", at(2026, 10, 17, 15)),
+    ("2 ทุ่ม", at(2026, 10, 17, 20)),
+    ("สองทุ่มครึ่ง", at(2026, 10, 17, 20, 30)),
+    ("ตี 5", at(2026, 10, 18, 5)),
+    ("เที่ยง", at(2026, 10, 17, 12)),
+    ("เที่ยงครึ่ง", at(2026, 10, 17, 12, 30)),
+    ("เที่ยงคืน", at(2026, 10, 18, 0)),
+    # นาฬิกา / am-pm / เวลาสัมพัทธ์
+    ("7:30", at(2026, 10, 18, 7, 30)),
+    ("13.45 น.", at(2026, 10, 17, 13, 45)),
+    ("3 pm", at(2026, 10, 17, 15)),
+    ("12 am", at(2026, 10, 18, 0)),
+    ("อีก 10 นาที", NOW + timedelta(minutes=10)),
+    ("อีกสองชั่วโมง", NOW + timedelta(hours=2)),
+    ("in 2 hours", NOW + timedelta(hours=2)),
+])
+def test_time_words(text, expected):
+    parsed = parse_datetime(text, NOW)
+    assert parsed.value == expected
+    assert parsed.has_time
+
+@pytest.mark.parametrize("text", [
+    "6 โมง",                # เช้าหรือเย็นก็ได้
+    "4 โมงเช้า",            # ช่วงเวลาขัดกับตัวเลข ห้ามเดาเป็นบ่าย 4
+    "พรุ่งนี้เช้า 4 โมง",      # พูดถึงช่วงเช้า จึงไม่เดาเป็น 16:00
+    "บ่าย 7",
+    "ตี 8",
+    "พรุ่งนี้ อีก 2 ชั่วโมง",   # วันกับเวลาสัมพัทธ์ขัดกันเอง
+    "ประชุมทีม",
+])
+def test_unresolvable_times(text):
+    assert parse_datetime(text, NOW).value is None
+
+@pytest.mark.parametrize("text, expected", [
+    ("พรุ่งนี้ 9 โมง", at(2026, 10, 18, 9)),
+    ("มะรืนนี้ บ่าย 2", at(2026, 10, 19, 14)),
+    ("พรุ่งนี้บ่ายสามครึ่ง", at(2026, 10, 18, 15, 30)),
+    ("พรุ่งนี้เย็น 5 โมง", at(2026, 10, 18, 17)),
+    ("อีก 3 วัน 10:00", at(2026, 10, 20, 10)),
+    ("วันจันทร์ 8 โมงเช้า", at(2026, 10, 19, 8)),
+    ("วันเสาร์ 11 โมง", at(2026, 10, 17, 11)),          # วันนี้ ยังไม่ถึงเวลา
+    ("วันเสาร์ 9 โมง", at(2026, 10, 24, 9)),           # วันนี้ แต่เวลาผ่านแล้ว -> สัปดาห์หน้า
+    ("วันเสาร์หน้า 11 โมง", at(2026, 10, 24, 11)),
+    ("next monday 9am", at(2026, 10, 19, 9)),
+    ("วันที่ 20 บ่ายโมง", at(2026, 10, 20, 13)),
+    ("วันที่ 5 9 โมง", at(2026, 11, 5, 9)),             # ผ่านวันที่ 5 ของเดือนนี้แล้ว -> เดือนหน้า
+    ("1 ม.ค. 9 โมง", at(2027, 1, 1, 9)),               # ไม่ระบุปี -> ครั้งถัดไป
+    ("dec 25 9am", at(2026, 12, 25, 9)),
+])
+def test_dates(text, expected):
+    parsed = parse_datetime(text, NOW)
+    assert parsed.value == expected
+    assert parsed.has_date and parsed.has_time
+
+@pytest.mark.parametrize("text, expected", [
+    ("25 ธ.ค. 2569 9:00", at(2026, 12, 25, 9)),
+    ("25 ธันวาคม พ.ศ. 2569 9:00", at(2026, 12, 25, 9)),
+    ("25 ธ.ค. 69 9:00", at(2026, 12, 25, 9)),          # ปี พ.ศ. 2 หลัก
+    ("5/11/2569 10.30", at(2026, 11, 5, 10, 30)),
+    ("5/11/69 10.30", at(2026, 11, 5, 10, 30)),
+    ("5/11/26 10.30", at(2026, 11, 5, 10, 30)),         # 26 ไม่ใช่ พ.ศ. ที่ใกล้ปัจจุบัน -> ค.ศ. 2026
+    ("5/11/2026 10.30", at(2026, 11, 5, 10, 30)),
+])
+def test_buddhist_era_years(text, expected):
+    assert parse_datetime(text, NOW).value == expected
+
+@pytest.mark.parametrize("now, text, expected", [
+    (at(2026, 10, 31, 23, 30), "9 โมง", at(2026, 11, 1, 9)),
+    (at(2026, 12, 31, 20), "พรุ่งนี้ 9 โมง", at(2027, 1, 1, 9)),
+    (at(2026, 12, 31, 23, 50), "อีก 20 นาที", at(2027, 1, 1, 0, 10)),
+    (at(2026, 12, 31, 23, 50), "เที่ยงคืน", at(2027, 1, 1, 0)),
+    (at(2028, 2, 28, 22), "พรุ่งนี้ 8 โมงเช้า", at(2028, 2, 29, 8)),
+    (at(2026, 12, 20, 9), "วันที่ 5 9 โมง", at(2027, 1, 5, 9)),
+])
+def test_rollover(now, text, expected):
+    assert parse_datetime(text, now).value == expected
+
+@pytest.mark.parametrize("text", [
+    "30 ก.พ. 9 โมง",
+    "31/02 9 โมง",
+    "31 ก.ย. 2569 10:00",
+    "พ.ย. 9 โมง",            # มีแต่ชื่อเดือน
+])
+def test_ambiguous_date_is_not_guessed(text):
+    parsed = parse_datetime(text, NOW)
+    assert parsed.value is None
+    assert parsed.has_date
+
+def test_ambiguous_day_of_month():
+    # พฤศจิกายนมี 30 วัน: "วันที่ 31" ห้ามกลายเป็นวันนี้หรือเดือนถัดไป
+    parsed = parse_datetime("วันที่ 31 9 โมง", at(2026, 11, 17, 8))
+    assert parsed.value is None
+    assert parsed.has_date
+
+def test_numeric_date_is_not_a_time():
+    parsed = parse_datetime("25/12", NOW)
+    assert parsed.value is None
+    assert parsed.has_date and not parsed.has_time
+
+def test_spans_cover_date_and_time():
+    text = "พรุ่งนี้ 9 โมงประชุม"
+    parsed = parse_datetime(text, NOW)
+    covered = "".join(text[start:end] for start, end in sorted(parsed.spans))
+    assert covered.replace(" ", "") == "พรุ่งนี้9โมง"
+
+@pytest.mark.parametrize("text, expected", [
+    ("๑๒:๓๐ PM", "12:30 pm"),
+    ("Tomorrow ๙ โมง", "tomorrow 9 โมง"),
+])
+def test_normalize_keeps_length(text, expected):
+    assert normalize(text) == expected
+    assert len(normalize(text)) == len(text)
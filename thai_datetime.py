@@ -0,0 +1,256 @@
+# thai_datetime.py
+
+import re
+from collections import namedtuple
+from datetime import datetime, date, time, timedelta
+
+# =====================================
+# ตัวแปลงวัน/เวลาภาษาไทย-อังกฤษ (เช่น "พรุ่งนี้ 9 โมง", "บ่าย 2 ครึ่ง", "2 ทุ่ม", "25 ธ.ค. 2568", "tomorrow 9am")
+# =====================================
+
+THAI_DIGITS = str.maketrans("๐๑๒๓๔๕๖๗๘๙", "0123456789")
+NUMBER_WORDS = {
+    "หนึ่ง": 1, "นึง": 1, "สอง": 2, "สาม": 3, "สี่": 4, "ห้า": 5, "หก": 6, "เจ็ด": 7,
+    "แปด": 8, "เก้า": 9, "สิบ": 10, "สิบเอ็ด": 11, "สิบสอง": 12,
+}
+_NUM = r"(?:\d{1,2}|" + "|".join(sorted(NUMBER_WORDS, key=len, reverse=True)) + r")"
+_MINUTES = r"(?P<half>\s*ครึ่ง)?(?:\s*(?P<min>\d{1,2})\s*นาที)?"
+
+THAI_MONTHS = {
+    "มกราคม": 1, "ม.ค.": 1, "กุมภาพันธ์": 2, "ก.พ.": 2, "มีนาคม": 3, "มี.ค.": 3, "เมษายน": 4, "เม.ย.": 4,
+    "พฤษภาคม": 5, "พ.ค.": 5, "มิถุนายน": 6, "มิ.ย.": 6, "กรกฎาคม": 7, "ก.ค.": 7, "สิงหาคม": 8, "ส.ค.": 8,
+    "กันยายน": 9, "ก.ย.": 9, "ตุลาคม": 10, "ต.ค.": 10, "พฤศจิกายน": 11, "พ.ย.": 11, "ธันวาคม": 12, "ธ.ค.": 12,
+}
+ENGLISH_MONTHS = {m: i for i, m in enumerate(
+    ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], start=1)}
+THAI_WEEKDAYS = {"จันทร์": 0, "อังคาร": 1, "พุธ": 2, "พฤหัสบดี": 3, "พฤหัส": 3, "ศุกร์": 4, "เสาร์": 5, "อาทิตย์": 6}
+ENGLISH_WEEKDAYS = {d: i for i, d in enumerate(["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"])}
+
+def _alt(words):
+    return "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+# --- เวลา (ลองตามลำดับ ตัวแรกที่เจอถือเป็นเวลา) ---
+RELATIVE_TIME = [
+    re.compile(r"อีก\s*(?P<n>\d{1,3}|" + _NUM + r")\s*(?P<unit>นาที|ชั่วโมง|ชม\.?)"),
+    re.compile(r"\bin\s+(?P<n>\d{1,3})\s*(?P<unit>minutes?|mins?|hours?|hrs?)\b"),
+]
+CLOCK_TIME = re.compile(r"(?<![\d/.-])(?P<h>[01]?\d|2[0-3])[:.](?P<m>[0-5]\d)(?![\d/])\s*(?P<suffix>น\.|นาฬิกา|a\.?m\.?|p\.?m\.?)?")
+AMPM_TIME = re.compile(r"(?<![\d:.])(?P<h>1[0-2]|0?[1-9])\s*(?P<suffix>a\.?m\.?|p\.?m\.?)(?![a-z])")
+MIDNIGHT = re.compile(r"เที่ยงคืน")
+NOON = re.compile(r"เที่ยง(?:วัน|ตรง)?" + _MINUTES)
+EARLY_MORNING = re.compile(r"ตี\s*(?P<n>" + _NUM + r")" + _MINUTES)
+AFTERNOON = re.compile(r"บ่าย\s*(?:(?P<n>" + _NUM + r")\s*(?:โมง)?|โมง)" + _MINUTES)
+EVENING = re.compile(r"(?P<n>" + _NUM + r")\s*ทุ่ม" + _MINUTES)
+O_CLOCK = re.compile(r"(?P<n>" + _NUM + r")\s*โมง\s*(?P<period>เช้า|เย็น|ตรง)?" + _MINUTES)
+
+# --- วันที่ ---
+RELATIVE_DAY_WORDS = {
+    "วันนี้": 0, "คืนนี้": 0, "เย็นนี้": 0, "เช้านี้": 0, "บ่ายนี้": 0, "today": 0, "tonight": 0,
+    "พรุ่งนี้": 1, "tomorrow": 1, "มะรืนนี้": 2, "มะรืน": 2, "day after tomorrow": 2,
+}
+# ไม่กินคำว่า "บ่าย" ต่อท้าย เพราะเป็นต้นของเวลาแบบ AFTERNOON ("พรุ่งนี้บ่าย 3")
+RELATIVE_DAY = re.compile(r"(?:the\s+)?(?P<word>" + _alt(RELATIVE_DAY_WORDS) + r")(?:\s*(?:เช้า|สาย|เย็น|ค่ำ))?")
+IN_DAYS = [
+    re.compile(r"อีก\s*(?P<n>\d{1,3}|" + _NUM + r")\s*วัน"),
+    re.compile(r"\bin\s+(?P<n>\d{1,3})\s*days?\b"),
+]
+THAI_WEEKDAY = re.compile(r"(?:วัน)?(?P<wd>" + _alt(THAI_WEEKDAYS) + r")(?P<next>\s*หน้า)?")
+ENGLISH_WEEKDAY = re.compile(r"\b(?P<next>next\s+)?(?:on\s+)?(?P<wd>" + _alt(ENGLISH_WEEKDAYS) + r")\b")
+THAI_MONTH_DATE = re.compile(r"(?:วันที่\s*)?(?P<d>[0-3]?\d)\s*(?P<mon>" + _alt(THAI_MONTHS) + r")\s*(?:(?:พ\.ศ\.|ค\.ศ\.)\s*)?(?P<y>\d{4})?")
+ENGLISH_MONTH_DATE = [
+    re.compile(r"\b(?P<d>[0-3]?\d)(?:st|nd|rd|th)?\s+(?P<mon>(?:" + _alt(ENGLISH_MONTHS) + r")[a-z]*)\.?,?\s*(?P<y>\d{4})?"),
+    re.compile(r"\b(?P<mon>(?:" + _alt(ENGLISH_MONTHS) + r")[a-z]*)\.?\s+(?P<d>[0-3]?\d)(?:st|nd|rd|th)?,?\s*(?P<y>\d{4})?"),
+]
+# ชื่อเดือนไทยที่ไม่มีวันที่ (เช่น "พ.ย. 9 โมง") ระบุวันไม่ครบ
+THAI_MONTH_ONLY = re.compile(r"(?:เดือน\s*)?(?:" + _alt(THAI_MONTHS) + r")")
+NUMERIC_DATE = re.compile(r"(?<![\d.:])(?:วันที่\s*)?(?P<d>[0-3]?\d)[/-](?P<m>[01]?\d)(?:[/-](?P<y>\d{2,4}))?(?![\d:])")
+DAY_OF_MONTH = re.compile(r"วันที่\s*(?P<d>[0-3]?\d)(?![\d/-])")
+
+ParsedDateTime = namedtuple("ParsedDateTime", "value has_date has_time spans")
+
+# ข้อความระบุวันที่ชัดเจนแต่ใช้ไม่ได้ (เช่น "30 ก.พ.", "31/02", "วันที่ 31" ของเดือนที่มี 30 วัน หรือมีแต่ชื่อเดือน)
+# _match_date คืน (AMBIGUOUS_DATE, span) แทน None เพื่อไม่ให้ถูกตีความเป็นวันนี้/พรุ่งนี้แทน
+AMBIGUOUS_DATE = object()
+# คำที่บอกว่าเป็นช่วงเช้า: "4 โมง" ที่ไม่มีคำต่อท้ายจะไม่ถูกเดาเป็นบ่าย 4 ถ้าข้อความพูดถึงช่วงเช้าไว้
+MORNING_HINT = re.compile(r"เช้า|สาย|morning")
+
+def _number(token):
+    token = token.strip()
+    return int(token) if token.isdigit() else NUMBER_WORDS.get(token)
+
+def _minutes(match):
+    groups = match.groupdict()
+    if groups.get("min"):
+        return int(groups["min"])
+    return 30 if groups.get("half") else 0
+
+def _resolve_year(year, today):
+    """ปี พ.ศ. (เช่น 2568 หรือ 68) แปลงเป็น ค.ศ."""
+    if year is None:
+        return None
+    year = int(year)
+    if year >= 2400:
+        return year - 543
+    if year < 100:
+        buddhist = 2500 + year - 543
+        return buddhist if today.year - 1 <= buddhist <= today.year + 10 else 2000 + year
+    return year
+
+def _build_date(day, month, year, today):
+    """date ที่ตรงกับวัน/เดือน/ปี (ถ้าไม่ระบุปีคือครั้งถัดไปที่ยังไม่ผ่าน) หรือ AMBIGUOUS_DATE ถ้าไม่มีวันนั้นจริง"""
+    try:
+        if year is not None:
+            return date(year, month, day)
+        candidate = date(today.year, month, day)
+        return candidate if candidate >= today else date(today.year + 1, month, day)
+    except ValueError:
+        return AMBIGUOUS_DATE
+
+def _match_time(text):
+    """คืน ((hour, minute) หรือ timedelta สำหรับเวลาแบบสัมพัทธ์, span) หรือ None"""
+    for pattern in RELATIVE_TIME:
+        m = pattern.search(text)
+        if m:
+            n = _number(m.group("n"))
+            unit = m.group("unit")
+            delta = timedelta(hours=n) if unit.startswith(("ชั่วโมง", "ชม", "hour", "hr")) else timedelta(minutes=n)
+            return delta, m.span()
+    m = CLOCK_TIME.search(text)
+    if m:
+        hour, minute = int(m.group("h")), int(m.group("m"))
+        suffix = (m.group("suffix") or "").replace(".", "")
+        if suffix == "pm" and hour < 12:
+            hour += 12
+        elif suffix == "am" and hour == 12:
+            hour = 0
+        return (hour, minute), m.span()
+    m = AMPM_TIME.search(text)
+    if m:
+        hour = int(m.group("h")) % 12
+        if m.group("suffix").replace(".", "") == "pm":
+            hour += 12
+        return (hour, 0), m.span()
+    m = MIDNIGHT.search(text)
+    if m:
+        return (0, 0), m.span()
+    m = NOON.search(text)
+    if m:
+        return (12, _minutes(m)), m.span()
+    m = EARLY_MORNING.search(text)
+    if m:
+        n = _number(m.group("n"))
+        if n is not None and 1 <= n <= 5:
+            return (n, _minutes(m)), m.span()
+    m = AFTERNOON.search(text)
+    if m:
+        n = _number(m.group("n")) if m.group("n") else 1
+        if n is not None and 1 <= n <= 5:
+            return (12 + n, _minutes(m)), m.span()
+    m = EVENING.search(text)
+    if m:
+        n = _number(m.group("n"))
+        if n is not None and 1 <= n <= 5:
+            return (18 + n, _minutes(m)), m.span()
+    m = O_CLOCK.search(text)
+    if m:
+        n, period = _number(m.group("n")), m.group("period")
+        if n is None:
+            return None
+        if period == "เย็น" and 1 <= n <= 6:
+            hour = 12 + n
+        elif period == "เช้า" and 5 <= n <= 11:
+            hour = n
+        elif period in ("เช้า", "เย็น"):
+            return None  # ช่วงเวลาที่ระบุมาขัดกับตัวเลข (เช่น "4 โมงเช้า") ห้ามเดาเป็นช่วงอื่นแทน
+        elif 7 <= n <= 11:
+            hour = n
+        elif n == 12:
+            hour = 12
+        elif 1 <= n <= 5 and not MORNING_HINT.search(text):
+            hour = 12 + n  # "4 โมง" ในภาษาพูดคือ 16:00 (แต่ "พรุ่งนี้เช้า 4 โมง" กำกวม)
+        else:
+            return None  # เช่น "6 โมง" กำกวมระหว่างเช้าและเย็น
+        return (hour, _minutes(m)), m.span()
+    return None
+
+def _match_date(text, today):
+    """คืน (date, span) หรือ (date, span, True) เมื่อเป็นชื่อวันที่ตรงกับวันนี้ (ถ้าเวลาผ่านไปแล้วให้เลื่อนไปสัปดาห์หน้า) หรือ None
+    date เป็น AMBIGUOUS_DATE เมื่อระบุวันที่ไว้แต่ใช้ไม่ได้"""
+    m = RELATIVE_DAY.search(text)
+    if m:
+        return today + timedelta(days=RELATIVE_DAY_WORDS[m.group("word")]), m.span()
+    for pattern in IN_DAYS:
+        m = pattern.search(text)
+        if m:
+            return today + timedelta(days=_number(m.group("n"))), m.span()
+    m = THAI_MONTH_DATE.search(text)
+    if m:
+        return _build_date(int(m.group("d")), THAI_MONTHS[m.group("mon")], _resolve_year(m.group("y"), today), today), m.span()
+    for pattern in ENGLISH_MONTH_DATE:
+        m = pattern.search(text)
+        if m and m.group("mon")[:3] in ENGLISH_MONTHS:
+            return _build_date(int(m.group("d")), ENGLISH_MONTHS[m.group("mon")[:3]], _resolve_year(m.group("y"), today), today), m.span()
+    m = THAI_MONTH_ONLY.search(text)
+    if m:
+        return AMBIGUOUS_DATE, m.span()
+    m = NUMERIC_DATE.search(text)
+    if m:
+        return _build_date(int(m.group("d")), int(m.group("m")), _resolve_year(m.group("y"), today), today), m.span()
+    for pattern, weekdays in ((THAI_WEEKDAY, THAI_WEEKDAYS), (ENGLISH_WEEKDAY, ENGLISH_WEEKDAYS)):
+        m = pattern.search(text)
+        if m:
+            days_ahead = (weekdays[m.group("wd")] - today.weekday()) % 7
+            if m.group("next") and days_ahead == 0:
+                days_ahead = 7
+            return today + timedelta(days=days_ahead), m.span(), days_ahead == 0
+    m = DAY_OF_MONTH.search(text)
+    if m:
+        day = int(m.group("d"))
+        month, year = (today.month, today.year) if day >= today.day else (today.month % 12 + 1, today.year + (today.month == 12))
+        try:
+            return date(year, month, day), m.span()
+        except ValueError:
+            return AMBIGUOUS_DATE, m.span()
+    return None
+
+def normalize(text):
+    """เลขไทยเป็นเลขอารบิก + ตัวพิมพ์เล็ก (ความยาวเท่าเดิม จึงใช้ span กับข้อความต้นฉบับได้)"""
+    normalized = text.translate(THAI_DIGITS).lower()
+    return normalized if len(normalized) == len(text) else text.translate(THAI_DIGITS)
+
+def parse_datetime(text, now):
+    """หาวันและเวลาในข้อความ โดยอิงจาก `now` (datetime ที่มี timezone)
+    คืน ParsedDateTime(value, has_date, has_time, spans) โดย value เป็น None ถ้าไม่พบเวลาหรือวัน/เวลาที่ระบุใช้ไม่ได้
+    ถ้าระบุแค่เวลาและเวลานั้นผ่านไปแล้ววันนี้ จะเลื่อนเป็นพรุ่งนี้"""
+    text = normalize(text)
+    tz = now.tzinfo
+    today = now.date()
+    spans = []
+    found_date = _match_date(text, today)
+    if found_date:
+        spans.append(found_date[1])
+    found_time = _match_time(text)
+    if found_time and any(s < found_time[1][1] and found_time[1][0] < e for s, e in spans):
+        found_time = None  # ทับกับวันที่ (เช่น "25/12") ไม่ใช่เวลา
+    if found_time:
+        spans.append(found_time[1])
+    if not found_time:
+        return ParsedDateTime(None, bool(found_date), False, spans)
+    if found_date and found_date[0] is AMBIGUOUS_DATE:
+        return ParsedDateTime(None, True, True, spans)
+
+    clock = found_time[0]
+    if isinstance(clock, timedelta):
+        if found_date:
+            return ParsedDateTime(None, True, True, spans)  # "พรุ่งนี้ อีก 2 ชั่วโมง" ขัดกันเอง
+        return ParsedDateTime(now + clock, True, True, spans)
+    hour, minute = clock
+    if not 0 <= minute < 60:
+        return ParsedDateTime(None, bool(found_date), True, spans)
+    day = found_date[0] if found_date else today
+    naive = datetime.combine(day, time(hour, minute))
+    value = tz.localize(naive) if hasattr(tz, "localize") else naive.replace(tzinfo=tz)
+    if value <= now and (not found_date or found_date[2:] == (True,)):
+        naive += timedelta(days=7 if found_date else 1)
+        value = tz.localize(naive) if hasattr(tz, "localize") else naive.replace(tzinfo=tz)
+    return ParsedDateTime(value, bool(found_date), True, spans)
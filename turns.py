@@ -0,0 +1,121 @@
+# turns.py
+
+import json
+import random
+from collections import namedtuple
+from datetime import datetime
+
+import pytz
+from linebot.models import TextSendMessage
+
+from conversation import Conversation, SystemPromptCache, ResponseCache, PromptStats, CONTEXT_TOKEN_BUDGET
+from intents import IntentRouter
+from metrics import CONTROL_TAGS
+
+# =====================================
+# ตรรกะของหนึ่งรอบสนทนาที่ใช้ร่วมกันระหว่างโหมด Flask (app.py) และโหมด asyncio (asgi.py)
+# =====================================
+# โมดูลนี้ไม่มี I/O: ผู้เรียกโหลด/commit turn และเรียก Gemini / LINE เองด้วย client ของโหมดนั้น
+
+bangkok_tz = pytz.timezone('Asia/Bangkok')
+MODEL_NAME = "gemini-1.5-flash-latest"
+emotions = ["😊", "😄", "🤔", "👍", "🙌", "😉", "✨"]
+REPLY_TOKEN_TTL = 50  # วินาที; reply token ของ LINE ใช้ได้ประมาณ 1 นาที
+FALLBACK_REPLY = "ขอโทษค่ะ ระบบขัดข้อง"
+EMPTY_REPLY = "ขออภัยค่ะ มีปัญหาในการสร้างคำตอบ"
+OCR_BUSY_REPLY = "ตอนนี้มีรูปรออ่านอยู่เยอะ ลองส่งใหม่อีกครั้งนะคะ 🙏"
+OCR_EMPTY_REPLY = "ขอโทษค่ะ อ่านข้อความจากรูปนี้ไม่ได้"
+BIRTHDAY_MESSAGE = "🎂 สุขสันต์วันเกิดนะคะ! ขอให้เป็นวันที่ดี มีความสุขมากๆ เลยค่ะ 🎉"
+
+def build_system_instruction(profile):
+    profile_str = ", ".join([f"{k}คือ{v}" for k, v in profile.items() if k not in ['pending_action', 'pending_data']])
+    profile_prompt = f"ข้อมูลเกี่ยวกับผู้ใช้: {profile_str}." if profile_str else ""
+    return {"role": "system", "parts": [{"text": f"""คุณคือผู้ช่วย AI ส่วนตัวที่ฉลาด มีอารมณ์ขัน และเป็นมิตร ตอบเป็นภาษาไทย\n{profile_prompt}\n# ความสามารถพิเศษ:\n1.  **จดจำข้อมูล**: หากผู้ใช้บอกข้อมูลส่วนตัว (เช่น ของโปรด, วันเกิดในรูปแบบ DD-MM) ให้ตอบรับและต่อท้ายด้วย `[SAVE_PROFILE:{{"key":"value"}}]`\n2.  **ลืมข้อมูล**: หากผู้ใช้สั่งให้ลืมข้อมูล ให้ตอบรับและต่อท้ายด้วย `[DELETE_PROFILE:{{"key":"ชื่อkey"}}]`\n3.  **ตั้งแจ้งเตือน (สมบูรณ์)**: หากผู้ใช้บอกทั้ง "เวลา" และ "ข้อความ" ให้ตอบรับและต่อท้ายด้วย `[SET_REMINDER:{{"time":"YYYY-MM-DD HH:MM:SS", "message":"ข้อความ"}}]`\n4.  **ตั้งแจ้งเตือน (รอข้อมูล)**: หากผู้ใช้บอก "แค่เวลา" แต่ "ยังไม่บอกข้อความ" ให้ถามกลับว่า "จะให้เตือนเรื่องอะไรดีคะ?" และต่อท้ายด้วย `[SET_PENDING_ACTION:{{"action":"set_reminder_message", "data":{{"time":"YYYY-MM-DD HH:MM:SS"}}}}]`\n5.  **สร้างบุคลิก**: หากผู้ใช้บ่นว่า "เบื่อ" หรือ "เศร้า" ให้เล่าเรื่องตลกสั้นๆ ที่สร้างสรรค์และไม่ซ้ำซาก\nสำคัญ: ห้ามแสดง Markdown ในคำตอบ"""}]}
+
+prompt_cache = SystemPromptCache(build_system_instruction)
+prompt_stats = PromptStats()
+response_cache = ResponseCache()
+intent_router = IntentRouter(bangkok_tz)
+
+CONTROL_TAG_NAMES = ("SAVE_PROFILE", "DELETE_PROFILE", "SET_REMINDER", "SET_PENDING_ACTION")
+
+def apply_control_tags(turn, reply_text):
+    """แปลงคำสั่งท้ายคำตอบของ Gemini (เช่น [SAVE_PROFILE:...]) เป็นการเขียนใน turn แล้วคืนข้อความที่ตัดคำสั่งออกแล้ว"""
+    clean_reply = reply_text
+    if '[SAVE_PROFILE:' in reply_text:
+        command_str = reply_text.split('[SAVE_PROFILE:')[1].split(']')[0]
+        try: turn.update_profile(json.loads(command_str)); clean_reply = reply_text.split('[SAVE_PROFILE:')[0].strip()
+        except Exception as e: print(f"ERROR parsing [SAVE_PROFILE]: {e}")
+    elif '[DELETE_PROFILE:' in reply_text:
+        command_str = reply_text.split('[DELETE_PROFILE:')[1].split(']')[0]
+        try: turn.delete_profile_key(json.loads(command_str)['key']); clean_reply = reply_text.split('[DELETE_PROFILE:')[0].strip()
+        except Exception as e: print(f"ERROR parsing [DELETE_PROFILE]: {e}")
+    elif '[SET_REMINDER:' in reply_text:
+        command_str = reply_text.split('[SET_REMINDER:')[1].split(']')[0]
+        try:
+            r_data = json.loads(command_str)
+            n_dt = bangkok_tz.localize(datetime.strptime(r_data["time"], "%Y-%m-%d %H:%M:%S"))
+            turn.add_reminder(r_data["message"], n_dt)
+            clean_reply = reply_text.split('[SET_REMINDER:')[0].strip()
+        except Exception as e: print(f"ERROR parsing [SET_REMINDER]: {e}")
+    elif '[SET_PENDING_ACTION:' in reply_text:
+        command_str = reply_text.split('[SET_PENDING_ACTION:')[1].split(']')[0]
+        try:
+            a_data = json.loads(command_str)
+            turn.update_profile({"pending_action": a_data.get("action"), "pending_data": a_data.get("data")})
+            clean_reply = reply_text.split('[SET_PENDING_ACTION:')[0].strip()
+        except Exception as e: print(f"ERROR parsing [SET_PENDING_ACTION]: {e}")
+    # นับผลของคำสั่ง (ตามลำดับเดียวกับ elif ด้านบน: มีแค่คำสั่งแรกที่เจอที่ถูกใช้)
+    for tag in CONTROL_TAG_NAMES:
+        if f'[{tag}:' in reply_text:
+            CONTROL_TAGS.inc(tag, "applied" if clean_reply != reply_text else "error")
+            break
+    return clean_reply
+
+# request คือ args ของ generate_text (contents, system_instruction, generation_config) หรือ None ถ้าได้คำตอบจาก cache
+ReplyPlan = namedtuple("ReplyPlan", "conversation cache_key cached_reply request prompt_tokens")
+
+def plan_reply(turn, user_text):
+    """ขั้นแรกของ ask_gemini: สร้างบทสนทนาที่ตัดให้พอดี budget และคำขอไปยัง Gemini (หรือคำตอบที่ cache ไว้)"""
+    conversation = Conversation.from_session(turn.session)
+    # คำถามแรกของบทสนทนา (ไม่มีประวัติ) คำตอบขึ้นกับข้อความและ profile เท่านั้น จึงใช้ response cache ได้
+    stateless = response_cache.enabled and not conversation.history and not conversation.summary
+    cache_key = response_cache.key(user_text, turn.profile) if stateless else None
+    cached_reply = response_cache.get(cache_key) if cache_key else None
+    conversation.add("user", user_text)
+    conversation.fit(CONTEXT_TOKEN_BUDGET)
+    if cached_reply is not None:
+        return ReplyPlan(conversation, cache_key, cached_reply, None, 0)
+    system_instruction, system_tokens = prompt_cache.get(turn.profile, conversation.summary)
+    return ReplyPlan(conversation, cache_key, None, (conversation.contents(), system_instruction, {"temperature": 0.85}),
+                     system_tokens + conversation.history_tokens())
+
+def finish_reply(turn, plan, reply_text):
+    """ขั้นสุดท้ายของ ask_gemini: ใช้คำสั่งท้ายคำตอบ, เก็บ cache และ session ลงใน turn แล้วคืนข้อความที่จะส่ง"""
+    cache_key = plan.cache_key
+    if not reply_text:
+        reply_text, cache_key = EMPTY_REPLY, None
+    clean_reply = apply_control_tags(turn, reply_text)
+    # cache เฉพาะคำตอบที่ไม่มีคำสั่งท้ายข้อความ (ไม่มีผลข้างเคียงต่อ profile/reminder)
+    if cache_key and plan.cached_reply is None and clean_reply == reply_text and not turn.has_writes:
+        response_cache.put(cache_key, reply_text)
+    conversation = plan.conversation
+    conversation.add("model", clean_reply)
+    conversation.fit(CONTEXT_TOKEN_BUDGET)
+    if plan.cached_reply is None:
+        prompt_stats.observe(plan.prompt_tokens, conversation.folded)
+    turn.set_session(json.dumps(conversation.to_session(), ensure_ascii=False))
+    return clean_reply + " " + random.choice(emotions)
+
+def image_prompt(text):
+    """ข้อความที่ส่งเข้ารอบสนทนาแทนรูปภาพ"""
+    return f"ข้อความที่อ่านได้จากรูปภาพที่ส่งมา:\n{text}\n\n(ถ้าเป็นใบนัดหรือมีวันเวลานัดหมาย ช่วยตั้งแจ้งเตือนให้ด้วย)"
+
+def build_reminder_message(message):
+    return TextSendMessage(text=f"⏰ แจ้งเตือนความจำ:\n\n{message}")
+
+def build_daily_summary(reminders_today):
+    summary_text = "สวัสดีตอนเช้าค่ะ! ☀️\nนี่คือรายการแจ้งเตือนสำหรับวันนี้นะคะ:\n"
+    for msg, notify_at in reminders_today:
+        summary_text += f"\n- {notify_at.astimezone(bangkok_tz).strftime('%H:%M')}: {msg}"
+    return TextSendMessage(text=summary_text)
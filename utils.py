@@ -1,8 +1,12 @@
 # utils.py
 
 import os
+import threading
+import time as time_mod
+from contextlib import contextmanager
 import psycopg2
-from datetime import datetime, timezone, time
+from psycopg2.extras import execute_values
+from datetime import datetime, timezone, time, timedelta
 import pytesseract
 from PIL import Image
 import re
@@ -10,6 +14,8 @@ import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import json
 
+from metrics import db_timed, record_stage, DB_POOL_WAIT_SECONDS
+
 # =====================================
 # Google Sheets Functions (คงไว้เผื่อใช้งาน)
 # =====================================
@@ -28,161 +34,669 @@ def get_gsheet_client():
 # =====================================
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
 
-def connect_db():
-    if not DATABASE_URL:
-        raise ConnectionError("DATABASE_URL environment variable is not set.")
-    return psycopg2.connect(DATABASE_URL, keepalives_idle=60, keepalives_interval=10, keepalives_count=5)
+class PoolTimeout(Exception):
+    """รอ connection จาก pool นานเกิน DB_POOL_TIMEOUT"""
+
+def is_connection_error(exc):
+    """error จากการเชื่อมต่อหรือ pool (ลองใหม่ภายหลังได้) ไม่ใช่จากข้อมูลหรือคำสั่ง SQL ที่จะล้มเหลวซ้ำทุกครั้ง"""
+    return isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout))
+
+class _CountingPool:
+    """ที่เก็บ connection ว่าง (idle) ที่นับจำนวน connection ที่เปิดจริง (TLS handshake + auth) และจำนวนที่ยืมออกไป
+    ไม่จำกัดจำนวนเอง: ConnectionPool คุมไม่ให้ยืมเกิน maxconn ด้วย semaphore จึงเก็บ connection ที่คืนมาไว้ใช้ซ้ำได้ทั้งหมด"""
+    def __init__(self, minconn, dsn, **kwargs):
+        self._dsn = dsn
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._idle = []
+        self.opened = 0
+        self.in_use = 0
+        for _ in range(minconn):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        conn = psycopg2.connect(self._dsn, **self._kwargs)
+        with self._lock:
+            self.opened += 1
+        return conn
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def getconn(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+            self.in_use += 1
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self.in_use -= 1
+                raise
+        return conn
+
+    def putconn(self, conn, close=False):
+        # เหมือน psycopg2.pool: rollback transaction ที่ค้าง และปิด connection ที่สถานะไม่แน่นอน
+        if not close and not conn.closed:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try: conn.rollback()
+                except Exception: close = True
+        with self._lock:
+            self.in_use -= 1
+            if not close and not conn.closed:
+                self._idle.append(conn)
+                return
+        try: conn.close()
+        except Exception: pass
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            try: conn.close()
+            except Exception: pass
+
+class ConnectionPool:
+    """Thread-safe connection pool ที่ "รอคิว" เมื่อ connection เต็ม (แทนการ raise ทันที) และเก็บสถิติการใช้งาน"""
+    def __init__(self, dsn, minconn, maxconn, timeout):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._pool = _CountingPool(minconn, dsn, keepalives_idle=60, keepalives_interval=10, keepalives_count=5)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._discarded = 0
 
-def create_tables():
-    """Initializes all database tables if they don't exist."""
-    conn = connect_db()
+    def getconn(self):
+        started = time_mod.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._waits += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self._timeouts += 1
+                raise PoolTimeout(f"No database connection available after {self.timeout}s (pool size {self.maxconn}).")
+        try:
+            conn = self._pool.getconn()
+            if conn.closed:
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        waited = time_mod.monotonic() - started
+        DB_POOL_WAIT_SECONDS.observe(waited)
+        record_stage("db_pool_wait", waited)
+        with self._lock:
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        discard = discard or bool(conn.closed)
+        try:
+            self._pool.putconn(conn, close=discard)
+        finally:
+            with self._lock:
+                if discard:
+                    self._discarded += 1
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.maxconn,
+                "in_use": self._pool.in_use,
+                "idle": self._pool.idle,
+                "opened": self._pool.opened,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_time_total": round(self._wait_total, 6),
+                "wait_time_max": round(self._wait_max, 6),
+                "wait_time_avg": round(self._wait_total / self._checkouts, 6) if self._checkouts else 0.0,
+                "timeouts": self._timeouts,
+                "discarded": self._discarded,
+            }
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_pool():
+    """สร้าง pool ครั้งแรกที่ใช้งาน (lazy) เพื่อไม่ให้ connection ถูกแชร์ข้าม process หลัง fork"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                if not DATABASE_URL:
+                    raise ConnectionError("DATABASE_URL environment variable is not set.")
+                _db_pool = ConnectionPool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT)
+    return _db_pool
+
+def close_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.closeall()
+            _db_pool = None
+
+def get_pool_stats():
+    return _db_pool.stats() if _db_pool is not None else {"size": DB_POOL_MAX, "in_use": 0, "opened": 0, "checkouts": 0}
+
+@contextmanager
+def connect_db():
+    """ยืม connection จาก pool; commit เมื่อสำเร็จ, rollback เมื่อ error และคืน connection ทุกครั้ง"""
+    db_pool = get_pool()
+    conn = db_pool.getconn()
+    discard = False
     try:
-        with conn.cursor() as cur:
-            cur.execute("CREATE TABLE IF NOT EXISTS chat_history (id SERIAL PRIMARY KEY, user_id TEXT, user_message TEXT, bot_response TEXT, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP);")
-            cur.execute("CREATE TABLE IF NOT EXISTS session_data (user_id TEXT PRIMARY KEY, context TEXT, last_updated TIMESTAMP);")
-            cur.execute("CREATE TABLE IF NOT EXISTS user_profiles (user_id TEXT PRIMARY KEY, profile_data JSONB, last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP);")
-            cur.execute("CREATE TABLE IF NOT EXISTS reminders (id SERIAL PRIMARY KEY, user_id TEXT NOT NULL, reminder_message TEXT NOT NULL, notify_at TIMESTAMP WITH TIME ZONE NOT NULL, status TEXT DEFAULT 'pending');")
-            conn.commit()
-            print("All tables created or already exist.")
-    except Exception as e:
-        print(f"Error creating tables: {e}")
-        raise e
+        yield conn
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    except Exception:
+        conn.rollback()
+        raise
     finally:
-        conn.close()
+        db_pool.putconn(conn, discard=discard)
+
+@contextmanager
+def db_cursor():
+    with connect_db() as conn:
+        with conn.cursor() as cur:
+            yield cur
 
 # --- ฟังก์ชันจัดการความจำถาวร (User Profile) ---
+@db_timed
 def get_user_profile(user_id):
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT profile_data FROM user_profiles WHERE user_id = %s", (user_id,))
-    row = cur.fetchone()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("SELECT profile_data FROM user_profiles WHERE user_id = %s", (user_id,))
+        row = cur.fetchone()
     return row[0] if row and row[0] else {}
 
+@db_timed
 def update_user_profile(user_id, data_to_update):
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO user_profiles (user_id, profile_data, last_updated) VALUES (%s, %s::jsonb, %s)
-        ON CONFLICT (user_id) DO UPDATE SET
-        profile_data = user_profiles.profile_data || EXCLUDED.profile_data,
-        last_updated = EXCLUDED.last_updated;
-    """, (user_id, json.dumps(data_to_update), datetime.now(timezone.utc)))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("""
+            INSERT INTO user_profiles (user_id, profile_data, last_updated) VALUES (%s, %s::jsonb, %s)
+            ON CONFLICT (user_id) DO UPDATE SET
+            profile_data = user_profiles.profile_data || EXCLUDED.profile_data,
+            last_updated = EXCLUDED.last_updated;
+        """, (user_id, json.dumps(data_to_update), datetime.now(timezone.utc)))
 
+@db_timed
 def delete_user_profile_key(user_id, key_to_delete):
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE user_profiles SET profile_data = profile_data - %s WHERE user_id = %s;", (key_to_delete, user_id))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("UPDATE user_profiles SET profile_data = profile_data - %s WHERE user_id = %s;", (key_to_delete, user_id))
 
 # --- ฟังก์ชันใหม่: ลบโปรไฟล์ทั้งหมดของผู้ใช้ ---
+@db_timed
 def delete_user_profile(user_id):
     """ลบข้อมูลโปรไฟล์ทั้งหมดของผู้ใช้ (ความจำถาวร)"""
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM user_profiles WHERE user_id = %s", (user_id,))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("DELETE FROM user_profiles WHERE user_id = %s", (user_id,))
 
+@db_timed
 def clear_pending_action(user_id):
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE user_profiles SET profile_data = profile_data - 'pending_action' - 'pending_data' WHERE user_id = %s;", (user_id,))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("UPDATE user_profiles SET profile_data = profile_data - 'pending_action' - 'pending_data' WHERE user_id = %s;", (user_id,))
 
 # --- ฟังก์ชันจัดการระบบแจ้งเตือน (Reminders) ---
+REMINDER_CHANNEL = "reminder_created"
+# INSERT แล้วแจ้ง (NOTIFY) เวลาที่ต้องส่งไปยังทุก process ที่ LISTEN อยู่; NOTIFY จะถูกส่งเมื่อ commit
+INSERT_REMINDER_SQL = f"""
+    WITH r AS (INSERT INTO reminders (user_id, reminder_message, notify_at) VALUES (%s, %s, %s) RETURNING notify_at)
+    SELECT pg_notify('{REMINDER_CHANNEL}', extract(epoch FROM notify_at)::text) FROM r
+"""
+_reminder_listeners = []
+
+def add_reminder_listener(callback):
+    """ลงทะเบียน callback(notify_at) ที่จะถูกเรียกหลังสร้างการแจ้งเตือนใหม่ใน process นี้"""
+    _reminder_listeners.append(callback)
+
+def _announce_reminders(notify_times):
+    for notify_at in notify_times:
+        for callback in _reminder_listeners:
+            try: callback(notify_at)
+            except Exception as e: print(f"ERROR in reminder listener: {e}")
+
+@db_timed
 def create_reminder(user_id, message, notify_at_datetime):
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO reminders (user_id, reminder_message, notify_at) VALUES (%s, %s, %s)", (user_id, message, notify_at_datetime))
-    conn.commit()
-    conn.close()
-
-def get_due_reminders():
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id, user_id, reminder_message FROM reminders WHERE notify_at <= %s AND status = 'pending'", (datetime.now(timezone.utc),))
-    return cur.fetchall()
-
-def delete_reminder(reminder_id):
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM reminders WHERE id = %s", (reminder_id,))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute(INSERT_REMINDER_SQL, (user_id, message, notify_at_datetime))
+    _announce_reminders([notify_at_datetime])
+
+# การส่งแบ่งเป็นสามขั้นเพื่อไม่ถือ connection / transaction ไว้ระหว่างเรียก LINE:
+# claim (เปลี่ยนเป็น 'sending' แล้ว commit) -> push -> finish (บันทึก 'sent' / 'failed' หรือคืนเป็น 'pending')
+# แถว 'sending' ที่ค้างเกิน REMINDER_CLAIM_LEASE วินาที (process ตายระหว่างส่ง) จะถูก claim ใหม่ได้
+REMINDER_CLAIM_LEASE = timedelta(seconds=int(os.getenv("REMINDER_CLAIM_LEASE", "300")))
+REMINDER_RETENTION_DAYS = int(os.getenv("REMINDER_RETENTION_DAYS", "30"))  # 0 = เก็บตลอดไป
+
+# SQL ที่ใช้ร่วมกับ async_db.py (โหมด asyncio) เขียนด้วย placeholder แบบ psycopg2 (%s)
+UPCOMING_REMINDER_TIMES_SQL = """
+    SELECT notify_at FROM reminders WHERE status = 'pending' AND notify_at <= %s
+    UNION SELECT claimed_at + %s::interval FROM reminders WHERE status = 'sending'
+"""
+CLAIM_DUE_REMINDERS_SQL = """
+    UPDATE reminders SET status = 'sending', claimed_at = now()
+    WHERE id IN (
+        SELECT id FROM reminders
+        WHERE ((status = 'pending' AND notify_at <= %s) OR (status = 'sending' AND claimed_at < %s)) AND NOT (id = ANY(%s))
+        ORDER BY notify_at LIMIT %s FOR UPDATE SKIP LOCKED)
+    RETURNING id, user_id, reminder_message, notify_at
+"""
+FINISH_REMINDERS_SQL = """
+    UPDATE reminders SET claimed_at = NULL,
+        status = CASE WHEN id = ANY(%s) THEN 'sent' WHEN id = ANY(%s) THEN 'failed' ELSE 'pending' END
+    WHERE id = ANY(%s) AND status = 'sending'
+"""
+DELETE_FINISHED_REMINDERS_SQL = "DELETE FROM reminders WHERE status IN ('sent', 'failed') AND notify_at < %s"
 
+def claim_params(limit, exclude_ids):
+    now = datetime.now(timezone.utc)
+    return (now, now - REMINDER_CLAIM_LEASE, list(exclude_ids), limit)
+
+def finish_params(claimed_ids, sent_ids, failed_ids):
+    return (list(sent_ids), list(failed_ids), list(claimed_ids))
+
+@db_timed
+def get_upcoming_reminder_times(until):
+    """เวลาแจ้งเตือนที่ยัง pending ทั้งหมดจนถึง `until` (รวมที่เลยกำหนดแล้ว) และเวลาที่ lease ของแถว 'sending' หมด"""
+    with db_cursor() as cur:
+        cur.execute(UPCOMING_REMINDER_TIMES_SQL, (until, REMINDER_CLAIM_LEASE))
+        return [row[0] for row in cur.fetchall()]
+
+@db_timed
+def claim_due_reminders(limit=100, exclude_ids=()):
+    """ย้ายการแจ้งเตือนที่ถึงเวลาแล้วเป็น 'sending' และ commit ทันที คืน [(id, user_id, message, notify_at)]
+    SKIP LOCKED ทำให้ process อื่นที่ claim พร้อมกันได้แถวคนละชุด จึงไม่ส่งซ้ำข้าม process"""
+    with db_cursor() as cur:
+        cur.execute(CLAIM_DUE_REMINDERS_SQL, claim_params(limit, exclude_ids))
+        return cur.fetchall()
+
+@db_timed
+def finish_reminders(claimed_ids, sent_ids, failed_ids=()):
+    """บันทึกผลของแถวที่ claim ไว้ด้วย UPDATE เดียว: sent / failed หรือคืนเป็น pending (แถวที่ต้องลองส่งใหม่)"""
+    if claimed_ids:
+        with db_cursor() as cur:
+            cur.execute(FINISH_REMINDERS_SQL, finish_params(claimed_ids, sent_ids, failed_ids))
+
+@db_timed
+def cleanup_finished_reminders(retention_days=REMINDER_RETENTION_DAYS):
+    """ลบการแจ้งเตือนที่ส่งแล้ว / ส่งไม่สำเร็จที่เลยกำหนดมาเกิน retention_days วัน (รันเป็นระยะจาก scheduler)"""
+    if retention_days <= 0:
+        return 0
+    with db_cursor() as cur:
+        cur.execute(DELETE_FINISHED_REMINDERS_SQL, (datetime.now(timezone.utc) - timedelta(days=retention_days),))
+        return cur.rowcount
+
+REMINDERS_FOR_TODAY_SQL = "SELECT reminder_message, notify_at FROM reminders WHERE user_id = %s AND status = 'pending' AND notify_at BETWEEN %s AND %s ORDER BY notify_at ASC"
+
+@db_timed
 def get_reminders_for_today(user_id, tz):
-    today = datetime.now(tz).date()
-    start_of_day = datetime.combine(today, time.min, tzinfo=tz)
-    end_of_day = datetime.combine(today, time.max, tzinfo=tz)
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT reminder_message, notify_at FROM reminders WHERE user_id = %s AND notify_at BETWEEN %s AND %s ORDER BY notify_at ASC", (user_id, start_of_day, end_of_day))
-    return cur.fetchall()
+    start_of_day, end_of_day = day_bounds(tz)
+    with db_cursor() as cur:
+        cur.execute(REMINDERS_FOR_TODAY_SQL, (user_id, start_of_day, end_of_day))
+        return cur.fetchall()
 
 # --- ฟังก์ชันสำหรับ Dashboard และงานเบื้องหลัง ---
+DAILY_REMINDER_SUMMARIES_SQL = """
+    SELECT user_id, array_agg(reminder_message ORDER BY notify_at), array_agg(notify_at ORDER BY notify_at)
+    FROM reminders WHERE status = 'pending' AND notify_at BETWEEN %s AND %s
+    GROUP BY user_id
+"""
+BIRTHDAY_USERS_SQL = "SELECT user_id FROM user_profiles WHERE profile_data->>'วันเกิด' = %s"
+
+def day_bounds(tz):
+    """ช่วงเวลาเริ่มต้น-สิ้นสุดของวันนี้ตามเขตเวลา tz"""
+    today = datetime.now(tz).date()
+    return datetime.combine(today, time.min, tzinfo=tz), datetime.combine(today, time.max, tzinfo=tz)
+
+@db_timed
+def get_daily_reminder_summaries(tz):
+    """รายการแจ้งเตือนที่ยัง pending ของวันนี้ของทุกผู้ใช้ในคิวรีเดียว: [(user_id, [(message, notify_at), ...]), ...]"""
+    with db_cursor() as cur:
+        cur.execute(DAILY_REMINDER_SUMMARIES_SQL, day_bounds(tz))
+        return [(user_id, list(zip(messages, times))) for user_id, messages, times in cur.fetchall()]
+
+@db_timed
+def get_birthday_users(day_month):
+    """user_id ของทุกคนที่วันเกิด (รูปแบบ DD-MM) ตรงกับ day_month"""
+    with db_cursor() as cur:
+        cur.execute(BIRTHDAY_USERS_SQL, (day_month,))
+        return [row[0] for row in cur.fetchall()]
+
+@db_timed
 def get_all_user_profiles():
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, profile_data, last_updated FROM user_profiles ORDER BY last_updated DESC")
-    return cur.fetchall()
+    with db_cursor() as cur:
+        cur.execute("SELECT user_id, profile_data, last_updated FROM user_profiles ORDER BY last_updated DESC")
+        return cur.fetchall()
 
+@db_timed
 def get_pending_reminders_for_dashboard():
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, reminder_message, notify_at FROM reminders WHERE status = 'pending' ORDER BY notify_at ASC")
-    return cur.fetchall()
+    with db_cursor() as cur:
+        cur.execute("SELECT user_id, reminder_message, notify_at FROM reminders WHERE status = 'pending' ORDER BY notify_at ASC")
+        return cur.fetchall()
+
+# อ่านจาก rollup (หนึ่งแถวต่อผู้ใช้) แทนการไล่ user_id ใน chat_history
+ALL_UNIQUE_USERS_SQL = "SELECT user_id FROM users ORDER BY user_id"
 
+@db_timed
 def get_all_unique_users():
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT DISTINCT user_id FROM chat_history;")
-    return [row[0] for row in cur.fetchall()]
+    with db_cursor() as cur:
+        cur.execute(ALL_UNIQUE_USERS_SQL)
+        return [row[0] for row in cur.fetchall()]
+
+# --- Dashboard API: แบ่งหน้า ค้นหา และเรียงลำดับในฐานข้อมูล ---
+DASHBOARD_CACHE_TTL = float(os.getenv("DASHBOARD_CACHE_TTL", "30"))
+SEARCH_COUNT_CAP = 10000  # นับผลการค้นหาไม่เกินนี้ เพื่อไม่ให้ count(*) สแกนทั้งตาราง
+EXACT_COUNT_THRESHOLD = 100000  # ตารางที่ใหญ่กว่านี้ใช้จำนวนแถวโดยประมาณจาก pg_class
+
+# ชื่อคอลัมน์ทั้งหมดเป็นค่าคงที่ (whitelist) ค่าจากผู้ใช้จะถูกส่งเป็น parameter เท่านั้น
+DASHBOARD_TABLES = {
+    "profiles": {
+        "from": "user_profiles", "where": "TRUE", "key": "user_id",
+        "columns": ["user_id", "profile_data", "last_updated"],
+        "sortable": ["user_id", None, "last_updated"],
+        "search": ["user_id", "profile_data::text"],
+        "default_order": (2, "desc"),
+    },
+    "reminders": {
+        "from": "reminders", "where": "status = 'pending'", "key": "id",
+        "columns": ["user_id", "reminder_message", "notify_at"],
+        "sortable": ["user_id", "reminder_message", "notify_at"],
+        "search": ["user_id", "reminder_message"],
+        "default_order": (2, "asc"),
+    },
+    "chats": {
+        "from": "chat_history", "where": "TRUE", "key": "id",
+        "columns": ["timestamp", "user_id", "user_message", "bot_response"],
+        "sortable": ["timestamp", "user_id", None, None],
+        "search": ["user_id", "user_message", "bot_response"],
+        "default_order": (0, "desc"),
+    },
+}
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+@db_timed
+def query_dashboard_table(name, start=0, length=25, search="", order_column=None, order_dir=None, after=None):
+    """ดึงข้อมูลหนึ่งหน้าของตาราง dashboard
+    ถ้ามี `after` (cursor จากหน้าก่อน) จะใช้ keyset pagination แทน OFFSET จึงเร็วเท่าเดิมไม่ว่าจะอยู่หน้าไหน
+    คืน (rows, จำนวนแถวที่ตรงกับการค้นหา หรือ None ถ้าไม่ได้ค้นหา, cursor ของแถวสุดท้าย)"""
+    spec = DASHBOARD_TABLES[name]
+    col_idx, direction = spec["default_order"]
+    if order_column is not None and 0 <= order_column < len(spec["sortable"]) and spec["sortable"][order_column]:
+        col_idx, direction = order_column, order_dir or direction
+    direction = "DESC" if str(direction).lower() == "desc" else "ASC"
+    sort_col, key = spec["sortable"][col_idx], spec["key"]
+
+    where, params = [spec["where"]], []
+    if search:
+        where.append("(" + " OR ".join(f"{col} ILIKE %s" for col in spec["search"]) + ")")
+        params += [f"%{_escape_like(search)}%"] * len(spec["search"])
+    page_where, page_params, offset = list(where), list(params), max(0, start)
+    if after is not None:
+        page_where.append(f"({sort_col}, {key}) {'<' if direction == 'DESC' else '>'} (%s, %s)")
+        page_params += list(after)
+        offset = 0
+    with db_cursor() as cur:
+        cur.execute(f"""
+            SELECT {", ".join(spec["columns"])}, {sort_col}, {key} FROM {spec["from"]}
+            WHERE {" AND ".join(page_where)}
+            ORDER BY {sort_col} {direction}, {key} {direction} LIMIT %s OFFSET %s
+        """, page_params + [max(1, min(length, 500)), offset])
+        rows = cur.fetchall()
+        filtered = None
+        if search:
+            cur.execute(f"SELECT count(*) FROM (SELECT 1 FROM {spec['from']} WHERE {' AND '.join(where)} LIMIT %s) t",
+                        params + [SEARCH_COUNT_CAP])
+            filtered = cur.fetchone()[0]
+    cursor = list(rows[-1][-2:]) if rows else None
+    return [row[:-2] for row in rows], filtered, cursor
+
+_dashboard_counts = {"expires": 0.0, "value": None}
+_dashboard_counts_lock = threading.Lock()
+
+@db_timed
+def get_dashboard_counts():
+    """ตัวเลขสรุปของ dashboard คำนวณในคิวรีเดียวแล้ว cache ไว้ DASHBOARD_CACHE_TTL วินาที"""
+    with _dashboard_counts_lock:
+        if _dashboard_counts["value"] is not None and time_mod.monotonic() < _dashboard_counts["expires"]:
+            return _dashboard_counts["value"]
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT
+                (SELECT count(*) FROM user_profiles),
+                (SELECT count(*) FROM reminders WHERE status = 'pending'),
+                (SELECT count(*) FROM chat_history WHERE timestamp >= now() - interval '24 hours'),
+                -- chat_history แบ่ง partition: จำนวนแถวโดยประมาณคือผลรวมของทุก partition
+                (SELECT CASE WHEN coalesce(sum(greatest(c.reltuples, 0)), 0) < %s THEN (SELECT count(*) FROM chat_history)
+                        ELSE sum(greatest(c.reltuples, 0))::bigint END
+                 FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'chat_history'::regclass),
+                (SELECT count(*) FROM users WHERE last_seen >= now() - interval '24 hours')
+        """, (EXACT_COUNT_THRESHOLD,))
+        profiles, pending_reminders, messages_24h, chats, active_users_24h = cur.fetchone()
+    value = {"profiles": profiles, "reminders": pending_reminders, "messages_24h": messages_24h, "chats": chats,
+             "active_users_24h": active_users_24h}
+    with _dashboard_counts_lock:
+        _dashboard_counts.update(value=value, expires=time_mod.monotonic() + DASHBOARD_CACHE_TTL)
+    return value
 
 # --- ฟังก์ชันจัดการแชทและความจำระยะสั้น (Session) ---
+# rollup ของตาราง users (first_seen / last_seen / message_count) อัปเดตใน transaction เดียวกับการเขียนแชท
+UPSERT_USER_ROLLUP_SQL = """
+    INSERT INTO users (user_id, first_seen, last_seen, message_count)
+    SELECT * FROM unnest(%s::text[], %s::timestamptz[], %s::timestamptz[], %s::bigint[])
+    ON CONFLICT (user_id) DO UPDATE SET
+        first_seen = LEAST(users.first_seen, EXCLUDED.first_seen),
+        last_seen = GREATEST(users.last_seen, EXCLUDED.last_seen),
+        message_count = users.message_count + EXCLUDED.message_count
+"""
+
+def user_rollup_params(rows):
+    """รวมแถวแชทเป็นหนึ่งรายการต่อผู้ใช้ (array ของ user_id, first_seen, last_seen, จำนวน) สำหรับ UPSERT_USER_ROLLUP_SQL
+    เรียงตาม user_id เพื่อให้ทุก writer ล็อกแถวใน users ตามลำดับเดียวกัน (กัน deadlock); คืน None ถ้าไม่มีผู้ใช้"""
+    rollup = {}
+    for user_id, _, _, ts in rows:
+        if user_id is None:
+            continue
+        entry = rollup.get(user_id)
+        if entry is None:
+            rollup[user_id] = [ts, ts, 1]
+        else:
+            entry[0], entry[1], entry[2] = min(entry[0], ts), max(entry[1], ts), entry[2] + 1
+    if not rollup:
+        return None
+    user_ids = sorted(rollup)
+    return (user_ids, [rollup[u][0] for u in user_ids], [rollup[u][1] for u in user_ids], [rollup[u][2] for u in user_ids])
+
 def save_chat(user_id, user_message, bot_response):
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO chat_history (user_id, user_message, bot_response, timestamp) VALUES (%s, %s, %s, %s)", (user_id, user_message, bot_response, datetime.now()))
-    conn.commit()
-    conn.close()
+    insert_chat_rows([(user_id, user_message, bot_response, datetime.now(timezone.utc))])
 
+@db_timed
+def insert_chat_rows(rows):
+    """บันทึกแชทหลายแถวด้วย INSERT เดียวพร้อมอัปเดต rollup ของ users; rows คือ list ของ (user_id, user_message, bot_response, timestamp)"""
+    rollup = user_rollup_params(rows)
+    with db_cursor() as cur:
+        execute_values(cur, "INSERT INTO chat_history (user_id, user_message, bot_response, timestamp) VALUES %s", rows, page_size=len(rows))
+        if rollup:
+            cur.execute(UPSERT_USER_ROLLUP_SQL, rollup)
+
+CHAT_HISTORY_SQL = "SELECT * FROM chat_history ORDER BY timestamp DESC LIMIT %s"
+
+@db_timed
 def get_chat_history(limit=100):
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM chat_history ORDER BY timestamp DESC LIMIT %s", (limit,))
-    return cur.fetchall()
+    with db_cursor() as cur:
+        cur.execute(CHAT_HISTORY_SQL, (limit,))
+        return cur.fetchall()
 
+@db_timed
 def save_session(user_id, context):
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO session_data (user_id, context, last_updated) VALUES (%s, %s, %s) ON CONFLICT (user_id) DO UPDATE SET context = EXCLUDED.context, last_updated = EXCLUDED.last_updated", (user_id, context, datetime.now()))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("INSERT INTO session_data (user_id, context, last_updated) VALUES (%s, %s::jsonb, %s) ON CONFLICT (user_id) DO UPDATE SET context = EXCLUDED.context, last_updated = EXCLUDED.last_updated", (user_id, context, datetime.now(timezone.utc)))
 
+@db_timed
 def get_session(user_id):
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT context FROM session_data WHERE user_id = %s", (user_id,))
-    row = cur.fetchone()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("SELECT context FROM session_data WHERE user_id = %s", (user_id,))
+        row = cur.fetchone()
     return row[0] if row else None
 
+@db_timed
 def clear_session(user_id):
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM session_data WHERE user_id = %s", (user_id,))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("DELETE FROM session_data WHERE user_id = %s", (user_id,))
+
+# =====================================
+# Idempotency ของ webhook event
+# =====================================
+CLAIM_WEBHOOK_EVENT_SQL = "INSERT INTO processed_events (event_id) VALUES (%s) ON CONFLICT (event_id) DO NOTHING RETURNING event_id"
+RELEASE_WEBHOOK_EVENT_SQL = "DELETE FROM processed_events WHERE event_id = %s"
+DELETE_PROCESSED_EVENTS_SQL = "DELETE FROM processed_events WHERE processed_at < %s"
+
+@db_timed
+def claim_webhook_event(event_id):
+    """บันทึกว่า event นี้ถูกประมวลผลแล้ว; คืน True ถ้าเป็นครั้งแรก, False ถ้าเคยประมวลผลไปแล้ว (LINE ส่งซ้ำ)"""
+    with db_cursor() as cur:
+        cur.execute(CLAIM_WEBHOOK_EVENT_SQL, (event_id,))
+        return cur.fetchone() is not None
+
+@db_timed
+def release_webhook_event(event_id):
+    """ลบ event ที่ claim ไว้แต่ประมวลผลไม่สำเร็จ เพื่อให้ครั้งที่ LINE ส่งซ้ำถูกประมวลผลใหม่"""
+    with db_cursor() as cur:
+        cur.execute(RELEASE_WEBHOOK_EVENT_SQL, (event_id,))
+
+@db_timed
+def delete_processed_events_before(cutoff):
+    with db_cursor() as cur:
+        cur.execute(DELETE_PROCESSED_EVENTS_SQL, (cutoff,))
+        return cur.rowcount
+
+# --- Turn-level data access: โหลดและบันทึกข้อมูลของการสนทนาหนึ่งรอบในรอบเดียว ---
+class Turn:
+    """ข้อมูลของการสนทนาหนึ่งรอบ (profile + session) ที่โหลดด้วย query เดียว
+    การเขียนทั้งหมดในรอบนี้จะถูกสะสมไว้ แล้ว commit พร้อมกันใน transaction เดียวด้วย commit()"""
+    PENDING_KEYS = ('pending_action', 'pending_data')
+
+    def __init__(self, user_id, profile=None, session=None):
+        self.user_id = user_id
+        self.profile = profile or {}
+        self.session = session
+        self._new_session = None
+        self._clear_session = False
+        self._delete_profile = False
+        self._profile_patch = {}
+        self._profile_delete_keys = []
+        self._reminders = []
+
+    def set_session(self, context):
+        self._new_session = context
+        self._clear_session = False
+
+    def clear_session(self):
+        self._new_session = None
+        self._clear_session = True
+
+    def delete_profile(self):
+        """ลบข้อมูลถาวรทั้งหมดของผู้ใช้ (ยกเลิกการแก้ไข profile อื่นที่สะสมไว้ในรอบนี้)"""
+        self._profile_patch = {}
+        self._profile_delete_keys = []
+        self._delete_profile = True
+
+    def update_profile(self, data_to_update):
+        for key in data_to_update:
+            if key in self._profile_delete_keys:
+                self._profile_delete_keys.remove(key)
+        self._profile_patch.update(data_to_update)
+
+    def delete_profile_key(self, key_to_delete):
+        self._profile_patch.pop(key_to_delete, None)
+        if key_to_delete not in self._profile_delete_keys:
+            self._profile_delete_keys.append(key_to_delete)
+
+    def clear_pending_action(self):
+        for key in self.PENDING_KEYS:
+            self.delete_profile_key(key)
+
+    def add_reminder(self, message, notify_at_datetime):
+        self._reminders.append((message, notify_at_datetime))
+
+    @property
+    def has_writes(self):
+        return any([self._new_session is not None, self._clear_session, self._delete_profile,
+                    self._profile_patch, self._profile_delete_keys, self._reminders])
+
+    def statements(self):
+        """คำสั่ง SQL (แบบ psycopg2) ของการเขียนทั้งหมดที่สะสมไว้ ตามลำดับที่ต้องรัน"""
+        now = datetime.now(timezone.utc)
+        if self._new_session is not None:
+            yield ("INSERT INTO session_data (user_id, context, last_updated) VALUES (%s, %s::jsonb, %s) "
+                   "ON CONFLICT (user_id) DO UPDATE SET context = EXCLUDED.context, last_updated = EXCLUDED.last_updated",
+                   (self.user_id, self._new_session, now))
+        elif self._clear_session:
+            yield ("DELETE FROM session_data WHERE user_id = %s", (self.user_id,))
+        if self._delete_profile:
+            yield ("DELETE FROM user_profiles WHERE user_id = %s", (self.user_id,))
+        if self._profile_patch:
+            yield ("""INSERT INTO user_profiles (user_id, profile_data, last_updated) VALUES (%s, %s::jsonb, %s)
+                ON CONFLICT (user_id) DO UPDATE SET
+                profile_data = (user_profiles.profile_data - %s::text[]) || EXCLUDED.profile_data,
+                last_updated = EXCLUDED.last_updated""",
+                   (self.user_id, json.dumps(self._profile_patch), now, self._profile_delete_keys))
+        elif self._profile_delete_keys and not self._delete_profile:
+            yield ("UPDATE user_profiles SET profile_data = profile_data - %s::text[] WHERE user_id = %s",
+                   (self._profile_delete_keys, self.user_id))
+        for message, notify_at in self._reminders:
+            yield (INSERT_REMINDER_SQL, (self.user_id, message, notify_at))
+
+    @db_timed
+    def commit(self):
+        """เขียนทุกอย่างที่สะสมไว้ใน transaction เดียว (ส่งเป็น batch เดียวไปยัง server)"""
+        if not self.has_writes:
+            return
+        with db_cursor() as cur:
+            batch = b";".join(cur.mogrify(sql, params) for sql, params in self.statements())
+            cur.execute(batch)
+        _announce_reminders([notify_at for _, notify_at in self._reminders])
+
+LOAD_TURN_SQL = """
+    SELECT p.profile_data, s.context FROM (SELECT %s::text AS user_id) u
+    LEFT JOIN user_profiles p ON p.user_id = u.user_id
+    LEFT JOIN session_data s ON s.user_id = u.user_id
+"""
+
+@db_timed
+def load_turn(user_id):
+    """โหลด profile และ session ของผู้ใช้ด้วย query เดียว"""
+    with db_cursor() as cur:
+        cur.execute(LOAD_TURN_SQL, (user_id,))
+        profile, session = cur.fetchone()
+    return Turn(user_id, profile or {}, session)
 
 def ocr_image(image_path):
+    """image_path เป็น path / file object หรือ PIL Image ที่เปิดไว้แล้วก็ได้"""
     try:
-        img = Image.open(image_path)
+        img = image_path if isinstance(image_path, Image.Image) else Image.open(image_path)
         return pytesseract.image_to_string(img, lang='tha+eng').strip()
     except Exception as e:
         print(f"OCR error: {e}")
@@ -0,0 +1,30 @@
+# worker.py
+
+import os
+import signal
+import threading
+
+from migrations import migrate
+from background import RUN_SCHEDULER, run_background_jobs
+
+# =====================================
+# process แยกสำหรับงานเบื้องหลัง (reminder dispatcher + งานรายวัน)
+# =====================================
+# ใช้คู่กับ web ที่ตั้ง RUN_SCHEDULER=never: python worker.py
+# รันหลาย instance ได้ ตัวที่ได้ advisory lock จะเป็น leader ตัวอื่นรอรับช่วงต่อ (failover)
+# import แค่ background.py จึงไม่เริ่ม Flask, turn worker, OCR pool หรือ chat log writer เหมือนตอน import app
+stopping = threading.Event()
+signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+if __name__ == "__main__":
+    if os.getenv("SKIP_MIGRATIONS") != "1":
+        print("Initializing database...")
+        migrate()
+    # RUN_SCHEDULER=never มีไว้ปิดงานใน web process; worker ต้องรันงานเสมอ จึงใช้ auto แทน
+    mode = RUN_SCHEDULER if RUN_SCHEDULER in ("auto", "always") else "auto"
+    run_background_jobs(mode)
+    print(f"Background worker running (RUN_SCHEDULER={mode}).")
+    while not stopping.wait(1.0):
+        pass
+    print("Background worker stopping...")
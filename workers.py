@@ -0,0 +1,154 @@
+# workers.py
+
+import queue
+import threading
+import time
+import traceback
+import zlib
+
+# =====================================
+# Worker pool สำหรับประมวลผล event จาก webhook
+# =====================================
+
+class QueueFull(Exception):
+    """คิวของ worker เต็ม (ระบบรับงานไม่ทัน)"""
+
+class LatencyStats:
+    """เก็บค่า count / total / max ของเวลาที่ใช้ในแต่ละขั้น (thread-safe)"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self.last = seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "count": self.count,
+                "avg": round(self.total / self.count, 6) if self.count else 0.0,
+                "max": round(self.max, 6),
+                "last": round(self.last, 6),
+            }
+
+class TurnWorkerPool:
+    """รันงานบน worker threads จำนวนจำกัด โดยงานที่มี key เดียวกัน (เช่น user_id)
+    จะถูกส่งเข้า worker ตัวเดิมเสมอ จึงประมวลผลตามลำดับและไม่แย่งกันแก้ session_data"""
+    def __init__(self, handle_func, num_workers=4, max_queue=1000, name="turn-worker"):
+        self.handle_func = handle_func
+        self.num_workers = max(1, num_workers)
+        self.name = name
+        # ความจุต่อ worker ถูกบังคับใน submit_batch เอง (ไม่ใช่ maxsize ของ Queue) เพื่อให้ resume ใส่งานต่อเนื่องได้เสมอ
+        self.capacity = max(1, max_queue // self.num_workers)
+        self._queues = [queue.Queue() for _ in range(self.num_workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._submit_lock = threading.Lock()
+        self._started = False
+        self.enqueued = 0
+        self.processed = 0
+        self.errors = 0
+        self.rejected = 0
+        self.resumed = 0
+        self.queue_wait = LatencyStats()
+        self.run_time = LatencyStats()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            for i, q in enumerate(self._queues):
+                t = threading.Thread(target=self._run, args=(q,), name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._started = True
+
+    def _shard(self, key):
+        return zlib.crc32(str(key).encode("utf-8")) % self.num_workers
+
+    def submit(self, key, item):
+        """ใส่งานเดียวเข้าคิว; ถ้าคิวเต็มจะ raise QueueFull ทันที"""
+        self.submit_batch([(key, item)])
+
+    def submit_batch(self, entries):
+        """ใส่งาน [(key, item), ...] เข้าคิวแบบทั้งชุดหรือไม่เลย โดยไม่บล็อก
+        ถ้า shard ใดมีที่ว่างไม่พอสำหรับงานของตัวเองในชุดนี้จะ raise QueueFull โดยยังไม่ได้ใส่งานใดเลย
+        (webhook ตอบ 503 แล้ว LINE ส่งซ้ำทั้งชุด จึงไม่เกิดงานซ้ำจากชุดที่ใส่ไปแค่บางส่วน)
+        ผู้ใส่งานถือ _submit_lock ตลอดการเช็กและใส่ ส่วน worker มีแต่เอางานออก ที่ว่างที่เช็กแล้วจึงไม่หายไประหว่างทาง"""
+        by_shard = {}
+        for key, item in entries:
+            by_shard.setdefault(self._shard(key), []).append(item)
+        with self._submit_lock:
+            for shard, items in by_shard.items():
+                q = self._queues[shard]
+                if self.capacity - q.qsize() < len(items):
+                    with self._lock:
+                        self.rejected += len(entries)
+                    raise QueueFull(f"{self.name} queue {shard} has no room for {len(items)} events")
+            now = time.monotonic()
+            for shard, items in by_shard.items():
+                for item in items:
+                    self._queues[shard].put_nowait((now, item))
+        with self._lock:
+            self.enqueued += len(entries)
+
+    def resume(self, key, item):
+        """ใส่งานต่อเนื่องของ event ที่รับไปแล้ว (เช่น ผล OCR) เข้า worker ของ key เดิม จึงยังเรียงลำดับกับข้อความอื่นของผู้ใช้
+        ไม่เช็กความจุและไม่บล็อก: event นี้ตอบ LINE ไปแล้วจึงปฏิเสธไม่ได้ ผู้เรียกต้องจำกัดจำนวนงานแบบนี้เอง"""
+        self._queues[self._shard(key)].put_nowait((time.monotonic(), item))
+        with self._lock:
+            self.resumed += 1
+
+    def _run(self, q):
+        while True:
+            entry = q.get()
+            if entry is None:
+                q.task_done()
+                return
+            enqueued_at, item = entry
+            started = time.monotonic()
+            self.queue_wait.observe(started - enqueued_at)
+            try:
+                self.handle_func(item)
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                print(f"ERROR in {self.name}: {e}\n{traceback.format_exc()}")
+            finally:
+                self.run_time.observe(time.monotonic() - started)
+                q.task_done()
+
+    def stop(self, timeout=10.0):
+        """รอให้งานในคิวเสร็จ (ไม่เกิน timeout) แล้วหยุด worker ทั้งหมด"""
+        if not self._started:
+            return
+        deadline = time.monotonic() + timeout
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self):
+        with self._lock:
+            counters = {"enqueued": self.enqueued, "resumed": self.resumed, "processed": self.processed, "errors": self.errors,
+                        "rejected": self.rejected}
+        return {
+            "workers": self.num_workers,
+            "depth": self.depth(),
+            "depth_per_worker": [q.qsize() for q in self._queues],
+            **counters,
+            "queue_wait_seconds": self.queue_wait.snapshot(),
+            "run_seconds": self.run_time.snapshot(),
+        }
@@ -0,0 +1,6 @@
+# wsgi.py
+
+# entry point สำหรับ gunicorn: gunicorn -c gunicorn.conf.py wsgi:app
+from app import app
+
+application = app